@@ -2,16 +2,32 @@
 # autopub.py - Main processing script for AutoPub Monitor
 
 import os
+import sys
 import csv
 import re
 import json
+import time
 import argparse
 import requests
 from datetime import datetime
 from pathlib import Path
 from process_video import VideoProcessor
+from encode_scheduler import EncodeScheduler
+from checkpoint import JobCheckpoint
+from workspace import JobWorkspace, InsufficientSpaceError, EXIT_DEFERRED, cleanup_stale_workspaces
+from upload_planner import UploadPlanner
+from bandwidth_arbiter import BandwidthArbiter
+from upload_client import send_file
+import resource_accounting
+from change_feed import ChangeFeed
+from queue_scheduler import job_priority
+from media_catalog import MediaCatalog
+from ledger import Ledger
+from processing_jobs import ProcessingClient, ProcessingHandedOff, EXIT_HANDED_OFF, DEFAULT_STORE
+from media_probe import DEFAULT_SPECULATIVE_DIR
 from selenium.webdriver.chrome.service import Service
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
 # Read configuration file
@@ -25,12 +41,36 @@ videos_db_path = os.path.join(script_dir, 'videos_db.csv')
 processed_path = os.path.join(script_dir, 'processed.csv')
 transcription_path = os.path.expanduser('~/AutoPublishDATA/transcription_data')
 preprocess_dir = os.path.expanduser('~/AutoPublishDATA/PreprocessedVideos')
+checkpoint_dir = os.path.expanduser('~/AutoPublishDATA/checkpoints')
 lock_file_path = os.path.join(script_dir, 'autopub.lock')
 bash_script_path = os.path.join(script_dir, 'autopub.sh')
 upload_url = 'http://localhost:8081/upload'
 process_url = 'http://localhost:8081/video-processing'
 publish_url = 'http://lazyingart:8081/publish'
 use_app_api = False
+queue_list_path = os.path.join(script_dir, 'queue_list.txt')
+stream_upload_url = ''
+pipelined_upload = False
+adaptive_upload = False
+audio_first_upload = False
+audio_upload_url = ''
+striped_upload = False
+upload_session_url = ''
+striped_upload_settings = {}
+upload_history_path = os.path.expanduser('~/AutoPublishDATA/upload_history.json')
+upload_settings = {}
+bandwidth_settings = {}
+resource_usage_log = os.path.expanduser('~/AutoPublishDATA/resource_usage.jsonl')
+transcription_feed_path = os.path.expanduser('~/AutoPublishDATA/transcription_changes.jsonl')
+media_catalog_path = os.path.expanduser('~/AutoPublishDATA/media_catalog.sqlite3')
+speculative_dir = DEFAULT_SPECULATIVE_DIR
+publish_coalescer_url = ''
+async_processing = False
+processing_settings = {'store_path': DEFAULT_STORE}
+ledger_settings = {}
+profile_dir = os.path.join(logs_folder_path, 'profiles')
+encode_settings = {}
+workspace_settings = {}
 
 # Parse the bash-style config file using subprocess to evaluate shell expressions
 try:
@@ -43,15 +83,58 @@ try:
         temp_script.write('echo "AUTOPUBLISH_DIR=$AUTOPUBLISH_DIR"\n')
         temp_script.write('echo "VIDEOS_DB_PATH=$VIDEOS_DB_PATH"\n')
         temp_script.write('echo "PROCESSED_PATH=$PROCESSED_PATH"\n')
+        temp_script.write('echo "LEDGER_ROTATE_ENTRIES=$LEDGER_ROTATE_ENTRIES"\n')
+        temp_script.write('echo "LEDGER_MAX_SEGMENTS=$LEDGER_MAX_SEGMENTS"\n')
         temp_script.write('echo "TRANSCRIPTION_DIR=$TRANSCRIPTION_DIR"\n')
         # Add this line after the TRANSCRIPTION_DIR line in the temp script:
         temp_script.write('echo "PREPROCESSED_VIDEOS_DIR=$PREPROCESSED_VIDEOS_DIR"\n')
+        temp_script.write('echo "CHECKPOINT_DIR=$CHECKPOINT_DIR"\n')
+        temp_script.write('echo "WORKSPACE_SHM_DIR=$WORKSPACE_SHM_DIR"\n')
+        temp_script.write('echo "WORKSPACE_SHM_LIMIT_MB=$WORKSPACE_SHM_LIMIT_MB"\n')
+        temp_script.write('echo "WORKSPACE_RESERVE_MB=$WORKSPACE_RESERVE_MB"\n')
         temp_script.write('echo "AUTOPUB_LOCK=$AUTOPUB_LOCK"\n')
         temp_script.write('echo "AUTOPUB_SH=$AUTOPUB_SH"\n')
         temp_script.write('echo "UPLOAD_URL=$UPLOAD_URL"\n')
         temp_script.write('echo "PROCESS_URL=$PROCESS_URL"\n')
         temp_script.write('echo "PUBLISH_URL=$PUBLISH_URL"\n')
         temp_script.write('echo "USE_APP_API=$USE_APP_API"\n')
+        temp_script.write('echo "QUEUE_LIST=$QUEUE_LIST"\n')
+        temp_script.write('echo "STREAM_UPLOAD_URL=$STREAM_UPLOAD_URL"\n')
+        temp_script.write('echo "PIPELINED_UPLOAD=$PIPELINED_UPLOAD"\n')
+        temp_script.write('echo "ADAPTIVE_UPLOAD=$ADAPTIVE_UPLOAD"\n')
+        temp_script.write('echo "AUDIO_FIRST_UPLOAD=$AUDIO_FIRST_UPLOAD"\n')
+        temp_script.write('echo "AUDIO_UPLOAD_URL=$AUDIO_UPLOAD_URL"\n')
+        temp_script.write('echo "STRIPED_UPLOAD=$STRIPED_UPLOAD"\n')
+        temp_script.write('echo "UPLOAD_SESSION_URL=$UPLOAD_SESSION_URL"\n')
+        temp_script.write('echo "STRIPED_UPLOAD_STREAMS=$STRIPED_UPLOAD_STREAMS"\n')
+        temp_script.write('echo "STRIPED_UPLOAD_MAX_STREAMS=$STRIPED_UPLOAD_MAX_STREAMS"\n')
+        temp_script.write('echo "STRIPED_UPLOAD_PART_MIB=$STRIPED_UPLOAD_PART_MIB"\n')
+        temp_script.write('echo "UPLOAD_HISTORY=$UPLOAD_HISTORY"\n')
+        temp_script.write('echo "UPLOAD_TARGET_VIDEO_KBPS=$UPLOAD_TARGET_VIDEO_KBPS"\n')
+        temp_script.write('echo "UPLOAD_TARGET_SHORT_SIDE=$UPLOAD_TARGET_SHORT_SIDE"\n')
+        temp_script.write('echo "BANDWIDTH_LINK_KIB=$BANDWIDTH_LINK_KIB"\n')
+        temp_script.write('echo "BANDWIDTH_SYNC_FLOOR_KIB=$BANDWIDTH_SYNC_FLOOR_KIB"\n')
+        temp_script.write('echo "BANDWIDTH_SYNC_JOBS=$BANDWIDTH_SYNC_JOBS"\n')
+        temp_script.write('echo "RESOURCE_USAGE_LOG=$RESOURCE_USAGE_LOG"\n')
+        temp_script.write('echo "TRANSCRIPTION_CHANGE_FEED=$TRANSCRIPTION_CHANGE_FEED"\n')
+        temp_script.write('echo "MEDIA_CATALOG_DB=$MEDIA_CATALOG_DB"\n')
+        temp_script.write('echo "SPECULATIVE_DIR=$SPECULATIVE_DIR"\n')
+        temp_script.write('echo "PUBLISH_COALESCE=$PUBLISH_COALESCE"\n')
+        temp_script.write('echo "PUBLISH_COALESCER_URL=$PUBLISH_COALESCER_URL"\n')
+        temp_script.write('echo "PROFILE_DIR=$PROFILE_DIR"\n')
+        temp_script.write('echo "ASYNC_PROCESSING=$ASYNC_PROCESSING"\n')
+        temp_script.write('echo "PROCESS_SUBMIT_URL=$PROCESS_SUBMIT_URL"\n')
+        temp_script.write('echo "PROCESS_STATUS_URL=$PROCESS_STATUS_URL"\n')
+        temp_script.write('echo "PROCESS_RESULT_URL=$PROCESS_RESULT_URL"\n')
+        temp_script.write('echo "PROCESSING_CALLBACK_URL=$PROCESSING_CALLBACK_URL"\n')
+        temp_script.write('echo "PROCESSING_JOBS_STORE=$PROCESSING_JOBS_STORE"\n')
+        temp_script.write('echo "ENCODE_CPU_BUDGET=$ENCODE_CPU_BUDGET"\n')
+        temp_script.write('echo "ENCODE_RESERVED_CPUS=$ENCODE_RESERVED_CPUS"\n')
+        temp_script.write('echo "ENCODE_THREADS_PER_JOB=$ENCODE_THREADS_PER_JOB"\n')
+        temp_script.write('echo "ENCODE_NICENESS=$ENCODE_NICENESS"\n')
+        temp_script.write('echo "ENCODE_BACKLOG_THRESHOLD=$ENCODE_BACKLOG_THRESHOLD"\n')
+        temp_script.write('echo "ENCODE_LONG_CLIP_SECONDS=$ENCODE_LONG_CLIP_SECONDS"\n')
+        temp_script.write('echo "ENCODE_SEGMENT_MIN_SECONDS=$ENCODE_SEGMENT_MIN_SECONDS"\n')
     
     # Make the script executable
     os.chmod(temp_script_path, 0o755)
@@ -82,6 +165,14 @@ try:
         transcription_path = config_vars['TRANSCRIPTION_DIR']
     if 'PREPROCESSED_VIDEOS_DIR' in config_vars:  # Add this block
         preprocess_dir = config_vars['PREPROCESSED_VIDEOS_DIR']
+    if config_vars.get('CHECKPOINT_DIR'):
+        checkpoint_dir = config_vars['CHECKPOINT_DIR']
+    if 'WORKSPACE_SHM_DIR' in config_vars:
+        workspace_settings['shm_dir'] = config_vars['WORKSPACE_SHM_DIR'] or None
+    if config_vars.get('WORKSPACE_SHM_LIMIT_MB', '').strip():
+        workspace_settings['shm_limit_bytes'] = int(config_vars['WORKSPACE_SHM_LIMIT_MB']) * 1024 * 1024
+    if config_vars.get('WORKSPACE_RESERVE_MB', '').strip():
+        workspace_settings['reserve_bytes'] = int(config_vars['WORKSPACE_RESERVE_MB']) * 1024 * 1024
     if 'AUTOPUB_LOCK' in config_vars:
         lock_file_path = config_vars['AUTOPUB_LOCK']
     if 'AUTOPUB_SH' in config_vars:
@@ -94,6 +185,81 @@ try:
         publish_url = config_vars['PUBLISH_URL']
     if 'USE_APP_API' in config_vars:
         use_app_api = config_vars['USE_APP_API'].strip().lower() in ("1", "true", "yes")
+    if config_vars.get('QUEUE_LIST'):
+        queue_list_path = config_vars['QUEUE_LIST']
+    if 'STREAM_UPLOAD_URL' in config_vars:
+        stream_upload_url = config_vars['STREAM_UPLOAD_URL']
+    if 'PIPELINED_UPLOAD' in config_vars:
+        pipelined_upload = config_vars['PIPELINED_UPLOAD'].strip().lower() in ("1", "true", "yes")
+    if 'ADAPTIVE_UPLOAD' in config_vars:
+        adaptive_upload = config_vars['ADAPTIVE_UPLOAD'].strip().lower() in ("1", "true", "yes")
+    if 'AUDIO_FIRST_UPLOAD' in config_vars:
+        audio_first_upload = config_vars['AUDIO_FIRST_UPLOAD'].strip().lower() in ("1", "true", "yes")
+    if 'AUDIO_UPLOAD_URL' in config_vars:
+        audio_upload_url = config_vars['AUDIO_UPLOAD_URL']
+    if 'STRIPED_UPLOAD' in config_vars:
+        striped_upload = config_vars['STRIPED_UPLOAD'].strip().lower() in ("1", "true", "yes")
+    if 'UPLOAD_SESSION_URL' in config_vars:
+        upload_session_url = config_vars['UPLOAD_SESSION_URL']
+    if config_vars.get('STRIPED_UPLOAD_STREAMS', '').strip():
+        striped_upload_settings['streams'] = int(config_vars['STRIPED_UPLOAD_STREAMS'])
+    if config_vars.get('STRIPED_UPLOAD_MAX_STREAMS', '').strip():
+        striped_upload_settings['max_streams'] = int(config_vars['STRIPED_UPLOAD_MAX_STREAMS'])
+    if config_vars.get('STRIPED_UPLOAD_PART_MIB', '').strip():
+        striped_upload_settings['part_size'] = int(config_vars['STRIPED_UPLOAD_PART_MIB']) * 1024 * 1024
+    if config_vars.get('UPLOAD_HISTORY'):
+        upload_history_path = config_vars['UPLOAD_HISTORY']
+    if config_vars.get('UPLOAD_TARGET_VIDEO_KBPS', '').strip():
+        upload_settings['target_video_kbps'] = int(config_vars['UPLOAD_TARGET_VIDEO_KBPS'])
+    if config_vars.get('UPLOAD_TARGET_SHORT_SIDE', '').strip():
+        upload_settings['target_short_side'] = int(config_vars['UPLOAD_TARGET_SHORT_SIDE'])
+    if config_vars.get('RESOURCE_USAGE_LOG'):
+        resource_usage_log = config_vars['RESOURCE_USAGE_LOG']
+    if config_vars.get('TRANSCRIPTION_CHANGE_FEED'):
+        transcription_feed_path = config_vars['TRANSCRIPTION_CHANGE_FEED']
+    if config_vars.get('PUBLISH_COALESCE', '').strip().lower() in ("1", "true", "yes"):
+        publish_coalescer_url = config_vars.get('PUBLISH_COALESCER_URL', '')
+    if config_vars.get('MEDIA_CATALOG_DB'):
+        media_catalog_path = config_vars['MEDIA_CATALOG_DB']
+    if config_vars.get('SPECULATIVE_DIR'):
+        speculative_dir = config_vars['SPECULATIVE_DIR']
+    if config_vars.get('PROFILE_DIR'):
+        profile_dir = config_vars['PROFILE_DIR']
+    if 'ASYNC_PROCESSING' in config_vars:
+        async_processing = config_vars['ASYNC_PROCESSING'].strip().lower() in ("1", "true", "yes")
+    for key, setting in (
+        ('PROCESS_SUBMIT_URL', 'submit_url'),
+        ('PROCESS_STATUS_URL', 'status_url'),
+        ('PROCESS_RESULT_URL', 'result_url'),
+        ('PROCESSING_CALLBACK_URL', 'callback_url'),
+        ('PROCESSING_JOBS_STORE', 'store_path'),
+    ):
+        if config_vars.get(key, '').strip():
+            processing_settings[setting] = config_vars[key]
+    for key, setting in (
+        ('LEDGER_ROTATE_ENTRIES', 'rotate_entries'),
+        ('LEDGER_MAX_SEGMENTS', 'max_segments'),
+    ):
+        if config_vars.get(key, '').strip():
+            ledger_settings[setting] = int(config_vars[key])
+    for key, setting in (
+        ('BANDWIDTH_LINK_KIB', 'capacity_kib'),
+        ('BANDWIDTH_SYNC_FLOOR_KIB', 'sync_floor_kib'),
+        ('BANDWIDTH_SYNC_JOBS', 'sync_jobs'),
+    ):
+        if config_vars.get(key, '').strip():
+            bandwidth_settings[setting] = int(config_vars[key])
+    for key, setting in (
+        ('ENCODE_CPU_BUDGET', 'cpu_budget'),
+        ('ENCODE_RESERVED_CPUS', 'reserved_cpus'),
+        ('ENCODE_THREADS_PER_JOB', 'threads_per_job'),
+        ('ENCODE_NICENESS', 'niceness'),
+        ('ENCODE_BACKLOG_THRESHOLD', 'backlog_threshold'),
+        ('ENCODE_LONG_CLIP_SECONDS', 'long_clip_seconds'),
+        ('ENCODE_SEGMENT_MIN_SECONDS', 'segment_min_seconds'),
+    ):
+        if config_vars.get(key, '').strip():
+            encode_settings[setting] = int(config_vars[key])
 except Exception as e:
     print(f"Warning: Error reading config file: {e}. Using default paths.")
 
@@ -107,19 +273,61 @@ print("transcription_path: ", transcription_path)
 open(videos_db_path, 'a').close()
 open(processed_path, 'a').close()
 
+# processed.csv and its sealed segments; lookups cover the whole history
+ledger = Ledger(processed_path, **ledger_settings)
+
+# One CPU budget shared by every encode on this machine
+encode_scheduler = EncodeScheduler(queue_path=queue_list_path, **encode_settings)
+
+# Uploads and publish requests take priority over the rsync loops on the uplink
+bandwidth_arbiter = BandwidthArbiter(**bandwidth_settings)
+
+# Legacy processing runs as a server-side job that the collector picks up,
+# instead of a request held open for the whole processing time
+processing_client = None
+if async_processing and not use_app_api:
+    if all(processing_settings.get(key) for key in ('submit_url', 'status_url', 'result_url')):
+        processing_client = ProcessingClient(**processing_settings)
+    else:
+        print("ASYNC_PROCESSING is on but the processing job URLs are not configured; processing will block.")
+
 # Function to read CSV and get a list of filenames
 def read_csv(csv_path):
     with open(csv_path, newline='') as csvfile:
         reader = csv.reader(csvfile)
         return [row[0] for row in reader]
 
-# Function to check if a file is listed in a CSV, and if not, add it
-def update_csv_if_new(file_path, csv_path):
-    existing_files = read_csv(csv_path)
-    if file_path not in existing_files:
+# Function to add several filenames to a CSV whose current entries are known
+def append_csv_rows(filenames, csv_path):
+    if filenames:
         with open(csv_path, 'a', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow([file_path])
+            writer.writerows([filename] for filename in filenames)
+
+def published_platforms_from_response(response, attempted):
+    """
+    Platforms the publish service reports as published.
+
+    A JSON body with a per-platform mapping under "results" or "platforms"
+    (values True, or objects/strings signalling success) is honoured; any
+    other successful response counts for every attempted platform.
+    """
+    try:
+        payload = response.json()
+    except ValueError:
+        return list(attempted)
+    per_platform = payload.get("results") or payload.get("platforms") if isinstance(payload, dict) else None
+    if not isinstance(per_platform, dict):
+        return list(attempted)
+
+    def succeeded(value):
+        if isinstance(value, dict):
+            return bool(value.get("ok", value.get("success", False)))
+        if isinstance(value, str):
+            return value.lower() in ("ok", "success", "published", "queued")
+        return value is True
+
+    return [name for name in attempted if succeeded(per_platform.get(name, True))]
 
 # Function to process the file, generate zip, and send to lazyingart server
 def process_and_publish_file(
@@ -130,75 +338,245 @@ def process_and_publish_file(
     use_translation_cache=False,
     use_metadata_cache=False,
     use_app_api=False,
+    profile=False,
+):
+    """
+    Process a video and publish the result.
+
+    Stage results are checkpointed, so a retry after a failure resumes at the
+    first stage that did not complete and only publishes to the platforms
+    that have not been published yet. The resources the job uses are logged
+    per stage to the resource usage log; with `profile`, a cProfile dump of
+    the Python side is written to the profile directory.
+
+    Returns:
+        bool: True if every stage succeeded.
+
+    Raises:
+        ProcessingHandedOff: The server is processing the video in the
+            background; the job is retried once the collector has its result.
+    """
+    checkpoint = JobCheckpoint(file_path, checkpoint_dir)
+    with resource_accounting.job_accounting(
+        file_path, resource_usage_log, profile_dir if profile else None
+    ), JobWorkspace(file_path, preprocess_dir, **workspace_settings) as workspace:
+        succeeded = _process_and_publish(
+            file_path, checkpoint, workspace,
+            publish_xhs, publish_bilibili, publish_douyin, publish_shipinhao, publish_y2b,
+            test_mode, use_cache, use_translation_cache, use_metadata_cache, use_app_api,
+        )
+        # Keep the fixed/augmented video for the retry; it is removed on success
+        workspace.keep_artifacts = not succeeded
+    return succeeded
+
+def _process_and_publish(
+    file_path, checkpoint, workspace,
+    publish_xhs, publish_bilibili, publish_douyin, publish_shipinhao, publish_y2b,
+    test_mode, use_cache, use_translation_cache, use_metadata_cache, use_app_api,
 ):
     # Create an instance of VideoProcessor and process the video
     print("Processing file...")
-    processor = VideoProcessor(
-        upload_url, 
-        process_url, 
-        file_path, 
-        transcription_path,
-        preprocess_dir=preprocess_dir,  # Add this parameter
-        use_app_api=use_app_api,
-    )
+    with resource_accounting.stage("preprocess"):
+        processor = VideoProcessor(
+            upload_url, 
+            process_url, 
+            file_path, 
+            transcription_path,
+            preprocess_dir=preprocess_dir,  # Add this parameter
+            use_app_api=use_app_api,
+            encode_scheduler=encode_scheduler,
+            stream_upload_url=stream_upload_url,
+            pipelined_upload=pipelined_upload,
+            checkpoint=checkpoint,
+            workspace=workspace,
+            upload_planner=UploadPlanner(upload_history_path, enabled=adaptive_upload, **upload_settings),
+            bandwidth_arbiter=bandwidth_arbiter,
+            audio_upload_url=audio_upload_url,
+            audio_first_upload=audio_first_upload,
+            upload_session_url=upload_session_url,
+            striped_upload=striped_upload,
+            striped_upload_settings=striped_upload_settings,
+            change_feed=ChangeFeed(transcription_feed_path, transcription_path),
+            processing_client=processing_client,
+            speculative_dir=speculative_dir,
+        )
     process_result = processor.process_video(
         use_cache=use_cache,
         use_translation_cache=use_translation_cache,
         use_metadata_cache=use_metadata_cache
     )
 
+    requested = {
+        "xiaohongshu": publish_xhs,
+        "bilibili": publish_bilibili,
+        "douyin": publish_douyin,
+        "shipinhao": publish_shipinhao,
+        "youtube": publish_y2b,
+    }
+    already_published = checkpoint.published_platforms()
+    if already_published:
+        print(f"Already published to: {', '.join(sorted(already_published))}")
+    platforms = {name: enabled and name not in already_published for name, enabled in requested.items()}
+
     if use_app_api:
         if not process_result or not isinstance(process_result, dict):
             print(f"Failed to process video: {file_path}")
-            return
+            return False
         video_id = process_result.get("video_id")
         if not video_id:
             print("Missing video_id from upload response; skipping publish.")
-            return
+            return False
 
-        if not any([publish_xhs, publish_bilibili, publish_douyin, publish_shipinhao, publish_y2b]):
+        if not any(platforms.values()):
             print("Publishing disabled; skipping publish call.")
-            return
+            checkpoint.clear()
+            return True
 
         publish_endpoint = VideoProcessor.format_video_url(publish_url, video_id)
         payload = {
-            "platforms": {
-                "xiaohongshu": publish_xhs,
-                "bilibili": publish_bilibili,
-                "douyin": publish_douyin,
-                "shipinhao": publish_shipinhao,
-                "youtube": publish_y2b,
-            },
+            "platforms": platforms,
             "test": test_mode,
         }
-        print(f"Publishing via app API: {publish_endpoint}")
-        response = requests.post(publish_endpoint, json=payload)
+        with resource_accounting.stage("publish"), bandwidth_arbiter.transfer("publish", os.path.basename(file_path)):
+            response = None
+            if publish_coalescer_url:
+                # Batched with other videos ready at the same time (publish_coalescer.py)
+                coalescer_endpoint = VideoProcessor.format_video_url(publish_coalescer_url, video_id)
+                print(f"Publishing via the publish coalescer: {coalescer_endpoint}")
+                try:
+                    response = requests.post(coalescer_endpoint, json=payload)
+                except requests.ConnectionError:
+                    print("Publish coalescer is not running; publishing directly.")
+            if response is None:
+                print(f"Publishing via app API: {publish_endpoint}")
+                response = requests.post(publish_endpoint, json=payload)
         print(f"Response: {response.text}")
-        return
+    elif process_result:
+        if not any(platforms.values()):
+            print("Nothing left to publish.")
+            checkpoint.clear()
+            return True
 
-    if process_result:
         # Send zip file to lazyingart server for publishing
-        with open(process_result, 'rb') as f:
-            files = {'file': (os.path.basename(process_result), f)}
-            data = {
-                'publish_xhs': str(publish_xhs).lower(),
-                'publish_bilibili': str(publish_bilibili).lower(),
-                'publish_douyin': str(publish_douyin).lower(),
-                'publish_shipinhao': str(publish_shipinhao).lower(),
-                'publish_y2b': str(publish_y2b).lower(),
-                'test': str(test_mode).lower(),
-                'filename': os.path.basename(process_result),
-            }
-            print(f"Publishing {process_result}")
-            response = requests.post(publish_url, files=files, data=data)
-            print(f"Response: {response.text}")
+        data = {
+            'publish_xhs': str(platforms["xiaohongshu"]).lower(),
+            'publish_bilibili': str(platforms["bilibili"]).lower(),
+            'publish_douyin': str(platforms["douyin"]).lower(),
+            'publish_shipinhao': str(platforms["shipinhao"]).lower(),
+            'publish_y2b': str(platforms["youtube"]).lower(),
+            'test': str(test_mode).lower(),
+            'filename': os.path.basename(process_result),
+        }
+        print(f"Publishing {process_result}")
+        with resource_accounting.stage("publish"):
+            response = send_file(
+                'post', publish_url, 'file', process_result,
+                fields=data, bandwidth=bandwidth_arbiter, kind="publish",
+            )
+        print(f"Response: {response.text}")
     else:
         print(f"Failed to process video: {file_path}")
+        return False
+
+    if not response.ok:
+        print(f"Publish failed with status {response.status_code}; it will be retried.")
+        return False
+
+    attempted = [name for name, enabled in platforms.items() if enabled]
+    published = published_platforms_from_response(response, attempted)
+    checkpoint.record_published(published)
+    missing = set(attempted) - set(published)
+    if missing:
+        print(f"Publishing failed for: {', '.join(sorted(missing))}; they will be retried.")
+        return False
+
+    checkpoint.clear()
+    return True
 
 def visualize_progress(total_files):
     """Visualize the processing progress."""
     return tqdm(total=total_files, desc="Processing videos", unit="file")
 
+def process_file_isolated(file_path, publish_kwargs):
+    """Run process_and_publish_file, returning the error instead of raising it."""
+    try:
+        print("process and publish file: ", file_path)
+        if not process_and_publish_file(file_path, **publish_kwargs):
+            return file_path, "processing or publishing failed"
+        return file_path, None
+    except ProcessingHandedOff as e:
+        return file_path, e
+    except Exception as e:
+        return file_path, f"{type(e).__name__}: {e}"
+
+def process_batch(files_to_process, jobs=1, verbose=False, **publish_kwargs):
+    """
+    Process a list of files serially or across a process pool.
+
+    Workers only process and publish; the ledger (processed.csv) is written
+    by this process alone as results come in, so concurrent jobs never race
+    on it. A file whose processing raises is reported and left out of the
+    ledger so the next run retries it, without stopping the rest of the batch.
+    A file handed off to the processing server is left out of the ledger too,
+    and counts as neither done nor failed.
+
+    Args:
+        files_to_process (list): Paths of the videos to process.
+        jobs (int): Number of worker processes; 1 processes files in order in this process.
+        verbose (bool): Show a progress bar for the whole batch.
+        **publish_kwargs: Forwarded to process_and_publish_file.
+
+    Returns:
+        list: (file_path, error) tuples for the files that failed.
+    """
+    if not files_to_process:
+        return []
+
+    progress_bar = visualize_progress(len(files_to_process)) if verbose else None
+    failures = []
+    batch_started = time.time()
+
+    def record_result(file_path, error):
+        if error is None:
+            ledger.add(os.path.basename(file_path))
+        elif isinstance(error, ProcessingHandedOff):
+            print(f"Handed {file_path} off to the processing server ({error.job_id}); it is published on a later run.")
+        else:
+            print(f"Failed to process {file_path}: {error}")
+            failures.append((file_path, error))
+        if progress_bar is not None:
+            progress_bar.update(1)
+
+    if jobs <= 1:
+        for file_path in files_to_process:
+            record_result(*process_file_isolated(file_path, publish_kwargs))
+    else:
+        print(f"Processing {len(files_to_process)} files with {jobs} parallel jobs")
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(process_file_isolated, file_path, publish_kwargs): file_path
+                for file_path in files_to_process
+            }
+            for future in as_completed(futures):
+                try:
+                    record_result(*future.result())
+                except Exception as e:
+                    # The worker process itself died (e.g. killed by the OOM killer)
+                    record_result(futures[future], f"{type(e).__name__}: {e}")
+
+    if progress_bar is not None:
+        progress_bar.close()
+    if failures:
+        print(f"{len(failures)} of {len(files_to_process)} files failed; they will be retried on the next run.")
+    batch_usage = [
+        record for record in resource_accounting.load_usage(resource_usage_log, since=batch_started)
+        if record["job"] in files_to_process
+    ]
+    if batch_usage:
+        print("Resource usage for this batch:")
+        resource_accounting.print_report(batch_usage)
+    return failures
+
 if __name__ == "__main__":
     # Set random seed for reproducibility
     import random
@@ -206,9 +584,9 @@ if __name__ == "__main__":
     random.seed(23)
     np.random.seed(23)
 
-    # Check if lock file exists, if not, create it
-    if not os.path.exists(lock_file_path):
-        open(lock_file_path, 'a').close()
+    # Drop workspaces of jobs that failed and were never retried
+    for stale_path in cleanup_stale_workspaces(preprocess_dir):
+        print(f"Removed stale workspace: {stale_path}")
 
     # Parse command line arguments
     parser = argparse.ArgumentParser()
@@ -225,8 +603,21 @@ if __name__ == "__main__":
     parser.add_argument('--force', nargs='?', const="", default="", help="Force update the file followed by the --force argument")
     parser.add_argument('--path', action='store', type=str, help="Process only the file at this path")
     parser.add_argument('-v', '--verbose', action='store_true', help="Show progress bar")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of files to process in parallel when scanning the whole directory")
+    parser.add_argument('--profile', action='store_true', help="Write a cProfile dump of each job to PROFILE_DIR")
+    parser.add_argument('--preempting', action='store_true',
+                        help="Run alongside the job holding the lock (an urgent job started by process_queue.sh)")
     args = parser.parse_args()
 
+    # An urgent job runs while the preempted one still holds the lock, and must leave it alone
+    def release_lock():
+        if not args.preempting and os.path.exists(lock_file_path):
+            os.remove(lock_file_path)
+
+    # Check if lock file exists, if not, create it
+    if not args.preempting and not os.path.exists(lock_file_path):
+        open(lock_file_path, 'a').close()
+
     # Determine publishing platforms based on provided arguments
     # If none of the publish_xxx flags are provided, default to publishing on all platforms
     publish_flags_provided = any(
@@ -273,87 +664,92 @@ if __name__ == "__main__":
     
     # Single file mode
     if args.path:
+        # Encodes of a job queued with a higher priority suspend those of lower ones
+        encode_scheduler.priority = job_priority(queue_list_path, args.path)
         filename = os.path.basename(args.path)
         if video_file_pattern.match(filename):
-            processed_files = read_csv(processed_path)
-            if filename not in processed_files or force_filename:
+            if filename not in ledger or force_filename:
                 print("process and publish file: ", args.path)
-                process_and_publish_file(
-                    args.path,
-                    publish_xhs=publish_xhs,
-                    publish_bilibili=publish_bilibili,
-                    publish_douyin=publish_douyin,
-                    publish_y2b=publish_y2b,
-                    publish_shipinhao=publish_shipinhao,
-                    test_mode=test_mode,
-                    use_cache=use_cache,
-                    use_translation_cache=use_translation_cache,
-                    use_metadata_cache=use_metadata_cache,
-                    use_app_api=use_app_api
-                )
-                update_csv_if_new(filename, processed_path)
+                try:
+                    succeeded = process_and_publish_file(
+                        args.path,
+                        publish_xhs=publish_xhs,
+                        publish_bilibili=publish_bilibili,
+                        publish_douyin=publish_douyin,
+                        publish_y2b=publish_y2b,
+                        publish_shipinhao=publish_shipinhao,
+                        test_mode=test_mode,
+                        use_cache=use_cache,
+                        use_translation_cache=use_translation_cache,
+                        use_metadata_cache=use_metadata_cache,
+                        use_app_api=use_app_api,
+                        profile=args.profile,
+                    )
+                except InsufficientSpaceError as e:
+                    # Not enough disk for this job right now; the queue retries it later
+                    print(f"Deferring {args.path}: {e}")
+                    release_lock()
+                    sys.exit(EXIT_DEFERRED)
+                except ProcessingHandedOff as e:
+                    # The queue defers the job; the collector wakes it when the result is in
+                    print(f"Handed {args.path} off to the processing server ({e.job_id})")
+                    release_lock()
+                    sys.exit(EXIT_HANDED_OFF)
+                if not succeeded:
+                    # Leave the file unrecorded and report failure so the queue retries it
+                    release_lock()
+                    sys.exit(1)
+                ledger.add(filename)
         else:
             print(f"The file {filename} does not match the video file pattern or has already been processed.")
     else:
-        # Get list of video files to process
+        # Get list of video files to process from the media catalog; the
+        # watcher keeps it current, so the directory is only walked again
+        # when files came or went while the watcher was not running
         files_to_process = []
-        for filename in os.listdir(autopublish_folder_path):
+        catalog = MediaCatalog(media_catalog_path, autopublish_folder_path, processed_path=processed_path)
+        if catalog.stale():
+            catalog.scan()
+        known_videos = set(read_csv(videos_db_path))
+        new_videos, new_processed = [], []
+        top_level = os.path.abspath(autopublish_folder_path)
+        for entry in catalog.search():
+            filename, file_path = entry["name"], entry["path"]
+            if os.path.dirname(file_path) != top_level:
+                continue
             if filename.startswith("preprocessed"):
-                update_csv_if_new(filename, processed_path)
+                if not entry["processed"]:
+                    new_processed.append(filename)
                 continue
 
-            if video_file_pattern.match(filename):
-                file_path = os.path.join(autopublish_folder_path, filename)
-                if os.path.isfile(file_path):
-                    # Check and update videos_db.csv
-                    update_csv_if_new(filename, videos_db_path)
-                    
-                    processed_files = read_csv(processed_path)
-                    if ((force_files and any(force_file.strip() in filename for force_file in force_files)) or 
-                       (filename and filename in force_files)) or (not force_filename and filename not in processed_files):
-                        files_to_process.append(file_path)
-
-        # Process files with progress visualization if verbose
-        if args.verbose and files_to_process:
-            progress_bar = visualize_progress(len(files_to_process))
-            for file_path in files_to_process:
-                filename = os.path.basename(file_path)
-                print("process and publish file: ", file_path)
-                process_and_publish_file(
-                    file_path,
-                    publish_xhs=publish_xhs,
-                    publish_bilibili=publish_bilibili,
-                    publish_douyin=publish_douyin,
-                    publish_y2b=publish_y2b,
-                    publish_shipinhao=publish_shipinhao,
-                    test_mode=test_mode,
-                    use_cache=use_cache,
-                    use_translation_cache=use_translation_cache,
-                    use_metadata_cache=use_metadata_cache,
-                    use_app_api=use_app_api
-                )
-                update_csv_if_new(filename, processed_path)
-                progress_bar.update(1)
-            progress_bar.close()
-        else:
-            for file_path in files_to_process:
-                filename = os.path.basename(file_path)
-                print("process and publish file: ", file_path)
-                process_and_publish_file(
-                    file_path,
-                    publish_xhs=publish_xhs,
-                    publish_bilibili=publish_bilibili,
-                    publish_douyin=publish_douyin,
-                    publish_y2b=publish_y2b,
-                    publish_shipinhao=publish_shipinhao,
-                    test_mode=test_mode,
-                    use_cache=use_cache,
-                    use_translation_cache=use_translation_cache,
-                    use_metadata_cache=use_metadata_cache,
-                    use_app_api=use_app_api
-                )
-                update_csv_if_new(filename, processed_path)
-
-# After all tasks are done, remove the lock file
-if os.path.exists(lock_file_path):
-    os.remove(lock_file_path)
+            # Check and update videos_db.csv
+            if filename not in known_videos:
+                known_videos.add(filename)
+                new_videos.append(filename)
+
+            if ((force_files and any(force_file.strip() in filename for force_file in force_files)) or
+               (filename and filename in force_files)) or (not force_filename and not entry["processed"]):
+                files_to_process.append(file_path)
+        append_csv_rows(new_videos, videos_db_path)
+        ledger.add_many(new_processed)
+        catalog.close()
+
+        process_batch(
+            files_to_process,
+            jobs=args.jobs,
+            verbose=args.verbose,
+            publish_xhs=publish_xhs,
+            publish_bilibili=publish_bilibili,
+            publish_douyin=publish_douyin,
+            publish_y2b=publish_y2b,
+            publish_shipinhao=publish_shipinhao,
+            test_mode=test_mode,
+            use_cache=use_cache,
+            use_translation_cache=use_translation_cache,
+            use_metadata_cache=use_metadata_cache,
+            use_app_api=use_app_api,
+            profile=args.profile,
+        )
+
+    # After all tasks are done, remove the lock file
+    release_lock()
@@ -24,34 +24,48 @@ echo_with_timestamp "Executing autopub.py with file: ${full_path}..."
 # Create log directory if it doesn't exist
 mkdir -p "${AUTOPUB_LOGS_DIR}"
 
-# Wait for lock file to be released
-while [ -f "${AUTOPUB_LOCK}" ]; do
-    echo_with_timestamp "Another instance of the script is running. Waiting..."
-    sleep 10  # Check every 10 seconds
-done
+# An urgent job started by process_queue.sh with AUTOPUB_PREEMPT=1 runs next to
+# the job holding the lock (whose encodes it suspends) and leaves the lock alone
+EXTRA_ARGS=()
+if [ "${AUTOPUB_PREEMPT:-0}" = "1" ]; then
+    EXTRA_ARGS+=(--preempting)
+else
+    # Wait for lock file to be released
+    while [ -f "${AUTOPUB_LOCK}" ]; do
+        echo_with_timestamp "Another instance of the script is running. Waiting..."
+        sleep 10  # Check every 10 seconds
+    done
 
-# Create a lock file
-touch "${AUTOPUB_LOCK}"
+    # Create a lock file
+    touch "${AUTOPUB_LOCK}"
 
-# Ensure the lock file is removed when the script finishes
-trap 'rm -f "${AUTOPUB_LOCK}"; exit' INT TERM EXIT
+    # Ensure the lock file is removed when the script finishes
+    trap 'rm -f "${AUTOPUB_LOCK}"; exit' INT TERM EXIT
+fi
 
 echo_with_timestamp "Executing autopub.py..."
 if [ -n "${full_path}" ]; then
     # If a full path is provided, run the script with the --path argument
     echo_with_timestamp "Processing file: ${full_path}..."
     sleep 10
-    python "${AUTOPUB_PY}" --use-cache --use-metadata-cache --use-translation-cache --path "${full_path}" > "${AUTOPUB_LOGS_DIR}/autopub_$(date '+%Y-%m-%d_%H-%M-%S').log" 2>&1
+    python "${AUTOPUB_PY}" --use-cache --use-metadata-cache --use-translation-cache "${EXTRA_ARGS[@]}" --path "${full_path}" > "${AUTOPUB_LOGS_DIR}/autopub_$(date '+%Y-%m-%d_%H-%M-%S').log" 2>&1
+    status=$?
 else
     sleep 10
     # If no path is provided, run the script without the --path argument
     python "${AUTOPUB_PY}" --use-cache --use-metadata-cache --use-translation-cache > "${AUTOPUB_LOGS_DIR}/autopub_$(date '+%Y-%m-%d_%H-%M-%S').log" 2>&1
+    status=$?
 fi
 
-echo_with_timestamp "Finished executing autopub.py with file: ${full_path}..."
+echo_with_timestamp "Finished executing autopub.py with file: ${full_path} (exit code ${status})..."
 
 # Remove the lock file and clear the trap
-rm -f "${AUTOPUB_LOCK}"
-trap - INT TERM EXIT
+if [ "${AUTOPUB_PREEMPT:-0}" != "1" ]; then
+    rm -f "${AUTOPUB_LOCK}"
+    trap - INT TERM EXIT
+fi
+
+echo_with_timestamp "Finished autopub.sh..."
 
-echo_with_timestamp "Finished autopub.sh..."
\ No newline at end of file
+# Report autopub.py's result so process_queue.sh can retry failed files
+exit ${status}
\ No newline at end of file
@@ -36,10 +36,23 @@ if [ "$1" = "start" ]; then
         tmux send-keys -t "$SESSION_NAME":0.1 "clear" C-m
         tmux send-keys -t "$SESSION_NAME":0.1 "${MONITOR_AUTOPUBLISH_SH}" C-m
 
-        # Bottom-left: process queue
+        # Bottom-left: process queue (or the cluster coordinator and a local worker)
         tmux send-keys -t "$SESSION_NAME":0.2 "cd ${PROJECT_DIR}" C-m
         tmux send-keys -t "$SESSION_NAME":0.2 "clear" C-m
-        tmux send-keys -t "$SESSION_NAME":0.2 "${PROCESS_QUEUE_SH}" C-m
+        if [ "${PUBLISH_COALESCE}" = "true" ]; then
+            COALESCER_CMD="python3 ${PUBLISH_COALESCER_PY} serve --publish-url '${PUBLISH_URL}' --batch-url '${PUBLISH_BATCH_URL}' --port ${PUBLISH_COALESCER_PORT} --linger ${PUBLISH_BATCH_LINGER_SECONDS} --max-delay ${PUBLISH_BATCH_MAX_DELAY_SECONDS} --max-batch ${PUBLISH_BATCH_MAX_SIZE}"
+            tmux send-keys -t "$SESSION_NAME":0.2 "${COALESCER_CMD} &>> ${AUTOPUB_LOGS_DIR}/publish_coalescer.log &" C-m
+        fi
+        if [ "${ASYNC_PROCESSING}" = "true" ]; then
+            COLLECTOR_CMD="python3 ${PROCESSING_JOBS_PY} --store ${PROCESSING_JOBS_STORE} collect --status-url '${PROCESS_STATUS_URL}' --result-url '${PROCESS_RESULT_URL}' --queue ${QUEUE_LIST} --queue-state ${QUEUE_STATE} --queue-lock ${QUEUE_LOCK} --change-feed ${TRANSCRIPTION_CHANGE_FEED} --transcription-dir ${TRANSCRIPTION_DIR} --poll-seconds ${PROCESSING_POLL_SECONDS} --callback-port ${PROCESSING_CALLBACK_PORT}"
+            tmux send-keys -t "$SESSION_NAME":0.2 "${COLLECTOR_CMD} &>> ${AUTOPUB_LOGS_DIR}/processing_jobs.log &" C-m
+        fi
+        if [ "${CLUSTER_MODE}" = "true" ]; then
+            COORDINATOR_CMD="CLUSTER_TOKEN=${CLUSTER_TOKEN} python3 ${CLUSTER_PY} coordinator --queue ${QUEUE_LIST} --state ${QUEUE_STATE} --lock ${QUEUE_LOCK} --policy ${QUEUE_POLICY} --probe-cache-dir ${PROBE_CACHE_DIR} --speculative-dir ${SPECULATIVE_DIR} --aging-seconds ${QUEUE_AGING_SECONDS} --max-attempts ${QUEUE_MAX_ATTEMPTS} --backoff-base ${QUEUE_BACKOFF_BASE} --backoff-max ${QUEUE_BACKOFF_MAX} --defer-seconds ${QUEUE_DEFER_SECONDS} --handoff-seconds ${PROCESSING_HANDOFF_SECONDS} --failed-list ${FAILED_LIST} --processed ${PROCESSED_PATH} --ledger-rotate-entries ${LEDGER_ROTATE_ENTRIES} --ledger-max-segments ${LEDGER_MAX_SEGMENTS} --lease-seconds ${CLUSTER_LEASE_SECONDS} --host ${CLUSTER_HOST} --port ${CLUSTER_PORT}"
+            tmux send-keys -t "$SESSION_NAME":0.2 "${COORDINATOR_CMD} &>> ${AUTOPUB_LOGS_DIR}/coordinator.log & ${CONDA_ACTIVATE} && CLUSTER_TOKEN=${CLUSTER_TOKEN} python ${CLUSTER_PY} worker --coordinator ${CLUSTER_COORDINATOR_URL}" C-m
+        else
+            tmux send-keys -t "$SESSION_NAME":0.2 "${PROCESS_QUEUE_SH}" C-m
+        fi
 
         # Bottom-right: manual
         tmux send-keys -t "$SESSION_NAME":0.3 "cd ${PROJECT_DIR}" C-m
@@ -52,7 +65,8 @@ if [ "$1" = "start" ]; then
     if ! tmux has-session -t am-transcription-sync 2>/dev/null; then
         echo_with_timestamp "Creating am-transcription-sync tmux session..."
         tmux new-session -d -s am-transcription-sync
-        tmux send-keys -t am-transcription-sync "while true; do rsync -avh --progress ${TRANSCRIPTION_DIR}/ ${JIANGUOYUN_TRANSCRIPTION_DIR}/; sleep 10; done" #C-m
+        MIRROR_CMD="python3 ${CHANGE_FEED_PY} --feed \"${TRANSCRIPTION_CHANGE_FEED}\" --reconcile-hours ${TRANSCRIPTION_RECONCILE_HOURS} --capacity-kib ${BANDWIDTH_LINK_KIB:-0} --sync-floor-kib ${BANDWIDTH_SYNC_FLOOR_KIB} --sync-jobs ${BANDWIDTH_SYNC_JOBS}"
+        tmux send-keys -t am-transcription-sync "${MIRROR_CMD} \"${TRANSCRIPTION_DIR}\" \"${JIANGUOYUN_TRANSCRIPTION_DIR}\"" #C-m
     fi
 
     echo_with_timestamp "All services started successfully!"
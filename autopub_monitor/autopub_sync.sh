@@ -11,6 +11,15 @@ echo_with_timestamp() {
 
 echo_with_timestamp "Starting file synchronization between ${JIANGUOYUN_AUTOPUBLISH_DIR} and ${AUTOPUBLISH_DIR}"
 
+# Probe and check files in the Nutstore folder as soon as they stop changing,
+# so the results are ready by the time they are ingested and queued
+if [ "${SPECULATIVE_PROBE}" = "true" ]; then
+    python3 "${SPECULATIVE_PROBE_PY}" --speculative-dir "${SPECULATIVE_DIR}" run \
+        --stable-seconds "${SPECULATIVE_STABLE_SECONDS}" "${JIANGUOYUN_AUTOPUBLISH_DIR}" &
+    SPECULATIVE_PID=$!
+    trap 'kill ${SPECULATIVE_PID} 2>/dev/null' EXIT
+fi
+
 while true; do
     # Function to check if the filename contains a date in any recognizable format
     contains_date() {
@@ -56,10 +65,16 @@ while true; do
         process_file "$src_file"
     done
 
-    # Perform the rsync operation, including only files with the _COMPLETED suffix
-    rsync -rt --progress --delete --whole-file --min-size=1 \
-        --include="*_COMPLETED.*" --exclude="*" \
-        "${JIANGUOYUN_AUTOPUBLISH_DIR}/" "${AUTOPUBLISH_DIR}/"
+    # Yield the uplink to uploads and publishing (0 = unlimited)
+    BWLIMIT=$(python3 "${BANDWIDTH_ARBITER_PY}" \
+        --capacity-kib "${BANDWIDTH_LINK_KIB:-0}" \
+        --sync-floor-kib "${BANDWIDTH_SYNC_FLOOR_KIB}" \
+        --sync-jobs "${BANDWIDTH_SYNC_JOBS}" bwlimit 2>/dev/null || echo 0)
+
+    # Mirror the files with the _COMPLETED suffix: reflinked or hardlinked on
+    # the same filesystem, copied (at BWLIMIT) across filesystems
+    python3 "${INGEST_PY}" sync --method "${INGEST_METHOD}" --manifest "${INGEST_MANIFEST}" \
+        --bwlimit-kib "${BWLIMIT}" "${JIANGUOYUN_AUTOPUBLISH_DIR}" "${AUTOPUBLISH_DIR}"
     
     # Wait before repeating the operation
     sleep 10
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# bandwidth_arbiter.py - Share the uplink between uploads, publishing and the rsync loops
+
+import io
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import tempfile
+import argparse
+import threading
+from contextlib import contextmanager
+
+from encode_scheduler import _pid_alive
+
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), 'autopub_bandwidth')
+DEFAULT_SYNC_FLOOR_KIB = 256
+DEFAULT_SYNC_JOBS = 2
+
+# Share of the link each kind of transfer gets relative to the others
+TRANSFER_WEIGHTS = {
+    "publish": 3,
+    "upload": 1,
+}
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter for bytes, safe to share between threads.
+
+    A consumer takes its tokens immediately, going into debt if there are not
+    enough, and sleeps the debt off outside the lock, so concurrent consumers
+    are served in arrival order at the bucket's rate. A rate of None means
+    unlimited.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """
+        Args:
+            rate (float, optional): Bytes per second.
+            burst (int, optional): Bytes that may be sent at once after idling;
+                defaults to a quarter second at the rate (at least 64 KiB).
+        """
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.burst = burst
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate if rate and rate > 0 else None
+            self._capacity = self.burst or max(64 * 1024, (self.rate or 0) / 4)
+
+    def consume(self, amount):
+        """Block until `amount` bytes may be sent."""
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self, chunks):
+        """Pass an iterable of byte chunks through the bucket."""
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
+
+
+class ThrottledReader:
+    """
+    File-like wrapper that rate-limits read(), for request bodies.
+
+    Exposes `len` so requests still sends a Content-Length for bodies with a
+    known size (e.g. a MultipartEncoder) instead of chunked encoding.
+    """
+
+    def __init__(self, stream, bucket, length=None):
+        self.stream = stream
+        self.bucket = bucket
+        self.len = length if length is not None else getattr(stream, 'len', None)
+
+    def read(self, size=-1):
+        data = self.stream.read(size if size and size > 0 else 64 * 1024)
+        if data:
+            self.bucket.consume(len(data))
+        return data
+
+
+class BandwidthArbiter:
+    """
+    Machine-wide bandwidth policy for the uplink.
+
+    Uploads and publish requests register as active transfers in a shared,
+    flock-guarded file. While any transfer is active, the rsync loops are held
+    to a small floor through their `--bwlimit`; otherwise they may use the whole
+    link. When the link capacity is known, the Python transfers are
+    token-bucket limited to their weighted share of what the floor leaves, so
+    concurrent jobs and publish requests do not trample each other.
+    """
+
+    def __init__(self, capacity_kib=None, sync_floor_kib=DEFAULT_SYNC_FLOOR_KIB,
+                 sync_jobs=DEFAULT_SYNC_JOBS, state_dir=DEFAULT_STATE_DIR, refresh_interval=2.0):
+        """
+        Args:
+            capacity_kib (int, optional): Uplink capacity in KiB/s (rsync's unit); None if unknown.
+            sync_floor_kib (int): Bandwidth each rsync loop keeps while transfers are active.
+            sync_jobs (int): Number of rsync loops sharing the link.
+            state_dir (str): Directory for the shared transfer registry.
+            refresh_interval (float): Seconds between re-reads of the registry during a transfer.
+        """
+        self.capacity_kib = capacity_kib or None
+        self.sync_floor_kib = sync_floor_kib
+        self.sync_jobs = sync_jobs
+        self.state_dir = state_dir
+        self.refresh_interval = refresh_interval
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.lock_path = os.path.join(self.state_dir, 'transfers.lock')
+        self.transfers_path = os.path.join(self.state_dir, 'transfers.json')
+
+    @contextmanager
+    def _locked_transfers(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.transfers_path) as f:
+                        transfers = json.load(f)
+                except (OSError, ValueError):
+                    transfers = {}
+                transfers = {key: t for key, t in transfers.items() if _pid_alive(t["pid"])}
+                yield transfers
+                temp_path = f"{self.transfers_path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w') as f:
+                    json.dump(transfers, f)
+                os.replace(temp_path, self.transfers_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def active_transfers(self):
+        with self._locked_transfers() as transfers:
+            return list(transfers.values())
+
+    def transfer_rate(self, kind, transfers=None):
+        """Bytes per second a transfer of this kind may use, or None for unlimited."""
+        if self.capacity_kib is None:
+            return None
+        if transfers is None:
+            transfers = self.active_transfers()
+        available_kib = max(self.capacity_kib - self.sync_floor_kib * self.sync_jobs, self.capacity_kib / 4)
+        total_weight = sum(TRANSFER_WEIGHTS.get(t["kind"], 1) for t in transfers) or 1
+        return available_kib * 1024 * TRANSFER_WEIGHTS.get(kind, 1) / total_weight
+
+    def sync_bwlimit(self):
+        """`--bwlimit` value (KiB/s) for one rsync loop right now; 0 means unlimited."""
+        if self.active_transfers():
+            return self.sync_floor_kib
+        if self.capacity_kib is None:
+            return 0
+        return max(self.sync_floor_kib, int(self.capacity_kib / self.sync_jobs))
+
+    @contextmanager
+    def transfer(self, kind="upload", label=""):
+        """
+        Register an upload or publish transfer for its duration.
+
+        Yields:
+            TokenBucket: Limiter for the transfer's bytes; its rate follows the
+            number of concurrent transfers.
+        """
+        key = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        with self._locked_transfers() as transfers:
+            transfers[key] = {"pid": os.getpid(), "kind": kind, "label": label, "started": time.time()}
+            rate = self.transfer_rate(kind, list(transfers.values()))
+
+        bucket = TokenBucket(rate)
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.wait(self.refresh_interval):
+                bucket.set_rate(self.transfer_rate(kind))
+
+        refresher = None
+        if self.capacity_kib is not None:
+            refresher = threading.Thread(target=refresh, name="bandwidth-refresh", daemon=True)
+            refresher.start()
+        try:
+            yield bucket
+        finally:
+            stop.set()
+            if refresher is not None:
+                refresher.join()
+            with self._locked_transfers() as transfers:
+                transfers.pop(key, None)
+
+
+def _send(link, limiter, total_bytes, chunk_size=64 * 1024):
+    """Push bytes through an optional per-flow limiter and then the shared link."""
+    sent = 0
+    while sent < total_bytes:
+        chunk = min(chunk_size, total_bytes - sent)
+        if limiter is not None:
+            limiter.consume(chunk)
+        link.consume(chunk)
+        sent += chunk
+
+
+def run_benchmark(link_mib=16.0, upload_mib=16.0, sync_flows=2, sync_floor_kib=512, repeats=3):
+    """
+    Upload latency on a throttled stand-in link while the rsync loops are busy.
+
+    The link is a shared token bucket at `link_mib` MiB/s. Background threads
+    play the rsync loops and send continuously; an upload of `upload_mib` MiB
+    starts once they are running. Without arbitration every flow gets an
+    equal share of the link. With arbitration a BandwidthArbiter with the
+    link's capacity and a scratch registry decides: the sync threads re-read
+    sync_bwlimit() before each chunk, as the rsync loops do before each run,
+    and the upload registers through transfer() and sends its body through a
+    ThrottledReader on the bucket it gets.
+    """
+    link_rate = link_mib * 1024 * 1024
+    upload_bytes = int(upload_mib * 1024 * 1024)
+    results = {}
+    for mode in ("unmanaged", "arbitrated"):
+        latencies = []
+        for _ in range(repeats):
+            link = TokenBucket(link_rate, burst=64 * 1024)
+            stop = threading.Event()
+            state_dir = tempfile.mkdtemp(prefix="bandwidth_bench_")
+            arbiter = None
+            if mode == "arbitrated":
+                arbiter = BandwidthArbiter(int(link_mib * 1024), sync_floor_kib, sync_flows, state_dir,
+                                           refresh_interval=0.5)
+
+            def sync_loop():
+                limiter = TokenBucket() if arbiter is not None else None
+                while not stop.is_set():
+                    if limiter is not None:
+                        limiter.set_rate(arbiter.sync_bwlimit() * 1024)
+                    _send(link, limiter, 256 * 1024)
+
+            threads = [threading.Thread(target=sync_loop, daemon=True) for _ in range(sync_flows)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+
+            start_time = time.monotonic()
+            if arbiter is None:
+                _send(link, None, upload_bytes)
+            else:
+                with arbiter.transfer("upload", "benchmark") as bucket:
+                    body = ThrottledReader(io.BytesIO(bytes(upload_bytes)), bucket, upload_bytes)
+                    while True:
+                        data = body.read(64 * 1024)
+                        if not data:
+                            break
+                        link.consume(len(data))
+            latencies.append(time.monotonic() - start_time)
+
+            stop.set()
+            for thread in threads:
+                thread.join()
+            shutil.rmtree(state_dir, ignore_errors=True)
+        results[mode] = latencies
+
+    ideal = upload_mib / link_mib
+    print(f"Link {link_mib:.0f} MiB/s, upload {upload_mib:.0f} MiB, {sync_flows} sync flows "
+          f"(floor {sync_floor_kib} KiB/s each); idle-link upload takes {ideal:.2f}s")
+    print(f"{'mode':<12}{'mean':>8}{'best':>8}{'worst':>8}")
+    for mode, latencies in results.items():
+        print(f"{mode:<12}{sum(latencies) / len(latencies):>7.2f}s{min(latencies):>7.2f}s{max(latencies):>7.2f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uplink bandwidth arbitration")
+    parser.add_argument('--capacity-kib', type=int, default=None, help="Uplink capacity in KiB/s")
+    parser.add_argument('--sync-floor-kib', type=int, default=DEFAULT_SYNC_FLOOR_KIB,
+                        help="Bandwidth each rsync loop keeps during uploads (KiB/s)")
+    parser.add_argument('--sync-jobs', type=int, default=DEFAULT_SYNC_JOBS, help="Number of rsync loops")
+    parser.add_argument('--state-dir', default=DEFAULT_STATE_DIR, help="Shared transfer registry")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('bwlimit', help="Print the --bwlimit (KiB/s) for an rsync loop")
+    subparsers.add_parser('status', help="Show active transfers")
+    bench_parser = subparsers.add_parser('benchmark', help="Upload latency under sync contention")
+    bench_parser.add_argument('--link-mib', type=float, default=16.0, help="Stand-in link speed (MiB/s)")
+    bench_parser.add_argument('--upload-mib', type=float, default=16.0, help="Upload size (MiB)")
+    bench_parser.add_argument('--repeats', type=int, default=3, help="Runs per mode")
+
+    args = parser.parse_args()
+    if args.command == 'benchmark':
+        run_benchmark(args.link_mib, args.upload_mib, args.sync_jobs, args.sync_floor_kib, args.repeats)
+    else:
+        arbiter = BandwidthArbiter(args.capacity_kib, args.sync_floor_kib, args.sync_jobs, args.state_dir)
+        if args.command == 'bwlimit':
+            print(arbiter.sync_bwlimit())
+        else:
+            transfers = arbiter.active_transfers()
+            print(f"Active transfers: {len(transfers)}; rsync --bwlimit={arbiter.sync_bwlimit()}")
+            for t in transfers:
+                rate = arbiter.transfer_rate(t["kind"], transfers)
+                limit = f"{rate / 1024:.0f} KiB/s" if rate else "unlimited"
+                print(f"  pid {t['pid']} {t['kind']:<8} {limit:>14}  {t['label']}")
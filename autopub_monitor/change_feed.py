@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# change_feed.py - Change feed of pipeline artifacts and an incremental mirror that follows it
+
+import os
+import json
+import time
+import fcntl
+import argparse
+from contextlib import contextmanager
+
+from bandwidth_arbiter import BandwidthArbiter, TokenBucket, DEFAULT_SYNC_FLOOR_KIB, DEFAULT_SYNC_JOBS
+from ingest import copy_file
+
+DEFAULT_FEED = os.path.expanduser('~/AutoPublishDATA/transcription_changes.jsonl')
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Write a file under a temporary name and rename it into place once complete.
+
+    Readers (and the mirror) never see a partial file; on an error the
+    temporary file is removed and any previous version stays.
+    """
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class ChangeFeed:
+    """
+    Append-only JSON-lines log of files the pipeline wrote under a root directory.
+
+    Each line is {"at", "op": "write"|"delete", "path"} with the path relative
+    to the root. Appends are flock-guarded so parallel jobs can share one feed;
+    a reader's position is simply a byte offset into the file.
+    """
+
+    def __init__(self, feed_path=DEFAULT_FEED, root=None):
+        self.feed_path = feed_path
+        self.root = root
+
+    def record(self, path, op="write"):
+        """Announce a file that was written (or deleted); failures only warn."""
+        relative = os.path.relpath(path, self.root) if self.root else path
+        line = json.dumps({"at": time.time(), "op": op, "path": relative}) + '\n'
+        try:
+            os.makedirs(os.path.dirname(self.feed_path) or '.', exist_ok=True)
+            with open(self.feed_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(line)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except OSError as e:
+            print(f"Warning: could not record {relative} in the change feed: {e}")
+
+    def read(self, offset=0):
+        """
+        Complete records after a byte offset.
+
+        Returns:
+            tuple: (records, new offset); a partially written last line is left for the next read.
+        """
+        try:
+            with open(self.feed_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset = 0  # the feed was truncated or replaced
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0
+        end = data.rfind(b'\n') + 1
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records, offset + end
+
+
+class Mirror:
+    """
+    Keeps a copy of a directory tree up to date by following its change feed.
+
+    Only the paths named in the feed are copied, each under a temporary name
+    renamed into place, with the source's mtime. While idle the mirror only
+    stats the feed file. A full reconcile, comparing size and mtime of every
+    file, runs at start and then every `reconcile_seconds` as a safety net for
+    writes that bypassed the feed. Copies run at the `--bwlimit` the bandwidth
+    arbiter gives a sync loop, re-read before each batch.
+    """
+
+    def __init__(self, feed, source_root, dest_root, cursor_path=None,
+                 reconcile_seconds=6 * 3600, bandwidth=None):
+        self.feed = feed
+        self.source_root = source_root
+        self.dest_root = dest_root
+        self.cursor_path = cursor_path or f"{feed.feed_path}.cursor"
+        self.reconcile_seconds = reconcile_seconds
+        self.bandwidth = bandwidth
+        self.bucket = TokenBucket()
+        try:
+            with open(self.cursor_path) as f:
+                self.offset = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            self.offset = 0
+
+    def _save_cursor(self):
+        temp_path = f"{self.cursor_path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(str(self.offset))
+        os.replace(temp_path, self.cursor_path)
+
+    def _update_rate(self):
+        if self.bandwidth is not None:
+            self.bucket.set_rate(self.bandwidth.sync_bwlimit() * 1024)
+
+    def copy(self, relative):
+        """Copy one file into the mirror atomically; False if the source is gone."""
+        source = os.path.join(self.source_root, relative)
+        target = os.path.join(self.dest_root, relative)
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            return False
+        directory, name = os.path.split(target)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, f".{name}.{os.getpid()}.mirror")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            copy_file(source, temp_path, self.bucket)
+            os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(temp_path, target)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return True
+
+    def delete(self, relative):
+        try:
+            os.remove(os.path.join(self.dest_root, relative))
+        except FileNotFoundError:
+            pass
+
+    def follow(self):
+        """Apply the feed records written since the last call; returns how many were applied."""
+        records, offset = self.feed.read(self.offset)
+        # Only the latest record per path matters
+        latest = {}
+        for record in records:
+            latest[record["path"]] = record["op"]
+        if latest:
+            self._update_rate()
+        for relative, op in latest.items():
+            try:
+                if op == "delete":
+                    self.delete(relative)
+                elif self.copy(relative):
+                    print(f"Mirrored {relative}")
+            except OSError as e:
+                print(f"Failed to mirror {relative}: {e}; the next reconcile retries it")
+        if offset != self.offset:
+            self.offset = offset
+            self._save_cursor()
+        return len(latest)
+
+    def reconcile(self):
+        """Copy every file whose size or mtime differs in the mirror; returns how many were copied."""
+        copied = 0
+        self._update_rate()
+        for directory, dirs, files in os.walk(self.source_root):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                source = os.path.join(directory, name)
+                relative = os.path.relpath(source, self.source_root)
+                try:
+                    stat = os.stat(source)
+                    mirrored = os.stat(os.path.join(self.dest_root, relative))
+                    if mirrored.st_size == stat.st_size and mirrored.st_mtime_ns == stat.st_mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+                try:
+                    if self.copy(relative):
+                        copied += 1
+                except OSError as e:
+                    print(f"Failed to mirror {relative}: {e}")
+        return copied
+
+    def run(self, poll_interval=2.0):
+        """Follow the feed forever, reconciling periodically."""
+        last_reconcile = 0.0
+        last_signature = None
+        while True:
+            if self.reconcile_seconds and time.time() - last_reconcile >= self.reconcile_seconds:
+                start_time = time.time()
+                copied = self.reconcile()
+                last_reconcile = time.time()
+                print(f"Reconcile copied {copied} files in {last_reconcile - start_time:.1f}s")
+            try:
+                stat = os.stat(self.feed.feed_path)
+                signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            except FileNotFoundError:
+                signature = None
+            if signature != last_signature:
+                self.follow()
+                last_signature = signature
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mirror a directory by following its change feed")
+    parser.add_argument('source_root', help="Directory the pipeline writes (TRANSCRIPTION_DIR)")
+    parser.add_argument('dest_root', help="Mirror directory")
+    parser.add_argument('--feed', default=DEFAULT_FEED, help="Change feed file")
+    parser.add_argument('--cursor', help="Where the mirror keeps its position (default: FEED.cursor)")
+    parser.add_argument('--reconcile-hours', type=float, default=6.0, help="Hours between full reconciles (0 = never)")
+    parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds between checks of the feed")
+    parser.add_argument('--capacity-kib', type=int, default=None, help="Uplink capacity for the bandwidth arbiter")
+    parser.add_argument('--sync-floor-kib', type=int, default=DEFAULT_SYNC_FLOOR_KIB,
+                        help="Copy rate while uploads are running (KiB/s)")
+    parser.add_argument('--sync-jobs', type=int, default=DEFAULT_SYNC_JOBS, help="Number of sync loops")
+    parser.add_argument('--once', action='store_true', help="Apply pending changes (and reconcile with --reconcile-hours) and exit")
+    args = parser.parse_args()
+
+    mirror = Mirror(ChangeFeed(args.feed, args.source_root), args.source_root, args.dest_root,
+                    args.cursor, args.reconcile_hours * 3600,
+                    BandwidthArbiter(args.capacity_kib, args.sync_floor_kib, args.sync_jobs))
+    if args.once:
+        if args.reconcile_hours:
+            print(f"Reconcile copied {mirror.reconcile()} files")
+        print(f"Applied {mirror.follow()} changes")
+    else:
+        mirror.run(args.poll_interval)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# checkpoint.py - Per-job stage checkpoints so retries resume at the failed stage
+
+import os
+import json
+import hashlib
+import argparse
+from datetime import datetime
+
+DEFAULT_CHECKPOINT_DIR = os.path.expanduser('~/AutoPublishDATA/checkpoints')
+
+# Pipeline stages in the order they run
+# ("submit" records a processing job handed to the server, see processing_jobs.py)
+STAGES = ("preprocess", "augment", "upload", "submit", "process", "publish")
+
+
+def file_signature(path):
+    """Size and mtime of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class JobCheckpoint:
+    """
+    Manifest of the completed stages of one video's trip through the pipeline.
+
+    Each stage records the artifacts it produced (path plus size and mtime)
+    and its results, e.g. the uploaded `file_path`/`video_id` or the platforms
+    already published. A stage only counts as done while its artifacts are
+    still on disk unchanged, and the whole manifest is discarded when the
+    source video itself changes.
+    """
+
+    def __init__(self, source_path, checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+        self.source_path = os.path.realpath(source_path)
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        key = hashlib.sha1(self.source_path.encode('utf-8')).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(self.source_path))[0]
+        self.manifest_path = os.path.join(self.checkpoint_dir, f"{stem}.{key}.json")
+        self.data = self._load()
+
+    def _empty(self):
+        return {
+            "source": self.source_path,
+            "source_signature": file_signature(self.source_path),
+            "stages": {},
+        }
+
+    def _load(self):
+        try:
+            with open(self.manifest_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self._empty()
+
+        if data.get("source_signature") != file_signature(self.source_path):
+            print(f"Source changed since the last attempt; discarding checkpoint {self.manifest_path}")
+            return self._empty()
+        return data
+
+    def _save(self):
+        temp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def get(self, stage):
+        """
+        Return the results of a completed stage, or None if it must run again.
+
+        A stage whose recorded artifacts are missing or modified is dropped
+        together with every later stage.
+        """
+        record = self.data["stages"].get(stage)
+        if record is None:
+            return None
+
+        for name, artifact in record.get("artifacts", {}).items():
+            if file_signature(artifact["path"]) != artifact["signature"]:
+                print(f"Checkpoint artifact '{name}' of stage '{stage}' changed or is missing; redoing from '{stage}'")
+                self.invalidate_from(stage)
+                return None
+
+        results = dict(record.get("results", {}))
+        results.update({name: artifact["path"] for name, artifact in record.get("artifacts", {}).items()})
+        return results
+
+    def complete(self, stage, artifacts=None, **results):
+        """
+        Record a completed stage.
+
+        Args:
+            stage (str): One of STAGES.
+            artifacts (dict, optional): Name to path of files the stage produced.
+            **results: JSON-serialisable results of the stage.
+        """
+        self.data["stages"][stage] = {
+            "completed_at": str(datetime.now()),
+            "artifacts": {
+                name: {"path": path, "signature": file_signature(path)}
+                for name, path in (artifacts or {}).items()
+            },
+            "results": results,
+        }
+        self._save()
+
+    def invalidate_from(self, stage):
+        """Forget a stage and every stage after it."""
+        for later in STAGES[STAGES.index(stage):]:
+            self.data["stages"].pop(later, None)
+        self._save()
+
+    def published_platforms(self):
+        """Platforms that were already published successfully."""
+        record = self.data["stages"].get("publish", {})
+        return set(record.get("results", {}).get("platforms", []))
+
+    def record_published(self, platforms):
+        """Add platforms to the publish stage's results."""
+        done = sorted(self.published_platforms() | set(platforms))
+        self.complete("publish", platforms=done)
+
+    def clear(self):
+        """Remove the manifest once the job has finished."""
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        self.data = self._empty()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or clear the checkpoint of a video")
+    parser.add_argument('path', help="Source video path")
+    parser.add_argument('--checkpoint-dir', default=DEFAULT_CHECKPOINT_DIR, help="Checkpoint directory")
+    parser.add_argument('--clear', action='store_true', help="Remove the checkpoint")
+    args = parser.parse_args()
+
+    checkpoint = JobCheckpoint(args.path, args.checkpoint_dir)
+    if args.clear:
+        checkpoint.clear()
+        print(f"Cleared checkpoint for {args.path}")
+    else:
+        for stage in STAGES:
+            results = checkpoint.get(stage)
+            print(f"{stage:<11} {'done' if results is not None else 'pending'}"
+                  f"{'  ' + json.dumps(results) if results else ''}")
@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# cluster.py - HTTP job coordinator and workers for processing the queue on several machines
+
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import fcntl
+import shutil
+import signal
+import tempfile
+import argparse
+import threading
+import subprocess
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, quote
+
+import requests
+
+from queue_scheduler import (
+    POLICIES, DEFAULT_POLICY, DEFAULT_AGING_SECONDS, DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_BACKOFF_BASE, DEFAULT_BACKOFF_MAX,
+    load_state, save_state, load_jobs, pick_next, remove_from_queue, fail_job, record_deferral,
+)
+from media_probe import DEFAULT_PROBE_CACHE_DIR, DEFAULT_SPECULATIVE_DIR
+from workspace import EXIT_DEFERRED
+from processing_jobs import EXIT_HANDED_OFF
+from ledger import Ledger, DEFAULT_ROTATE_ENTRIES, DEFAULT_MAX_SEGMENTS
+
+DEFAULT_PORT = 8765
+DEFAULT_LEASE_SECONDS = 120.0
+DEFAULT_DEFER_SECONDS = 300.0
+# A job handed off to the processing server is looked at again this much later
+DEFAULT_HANDOFF_SECONDS = 3600.0
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'autopub_worker_spool')
+AUTOPUB_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autopub.py')
+DEFAULT_AUTOPUB_ARGS = "--use-cache --use-metadata-cache --use-translation-cache"
+
+# Stand-in for autopub.py in the demo: read the input, then work for argv[2] seconds
+SIMULATED_JOB = (
+    "import sys, time\n"
+    "with open(sys.argv[1], 'rb') as f:\n"
+    "    while f.read(1 << 20): pass\n"
+    "time.sleep(float(sys.argv[2]))\n"
+)
+
+
+class Coordinator:
+    """
+    Hands out jobs from queue_list.txt to workers under time-limited leases.
+
+    The queue, its scheduler state and the failed list stay exactly as
+    process_queue.sh keeps them, under the same QUEUE_LOCK, so the monitor and
+    queue_file_utility.sh keep appending to the queue as before. A claim picks
+    the next job by the scheduling policy among the jobs not leased out. A
+    worker extends its lease with heartbeats; a lease that runs out (the
+    worker crashed, hung or lost its network) counts as a failed attempt and
+    the job becomes eligible again after the usual backoff. Results from a
+    lease that has already expired are refused, so each attempt is
+    accounted once.
+    """
+
+    def __init__(self, queue_path, state_path, lock_path, policy=DEFAULT_POLICY,
+                 aging_seconds=DEFAULT_AGING_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                 defer_seconds=DEFAULT_DEFER_SECONDS, failed_list=None, processed_path=None,
+                 probe_cache_dir=DEFAULT_PROBE_CACHE_DIR, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 ledger_rotate_entries=DEFAULT_ROTATE_ENTRIES, ledger_max_segments=DEFAULT_MAX_SEGMENTS,
+                 speculative_dir=DEFAULT_SPECULATIVE_DIR, handoff_seconds=DEFAULT_HANDOFF_SECONDS):
+        self.queue_path = queue_path
+        self.state_path = state_path
+        self.lock_path = lock_path
+        self.policy = policy
+        self.aging_seconds = aging_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.defer_seconds = defer_seconds
+        self.handoff_seconds = handoff_seconds
+        self.failed_list = failed_list
+        self.processed_path = processed_path
+        self.ledger = Ledger(processed_path, ledger_rotate_entries, ledger_max_segments) if processed_path else None
+        self.probe_cache_dir = probe_cache_dir
+        self.speculative_dir = speculative_dir
+        self.lease_seconds = lease_seconds
+        self.leases = {}
+        self.stats = {"claimed": 0, "done": 0, "failed": 0, "deferred": 0, "handed_off": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked_queue(self):
+        """Queue state under QUEUE_LOCK; saved on the way out."""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = load_state(self.state_path)
+                jobs = load_jobs(self.queue_path, state, probe_cache_dir=self.probe_cache_dir,
+                                 speculative_dir=self.speculative_dir)
+                yield state, jobs
+                save_state(self.state_path, state)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def claim(self, worker):
+        """
+        Lease the next eligible job to a worker.
+
+        Returns:
+            dict or None: The lease, or None if no job is eligible.
+        """
+        with self._lock:
+            self._expire_leases()
+            leased = {lease["path"] for lease in self.leases.values()}
+            with self._locked_queue() as (state, jobs):
+                job = pick_next([job for job in jobs if job.path not in leased], self.policy,
+                                aging_seconds=self.aging_seconds)
+            if job is None:
+                return None
+            lease = {
+                "lease_id": uuid.uuid4().hex,
+                "path": job.path,
+                "worker": worker,
+                "attempt": job.attempts + 1,
+                "lease_seconds": self.lease_seconds,
+                "expires_at": time.time() + self.lease_seconds,
+                "size": os.path.getsize(job.path) if os.path.exists(job.path) else None,
+            }
+            self.leases[lease["lease_id"]] = lease
+            self.stats["claimed"] += 1
+            print(f"Leased {job.path} to {worker} (attempt {lease['attempt']})")
+            return lease
+
+    def heartbeat(self, lease_id):
+        """Extend a lease; False if it has expired or is unknown."""
+        with self._lock:
+            self._expire_leases()
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return False
+            lease["expires_at"] = time.time() + self.lease_seconds
+            return True
+
+    def complete(self, lease_id, status, error=""):
+        """
+        Record the outcome of a leased job: "done", "failed", "deferred" or
+        "handed_off" (processing continues on the server; the job is looked at
+        again after handoff_seconds, as process_queue.sh does).
+
+        Returns:
+            bool: False if the lease had already expired; the result is then ignored.
+        """
+        with self._lock:
+            self._expire_leases()
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            path = lease["path"]
+            with self._locked_queue() as (state, _):
+                if status == "done":
+                    remove_from_queue(self.queue_path, path)
+                    state.pop(path, None)
+                    self._record_processed(path)
+                elif status == "deferred":
+                    record_deferral(state, path, self.defer_seconds)
+                elif status == "handed_off":
+                    record_deferral(state, path, self.handoff_seconds)
+                else:
+                    status = "failed"
+                    self._fail(state, path, f"{lease['worker']}: {error}")
+            self.stats[status] += 1
+            print(f"{status.capitalize()}: {path} on {lease['worker']}{f' ({error})' if error else ''}")
+            return True
+
+    def lease_path(self, lease_id):
+        with self._lock:
+            lease = self.leases.get(lease_id)
+            return lease["path"] if lease else None
+
+    def status(self):
+        with self._lock:
+            self._expire_leases()
+            with self._locked_queue() as (_, jobs):
+                queued = len(jobs)
+            now = time.time()
+            return {
+                "queued": queued,
+                "leases": [
+                    {"path": l["path"], "worker": l["worker"], "attempt": l["attempt"],
+                     "expires_in": round(l["expires_at"] - now, 1)}
+                    for l in self.leases.values()
+                ],
+                "stats": dict(self.stats),
+            }
+
+    def expire_leases(self):
+        with self._lock:
+            self._expire_leases()
+
+    def _expire_leases(self):
+        now = time.time()
+        expired = [lease for lease in self.leases.values() if lease["expires_at"] <= now]
+        if not expired:
+            return
+        with self._locked_queue() as (state, _):
+            for lease in expired:
+                del self.leases[lease["lease_id"]]
+                self.stats["expired"] += 1
+                print(f"Lease expired: {lease['path']} on {lease['worker']}")
+                self._fail(state, lease["path"], f"{lease['worker']}: lease expired")
+
+    def _fail(self, state, path, error):
+        fail_job(
+            self.queue_path, state, path, max_attempts=self.max_attempts,
+            backoff_base=self.backoff_base, backoff_max=self.backoff_max,
+            error=error, failed_list=self.failed_list,
+        )
+
+    def _record_processed(self, path):
+        """Add the file to the processed ledger, as autopub.py does for local runs."""
+        if self.ledger is not None:
+            self.ledger.add(os.path.basename(path))
+
+
+def serve(coordinator, host=DEFAULT_HOST, port=DEFAULT_PORT, token=None):
+    """
+    Run the coordinator's HTTP API.
+
+    With a token, every request must carry `Authorization: Bearer <token>`
+    (the input files are served to whoever asks otherwise); without one the
+    API should only listen on the loopback interface.
+
+    POST /claim {"worker"}                     -> lease JSON, or 204 when idle
+    POST /heartbeat {"lease_id"}               -> 200, or 409 when the lease is gone
+    POST /complete {"lease_id", "status", "error"} -> 200, or 409 when the lease is gone
+    GET  /input/<lease_id>                     -> the leased file
+    GET  /status                               -> queue length, leases and counters
+
+    Returns:
+        ThreadingHTTPServer: The running server (serve_forever runs in a thread).
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, code, payload=None):
+            body = json.dumps(payload).encode() if payload is not None else b''
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self):
+            if token is None:
+                return True
+            if hmac.compare_digest(self.headers.get('Authorization', ''), f"Bearer {token}"):
+                return True
+            self._send_json(401, {"error": "missing or wrong token"})
+            return False
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            except ValueError:
+                self._send_json(400, {"error": "invalid JSON"})
+                return
+            route = urlparse(self.path).path
+            if route == '/claim':
+                lease = coordinator.claim(request.get('worker') or self.client_address[0])
+                if lease is None:
+                    self._send_json(204)
+                else:
+                    self._send_json(200, {**lease, "input_url": f"/input/{lease['lease_id']}"})
+            elif route == '/heartbeat':
+                ok = coordinator.heartbeat(request.get('lease_id'))
+                self._send_json(200 if ok else 409, {"ok": ok})
+            elif route == '/complete':
+                ok = coordinator.complete(request.get('lease_id'), request.get('status'), request.get('error', ''))
+                self._send_json(200 if ok else 409, {"ok": ok})
+            else:
+                self._send_json(404, {"error": "unknown endpoint"})
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            route = urlparse(self.path).path
+            if route == '/status':
+                self._send_json(200, coordinator.status())
+                return
+            if route.startswith('/input/'):
+                path = coordinator.lease_path(route[len('/input/'):])
+                if path is None or not os.path.isfile(path):
+                    self._send_json(404, {"error": "no such lease or file"})
+                    return
+                with open(path, 'rb') as f:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                    self.end_headers()
+                    shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+                return
+            self._send_json(404, {"error": "unknown endpoint"})
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, name="coordinator-http", daemon=True).start()
+
+    def reaper():
+        while True:
+            time.sleep(max(1.0, coordinator.lease_seconds / 10))
+            coordinator.expire_leases()
+
+    threading.Thread(target=reaper, name="lease-reaper", daemon=True).start()
+    return httpd
+
+
+class Worker:
+    """
+    Claims jobs from the coordinator and runs the regular pipeline on them.
+
+    Each job runs `autopub.py --path` in a child process, exactly as
+    process_queue.sh runs it on a single machine: exit code 0 is done,
+    EXIT_DEFERRED is deferred, EXIT_HANDED_OFF handed off, anything else
+    failed. A heartbeat thread keeps the lease alive; if the coordinator says
+    the lease is gone, the child's whole process group (autopub.py and its
+    encoders) is stopped, since the job may already be running elsewhere. The input is
+    used in place when the path (after --path-map) exists on this machine,
+    e.g. on a shared mount, and downloaded from the coordinator otherwise.
+    """
+
+    def __init__(self, coordinator_url, name=None, spool_dir=DEFAULT_SPOOL_DIR, path_maps=None,
+                 autopub_args=DEFAULT_AUTOPUB_ARGS, simulate_seconds=None, always_download=False, token=None):
+        self.url = coordinator_url.rstrip('/')
+        self.name = name or f"{os.uname().nodename}:{os.getpid()}"
+        self.spool_dir = spool_dir
+        self.path_maps = path_maps or []
+        self.autopub_args = autopub_args.split()
+        self.simulate_seconds = simulate_seconds
+        self.always_download = always_download
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def _post(self, route, payload):
+        return self.session.post(f"{self.url}{route}", json=payload, timeout=30)
+
+    def local_path(self, path):
+        """Map a coordinator path onto this machine; None if it is not reachable here."""
+        if self.always_download:
+            return None
+        for remote, local in self.path_maps:
+            if path.startswith(remote):
+                path = local + path[len(remote):]
+                break
+        return path if os.path.isfile(path) else None
+
+    def fetch_input(self, lease):
+        """
+        Download the leased file into the spool directory; returns its path.
+
+        The file keeps its original basename, which autopub.py derives the
+        ledger entry, the upload name and the arrival time from, inside a
+        directory of its own per lease.
+        """
+        job_dir = os.path.join(self.spool_dir, lease['lease_id'])
+        os.makedirs(job_dir, exist_ok=True)
+        target = os.path.join(job_dir, os.path.basename(lease['path']))
+        partial = f"{target}.part"
+        try:
+            with self.session.get(f"{self.url}/input/{quote(lease['lease_id'])}", stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(partial, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            if lease.get("size") is not None and os.path.getsize(partial) != lease["size"]:
+                raise IOError(f"incomplete download of {lease['path']}")
+        except BaseException:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        os.replace(partial, target)
+        return target
+
+    def command(self, input_path):
+        if self.simulate_seconds is not None:
+            return [sys.executable, '-c', SIMULATED_JOB, input_path, str(self.simulate_seconds)]
+        return [sys.executable, AUTOPUB_PY, *self.autopub_args, '--path', input_path]
+
+    def run_job(self, lease):
+        """Run one leased job and report its outcome."""
+        downloaded = None
+        lost = threading.Event()
+        done = threading.Event()
+        process = None
+
+        def heartbeat():
+            interval = max(1.0, lease["lease_seconds"] / 4)
+            while not done.wait(interval):
+                try:
+                    if self._post('/heartbeat', {"lease_id": lease["lease_id"]}).status_code == 409:
+                        lost.set()
+                except requests.RequestException as e:
+                    print(f"Heartbeat failed: {e}")
+                if lost.is_set():
+                    print(f"Lease lost for {lease['path']}; stopping the job.")
+                    if process is not None and process.poll() is None:
+                        try:
+                            os.killpg(process.pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+                    return
+
+        beat = threading.Thread(target=heartbeat, name="lease-heartbeat", daemon=True)
+        beat.start()
+        status, error = "failed", ""
+        try:
+            input_path = self.local_path(lease["path"])
+            if input_path is None:
+                input_path = downloaded = self.fetch_input(lease)
+            print(f"[{self.name}] Processing {input_path} (attempt {lease['attempt']})")
+            # A session of its own, so a lost lease stops the encoders too
+            process = subprocess.Popen(self.command(input_path), start_new_session=True)
+            returncode = process.wait()
+            if returncode == 0:
+                status = "done"
+            elif returncode == EXIT_DEFERRED:
+                status = "deferred"
+            elif returncode == EXIT_HANDED_OFF:
+                status = "handed_off"
+            else:
+                error = f"exit code {returncode}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            done.set()
+            beat.join()
+            if downloaded:
+                shutil.rmtree(os.path.dirname(downloaded), ignore_errors=True)
+
+        if lost.is_set():
+            return status
+        try:
+            self._post('/complete', {"lease_id": lease["lease_id"], "status": status, "error": error})
+        except requests.RequestException as e:
+            # The lease expires and the coordinator retries the job
+            print(f"Could not report {lease['path']}: {e}")
+        return status
+
+    def run(self, idle_sleep=10.0, exit_when_idle=False):
+        """Claim and run jobs until interrupted (or the queue is empty, with exit_when_idle)."""
+        print(f"Worker {self.name} polling {self.url}")
+        while True:
+            try:
+                response = self._post('/claim', {"worker": self.name})
+            except requests.RequestException as e:
+                print(f"Coordinator unreachable ({e}); retrying in {idle_sleep:.0f}s")
+                time.sleep(idle_sleep)
+                continue
+            if response.status_code == 204:
+                if exit_when_idle:
+                    return
+                time.sleep(idle_sleep)
+                continue
+            response.raise_for_status()
+            self.run_job(response.json())
+
+
+def run_demo(workers=3, jobs=12, job_seconds=1.0, file_mib=4, lease_seconds=3.0, kill_one=True):
+    """
+    Coordinator and several worker processes on this machine.
+
+    Creates a queue of dummy files, starts the coordinator on a free port and
+    `workers` worker processes that download their input over HTTP and run a
+    simulated job. With kill_one, one worker is SIGKILLed in the middle of a
+    job; its lease expires and the job is retried by another worker. At the
+    end every file must have been completed exactly once.
+    """
+    work_dir = tempfile.mkdtemp(prefix="cluster_demo_")
+    media_dir = os.path.join(work_dir, 'media')
+    os.makedirs(media_dir)
+    queue_path = os.path.join(work_dir, 'queue_list.txt')
+    processed_path = os.path.join(work_dir, 'processed.csv')
+    with open(queue_path, 'w') as queue:
+        for index in range(jobs):
+            path = os.path.join(media_dir, f"IMG_{index:04d}.MOV")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(file_mib * 1024 * 1024))
+            queue.write(f"{path}\n")
+
+    coordinator = Coordinator(
+        queue_path, os.path.join(work_dir, 'queue_state.json'), os.path.join(work_dir, 'queue.lock'),
+        policy="fifo", backoff_base=0.5, processed_path=processed_path,
+        failed_list=os.path.join(work_dir, 'failed_list.txt'),
+        probe_cache_dir=os.path.join(work_dir, 'probe_cache'), lease_seconds=lease_seconds,
+    )
+    httpd = serve(coordinator, '127.0.0.1', 0)
+    url = f"http://127.0.0.1:{httpd.server_port}"
+    print(f"Coordinator at {url}; {jobs} jobs of {job_seconds:.1f}s, {workers} workers")
+
+    start_time = time.time()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'worker', '--coordinator', url,
+             '--name', f"worker-{index}", '--spool-dir', os.path.join(work_dir, f'spool{index}'),
+             '--simulate', str(job_seconds), '--always-download', '--exit-when-idle', '--idle-sleep', '0.5'],
+            stdout=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        for index in range(workers)
+    ]
+    if kill_one:
+        while not any(lease["worker"] == "worker-0" for lease in coordinator.status()["leases"]):
+            time.sleep(0.05)
+        time.sleep(job_seconds / 2)
+        os.killpg(processes[0].pid, signal.SIGKILL)
+        print("Killed worker-0 in the middle of a job")
+
+    # Workers exit when the queue is empty; one whose job is in backoff may
+    # leave early, so keep one worker polling until the queue drains
+    while coordinator.status()["queued"]:
+        if all(process.poll() is not None for process in processes):
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'worker', '--coordinator', url,
+                 '--name', "worker-late", '--spool-dir', os.path.join(work_dir, 'spool-late'),
+                 '--simulate', str(job_seconds), '--always-download', '--exit-when-idle', '--idle-sleep', '0.5'],
+                stdout=subprocess.DEVNULL,
+            ))
+        time.sleep(0.2)
+    for process in processes:
+        process.wait()
+    elapsed = time.time() - start_time
+    httpd.shutdown()
+
+    with open(processed_path) as f:
+        completed = [line.strip() for line in f if line.strip()]
+    stats = coordinator.stats
+    print(f"Drained in {elapsed:.1f}s (serial: {jobs * job_seconds:.1f}s of work); {stats}")
+    print(f"Processed ledger: {len(completed)} entries, {len(set(completed))} distinct of {jobs} jobs")
+    if sorted(set(completed)) != sorted(f"IMG_{index:04d}.MOV" for index in range(jobs)) or len(completed) != jobs:
+        raise SystemExit("Demo failed: the ledger does not list every job exactly once")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return stats
+
+
+def _path_map(value):
+    remote, sep, local = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected REMOTE_PREFIX=LOCAL_PREFIX")
+    return remote, local
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process the queue on several machines")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    coordinator_parser = subparsers.add_parser('coordinator', help="Serve the queue to workers")
+    coordinator_parser.add_argument('--queue', required=True, help="Path to queue_list.txt")
+    coordinator_parser.add_argument('--state', required=True, help="Path to the scheduler state file")
+    coordinator_parser.add_argument('--lock', required=True, help="QUEUE_LOCK file")
+    coordinator_parser.add_argument('--policy', default=DEFAULT_POLICY, choices=POLICIES, help="Scheduling policy")
+    coordinator_parser.add_argument('--probe-cache-dir', default=DEFAULT_PROBE_CACHE_DIR, help="Probe cache directory")
+    coordinator_parser.add_argument('--speculative-dir', default=DEFAULT_SPECULATIVE_DIR,
+                                    help="Results checked while files were still syncing")
+    coordinator_parser.add_argument('--aging-seconds', type=float, default=DEFAULT_AGING_SECONDS)
+    coordinator_parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    coordinator_parser.add_argument('--backoff-base', type=float, default=DEFAULT_BACKOFF_BASE)
+    coordinator_parser.add_argument('--backoff-max', type=float, default=DEFAULT_BACKOFF_MAX)
+    coordinator_parser.add_argument('--defer-seconds', type=float, default=DEFAULT_DEFER_SECONDS)
+    coordinator_parser.add_argument('--handoff-seconds', type=float, default=DEFAULT_HANDOFF_SECONDS,
+                                    help="Delay before a job handed off to the processing server is looked at again")
+    coordinator_parser.add_argument('--failed-list', help="File that receives paths dropped after max attempts")
+    coordinator_parser.add_argument('--processed', help="processed.csv ledger to record finished files in")
+    coordinator_parser.add_argument('--ledger-rotate-entries', type=int, default=DEFAULT_ROTATE_ENTRIES,
+                                    help="Seal the active ledger segment at this many entries")
+    coordinator_parser.add_argument('--ledger-max-segments', type=int, default=DEFAULT_MAX_SEGMENTS,
+                                    help="Merge the oldest sealed ledger segments beyond this many")
+    coordinator_parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                                    help="Lease length; workers heartbeat every quarter of it")
+    coordinator_parser.add_argument('--host', default=DEFAULT_HOST,
+                                    help="Listen address (anything but loopback requires --token)")
+    coordinator_parser.add_argument('--token', default=os.environ.get('CLUSTER_TOKEN') or None,
+                                    help="Shared secret workers must send (default $CLUSTER_TOKEN)")
+    coordinator_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Listen port")
+
+    worker_parser = subparsers.add_parser('worker', help="Claim and process jobs")
+    worker_parser.add_argument('--coordinator', default=f"http://localhost:{DEFAULT_PORT}", help="Coordinator URL")
+    worker_parser.add_argument('--name', help="Worker name (default: host:pid)")
+    worker_parser.add_argument('--token', default=os.environ.get('CLUSTER_TOKEN') or None,
+                               help="Coordinator's shared secret (default $CLUSTER_TOKEN)")
+    worker_parser.add_argument('--spool-dir', default=DEFAULT_SPOOL_DIR, help="Where downloaded inputs are kept")
+    worker_parser.add_argument('--path-map', type=_path_map, action='append', default=[],
+                               help="REMOTE_PREFIX=LOCAL_PREFIX for inputs on a shared mount (repeatable)")
+    worker_parser.add_argument('--always-download', action='store_true', help="Fetch inputs over HTTP even if reachable")
+    worker_parser.add_argument('--autopub-args', default=DEFAULT_AUTOPUB_ARGS, help="Arguments for autopub.py")
+    worker_parser.add_argument('--simulate', type=float, help="Run a simulated job of this many seconds instead")
+    worker_parser.add_argument('--idle-sleep', type=float, default=10.0, help="Seconds between claims when idle")
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help="Exit when no job is eligible")
+
+    status_parser = subparsers.add_parser('status', help="Show the coordinator's queue and leases")
+    status_parser.add_argument('--coordinator', default=f"http://localhost:{DEFAULT_PORT}", help="Coordinator URL")
+    status_parser.add_argument('--token', default=os.environ.get('CLUSTER_TOKEN') or None,
+                               help="Coordinator's shared secret (default $CLUSTER_TOKEN)")
+
+    demo_parser = subparsers.add_parser('demo', help="Coordinator and worker processes on this machine")
+    demo_parser.add_argument('--workers', type=int, default=3, help="Worker processes")
+    demo_parser.add_argument('--jobs', type=int, default=12, help="Queued dummy files")
+    demo_parser.add_argument('--job-seconds', type=float, default=1.0, help="Simulated job length")
+    demo_parser.add_argument('--no-kill', action='store_true', help="Do not kill a worker mid-job")
+
+    args = parser.parse_args()
+    if args.command == 'coordinator' and not args.token and args.host not in ('127.0.0.1', 'localhost', '::1'):
+        parser.error("--token (or CLUSTER_TOKEN) is required when listening beyond the loopback interface")
+    if args.command == 'coordinator':
+        coordinator = Coordinator(
+            args.queue, args.state, args.lock, policy=args.policy, aging_seconds=args.aging_seconds,
+            max_attempts=args.max_attempts, backoff_base=args.backoff_base, backoff_max=args.backoff_max,
+            defer_seconds=args.defer_seconds, failed_list=args.failed_list, processed_path=args.processed,
+            probe_cache_dir=args.probe_cache_dir, lease_seconds=args.lease_seconds,
+            ledger_rotate_entries=args.ledger_rotate_entries, ledger_max_segments=args.ledger_max_segments,
+            speculative_dir=args.speculative_dir, handoff_seconds=args.handoff_seconds,
+        )
+        httpd = serve(coordinator, args.host, args.port, args.token)
+        print(f"Coordinator listening on {args.host}:{httpd.server_port}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            httpd.shutdown()
+    elif args.command == 'worker':
+        worker = Worker(args.coordinator, args.name, args.spool_dir, args.path_map,
+                        args.autopub_args, args.simulate, args.always_download, args.token)
+        worker.run(args.idle_sleep, args.exit_when_idle)
+    elif args.command == 'status':
+        headers = {'Authorization': f"Bearer {args.token}"} if args.token else {}
+        print(json.dumps(requests.get(f"{args.coordinator.rstrip('/')}/status", headers=headers,
+                                      timeout=30).json(), indent=2))
+    else:
+        run_demo(args.workers, args.jobs, args.job_seconds, kill_one=not args.no_kill)
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# encode_scheduler.py - Global CPU budget, thread pinning and preset choice for encodes
+
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import tempfile
+import argparse
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+FAST_PRESET = 'Fast 1080p30'
+VERY_FAST_PRESET = 'Very Fast 1080p30'
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), 'autopub_encode_budget')
+
+
+@dataclass
+class EncodeSlot:
+    """CPUs reserved for one encode and the settings derived from them."""
+    cpus: list
+    preset: str
+    niceness: int = 10
+    suspend_check: Optional[Callable[[], bool]] = None
+    threads: int = field(init=False)
+
+    def __post_init__(self):
+        self.threads = max(1, len(self.cpus))
+
+    def split(self):
+        """One single-CPU slot per reserved CPU, for segment-parallel encodes."""
+        return [EncodeSlot(cpus=[cpu], preset=self.preset, niceness=self.niceness,
+                           suspend_check=self.suspend_check) for cpu in self.cpus]
+
+    def x264_options(self):
+        """Extra x264 options that match the reserved CPU count."""
+        return f"threads={self.threads}"
+
+    def preexec(self):
+        """
+        Return a preexec_fn that pins the child to the reserved CPUs and drops
+        its priority below the watcher, rsync loops and uploads.
+        """
+        cpus, niceness = set(self.cpus), self.niceness
+
+        def _apply():
+            try:
+                os.nice(niceness)
+            except OSError:
+                pass
+            try:
+                os.sched_setaffinity(0, cpus)
+            except (AttributeError, OSError):
+                pass
+            try:
+                os.sched_setscheduler(0, os.SCHED_BATCH, os.sched_param(0))
+            except (AttributeError, OSError):
+                pass
+
+        return _apply
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # An exited process its parent has not reaped yet holds no CPUs
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+class EncodeScheduler:
+    """
+    Hands out CPUs to encodes from a machine-wide budget.
+
+    Claims are kept in a small JSON file guarded by flock, so separate
+    autopub.py processes (batch workers, manual runs) share one budget.
+    Claims of processes that died are reclaimed automatically.
+
+    An encode with a higher priority than a running one does not wait for
+    it: it marks the running claim as suspended and takes its CPUs. The
+    suspended process pauses its encoder (see `suspended` and
+    run_media_command's suspend_check) until every process that preempted it
+    has released its CPUs.
+    """
+
+    def __init__(
+        self,
+        cpu_budget=None,
+        reserved_cpus=1,
+        threads_per_job=None,
+        niceness=10,
+        queue_path=None,
+        backlog_threshold=5,
+        long_clip_seconds=300,
+        segment_min_seconds=120,
+        state_dir=DEFAULT_STATE_DIR,
+        poll_interval=2.0,
+        priority=0,
+    ):
+        """
+        Args:
+            cpu_budget (int, optional): CPUs encodes may use in total. Defaults to
+                all CPUs minus reserved_cpus.
+            reserved_cpus (int): CPUs left free for I/O stages (watcher, rsync, upload).
+            threads_per_job (int, optional): CPUs per encode. Defaults to half the
+                budget when the budget allows two encodes, otherwise the whole budget.
+            niceness (int): Nice increment for encoder processes.
+            queue_path (str, optional): queue_list.txt, used to measure backlog depth.
+            backlog_threshold (int): Backlog depth at which encodes switch to the faster preset.
+            long_clip_seconds (float): Clip duration at which encodes switch to the faster preset.
+            segment_min_seconds (float): Clip duration from which an encode is split into
+                segments encoded in parallel; 0 disables segment-parallel encoding.
+            state_dir (str): Directory for the shared claim file.
+            poll_interval (float): Seconds between attempts while waiting for CPUs.
+            priority (int): Priority of this process's encodes (the job's queue
+                priority); a higher one preempts running encodes.
+        """
+        try:
+            available = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            available = list(range(os.cpu_count() or 1))
+
+        reserved_cpus = min(reserved_cpus, len(available) - 1)
+        pool = available[reserved_cpus:]
+        if cpu_budget:
+            pool = pool[:cpu_budget]
+        self.cpus = pool
+
+        if threads_per_job:
+            self.threads_per_job = min(threads_per_job, len(pool))
+        else:
+            self.threads_per_job = len(pool) // 2 if len(pool) >= 4 else len(pool)
+
+        self.niceness = niceness
+        self.queue_path = queue_path
+        self.backlog_threshold = backlog_threshold
+        self.long_clip_seconds = long_clip_seconds
+        self.segment_min_seconds = segment_min_seconds
+        self.state_dir = state_dir
+        self.poll_interval = poll_interval
+        self.priority = priority
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.claims_path = os.path.join(self.state_dir, 'claims.json')
+        self.lock_path = os.path.join(self.state_dir, 'claims.lock')
+
+    def backlog_depth(self):
+        """Number of files waiting in the queue (0 if the queue is unknown)."""
+        if not self.queue_path or not os.path.exists(self.queue_path):
+            return 0
+        with open(self.queue_path) as f:
+            return sum(1 for line in f if line.strip())
+
+    def choose_preset(self, duration=None, backlog_depth=None):
+        """
+        Pick the HandBrake preset for an encode.
+
+        The slower, smaller `Fast` preset is used when the machine has time for
+        it; a deep backlog or a long clip switches to `Very Fast`.
+        """
+        if backlog_depth is None:
+            backlog_depth = self.backlog_depth()
+        if backlog_depth >= self.backlog_threshold:
+            return VERY_FAST_PRESET
+        if duration is not None and duration >= self.long_clip_seconds:
+            return VERY_FAST_PRESET
+        return FAST_PRESET
+
+    def use_segments(self, duration, slot):
+        """Whether an encode should be split into segments across the slot's CPUs."""
+        return (
+            bool(self.segment_min_seconds)
+            and duration is not None
+            and duration >= self.segment_min_seconds
+            and slot.threads >= 2
+        )
+
+    def _read_claims(self):
+        """Claims by pid: {"cpus", "priority", "suspended_by"} (a bare CPU list is an older claim)."""
+        try:
+            with open(self.claims_path) as f:
+                raw = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        claims = {}
+        for pid, claim in raw.items():
+            if isinstance(claim, list):
+                claim = {"cpus": claim}
+            claims[int(pid)] = {
+                "cpus": claim.get("cpus", []),
+                "priority": claim.get("priority", 0),
+                "suspended_by": claim.get("suspended_by", []),
+            }
+        return claims
+
+    def suspended(self):
+        """
+        Whether this process's encodes are preempted right now.
+
+        Read without the lock (the claim file is replaced atomically); a
+        preempting process that died does not keep the encode paused.
+        """
+        claim = self._read_claims().get(os.getpid())
+        return bool(claim) and any(_pid_alive(pid) for pid in claim["suspended_by"])
+
+    @contextmanager
+    def _locked_claims(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                claims = {pid: claim for pid, claim in self._read_claims().items() if _pid_alive(pid)}
+                for claim in claims.values():
+                    claim["suspended_by"] = [pid for pid in claim["suspended_by"] if pid in claims]
+                yield claims
+                temp_path = f"{self.claims_path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w') as f:
+                    json.dump({str(pid): claim for pid, claim in claims.items()}, f)
+                os.replace(temp_path, self.claims_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _try_claim(self, wanted, minimum, priority=0):
+        """
+        Claim free CPUs, preempting lower-priority encodes if there are too few.
+
+        Returns:
+            tuple or None: (CPUs taken, pids preempted), or None if the caller must wait.
+        """
+        me = os.getpid()
+        with self._locked_claims() as claims:
+            busy = {cpu for claim in claims.values() for cpu in claim["cpus"]}
+            free = [cpu for cpu in self.cpus if cpu not in busy]
+            victims = []
+            if len(free) < minimum:
+                # Lowest priority first, and only as many as needed
+                running = sorted(
+                    (claim["priority"], pid) for pid, claim in claims.items()
+                    if pid != me and not claim["suspended_by"] and claim["priority"] < priority
+                )
+                for _, pid in running:
+                    if len(free) >= minimum:
+                        break
+                    victims.append(pid)
+                    free += [cpu for cpu in claims[pid]["cpus"] if cpu in self.cpus and cpu not in free]
+                if len(free) < minimum:
+                    return None
+                for pid in victims:
+                    claims[pid]["suspended_by"].append(me)
+            taken = free[:wanted]
+            claim = claims.setdefault(me, {"cpus": [], "priority": priority, "suspended_by": []})
+            claim["cpus"].extend(taken)
+            claim["priority"] = max(claim["priority"], priority)
+            return taken, victims
+
+    def _release(self, cpus):
+        me = os.getpid()
+        with self._locked_claims() as claims:
+            claim = claims.get(me)
+            remaining = [cpu for cpu in claim["cpus"] if cpu not in cpus] if claim else []
+            if remaining:
+                claim["cpus"] = remaining
+                return
+            claims.pop(me, None)
+            # The encodes this process preempted may continue
+            for other in claims.values():
+                if me in other["suspended_by"]:
+                    other["suspended_by"].remove(me)
+
+    @contextmanager
+    def reserve(self, duration=None, threads=None, timeout=None, priority=None):
+        """
+        Reserve CPUs for one encode, waiting while the budget is used up.
+
+        Args:
+            duration (float, optional): Clip duration, used for the preset choice.
+            threads (int, optional): CPUs wanted; defaults to threads_per_job.
+            timeout (float, optional): Give up waiting after this many seconds.
+            priority (int, optional): Defaults to the scheduler's priority; encodes
+                of lower priority are suspended rather than waited for.
+
+        Yields:
+            EncodeSlot: The reserved CPUs with the preset and niceness to use.
+        """
+        priority = self.priority if priority is None else priority
+        wanted = min(threads or self.threads_per_job, len(self.cpus))
+        minimum = min(wanted, max(1, self.threads_per_job // 2))
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        claimed = self._try_claim(wanted, minimum, priority)
+        if claimed is None:
+            print(f"   Waiting for CPU budget ({minimum} of {len(self.cpus)} CPUs needed)...")
+        while claimed is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("Timed out waiting for encode CPU budget")
+            time.sleep(self.poll_interval)
+            claimed = self._try_claim(wanted, minimum, priority)
+        cpus, victims = claimed
+        if victims:
+            print(f"   Preempting lower-priority encodes (pids {victims}) for this priority {priority} encode")
+
+        slot = EncodeSlot(cpus=cpus, preset=self.choose_preset(duration), niceness=self.niceness,
+                          suspend_check=self.suspended)
+        try:
+            yield slot
+        finally:
+            self._release(cpus)
+
+
+def _encode_rate(threads, parallel_fraction=0.9):
+    """Amdahl speedup of one encode running on `threads` CPUs."""
+    return 1.0 / ((1.0 - parallel_fraction) + parallel_fraction / threads)
+
+
+PRESET_COST = {FAST_PRESET: 1.0, VERY_FAST_PRESET: 0.6}
+
+
+def simulate_drain(backlog, cores, policy, backlog_threshold=5, long_clip_seconds=300, dt=1.0):
+    """
+    Simulate draining a backlog of encodes on `cores` CPUs.
+
+    Policies:
+        unmanaged: every encode starts at once with all CPUs; oversubscription
+            costs throughput (context switches, cache thrash).
+        serial: one encode at a time using every CPU.
+        budget: encodes get a fixed share of the CPU budget, Fast preset.
+        budget-adaptive: as budget, with the preset chosen from backlog and duration.
+
+    Returns:
+        float: Simulated seconds until the last encode finishes.
+    """
+    scheduler_threads = cores // 2 if cores >= 4 else cores
+    waiting = list(backlog)
+    running = []
+    now = 0.0
+
+    def start(duration, threads, preset):
+        work = duration * PRESET_COST[preset]
+        running.append({"remaining": work, "threads": threads})
+
+    while waiting or running:
+        if policy == "unmanaged":
+            while waiting:
+                start(waiting.pop(0), cores, FAST_PRESET)
+        else:
+            threads = cores if policy == "serial" else scheduler_threads
+            while waiting and sum(job["threads"] for job in running) + threads <= cores:
+                duration = waiting.pop(0)
+                preset = FAST_PRESET
+                if policy == "budget-adaptive" and (
+                    len(waiting) >= backlog_threshold or duration >= long_clip_seconds
+                ):
+                    preset = VERY_FAST_PRESET
+                start(duration, threads, preset)
+
+        demand = sum(job["threads"] for job in running)
+        share = min(1.0, cores / demand) if demand else 1.0
+        thrash = 0.85 if demand > cores else 1.0
+        for job in running:
+            job["remaining"] -= dt * _encode_rate(job["threads"]) * share * thrash
+        running = [job for job in running if job["remaining"] > 0]
+        now += dt
+    return now
+
+
+def mixed_backlog(count=40, seed=23):
+    """Encode work per clip in CPU-seconds: mostly short clips plus a few long recordings."""
+    rng = random.Random(seed)
+    return [rng.uniform(600, 2400) if rng.random() < 0.15 else rng.uniform(10, 90) for _ in range(count)]
+
+
+def run_benchmark(cores, count, seed):
+    backlog = mixed_backlog(count, seed)
+    print(f"Draining {count} encodes ({sum(backlog) / 3600:.1f} CPU-hours at Fast preset) on {cores} CPUs")
+    print(f"{'policy':<16} {'drain time (min)':>17}")
+    for policy in ("unmanaged", "serial", "budget", "budget-adaptive"):
+        drain = simulate_drain(backlog, cores, policy)
+        print(f"{policy:<16} {drain / 60:>17.1f}")
+
+
+# Stands in for an encoder: burns a fixed amount of CPU time, so it makes no
+# progress while stopped
+_BURN_CPU = "import sys, time\nend = time.process_time() + float(sys.argv[1])\nwhile time.process_time() < end: pass\n"
+
+
+def run_demo_encode(state_dir, priority, work):
+    """One encode of `work` CPU-seconds under a 1-CPU budget; prints its timings as JSON."""
+    from media_runner import run_media_command
+
+    start_time = time.monotonic()
+    scheduler = EncodeScheduler(cpu_budget=1, reserved_cpus=0, threads_per_job=1, niceness=0,
+                                state_dir=state_dir, poll_interval=0.1, priority=priority)
+    with scheduler.reserve() as slot:
+        waited = time.monotonic() - start_time
+        result = run_media_command([sys.executable, '-c', _BURN_CPU, str(work)], check=True,
+                                   preexec_fn=slot.preexec(), suspend_check=slot.suspend_check,
+                                   poll_interval=0.05)
+    print(json.dumps({"waited": waited, "suspended": result.suspended, "latency": time.monotonic() - start_time}))
+
+
+def run_preempt_demo(long_work=8.0, urgent_work=2.0, urgent_delay=1.0, slack_seconds=1.0):
+    """
+    Latency of an urgent encode that arrives while a long one runs, with and
+    without preemption, against the urgent encode on an idle machine.
+
+    Fails (SystemExit) unless the preempting encode finishes within
+    `slack_seconds` of its time alone and the long encode was paused for it.
+    """
+    def start(state_dir, priority, work):
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'demo-encode', '--state-dir', state_dir,
+             '--priority', str(priority), '--work', str(work)],
+            stdout=subprocess.PIPE, text=True,
+        )
+
+    def finish(process):
+        output = process.communicate()[0].strip().splitlines()
+        return json.loads(output[-1])
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="encode_preempt_") as work_dir:
+        rows.append(("urgent alone", finish(start(os.path.join(work_dir, 'alone'), 10, urgent_work)), None))
+        for label, priority in (("behind long, no preemption", 0), ("behind long, preemption", 10)):
+            state_dir = os.path.join(work_dir, str(priority))
+            long_job = start(state_dir, 0, long_work)
+            time.sleep(urgent_delay)
+            urgent = finish(start(state_dir, priority, urgent_work))
+            rows.append((label, urgent, finish(long_job)))
+
+    print(f"Long encode {long_work:.0f} CPU-s, urgent encode {urgent_work:.0f} CPU-s arriving after "
+          f"{urgent_delay:.0f}s, 1-CPU encode budget")
+    print(f"{'scenario':<28}{'urgent latency':>15}{'waited':>9}{'long total':>12}{'long paused':>13}")
+    for label, urgent, long_result in rows:
+        long_total = f"{long_result['latency']:.1f}s" if long_result else "-"
+        long_paused = f"{long_result['suspended']:.1f}s" if long_result else "-"
+        print(f"{label:<28}{urgent['latency']:>14.1f}s{urgent['waited']:>8.1f}s{long_total:>12}{long_paused:>13}")
+
+    # The preempting encode may lose a few scheduler polls to the paused one, no more
+    alone, preempting, long_result = rows[0][1], rows[2][1], rows[2][2]
+    if preempting['latency'] > alone['latency'] + slack_seconds:
+        raise SystemExit(f"Demo failed: the urgent encode took {preempting['latency']:.1f}s with preemption, "
+                         f"more than {slack_seconds:.1f}s over its {alone['latency']:.1f}s alone")
+    if long_result['suspended'] <= 0:
+        raise SystemExit("Demo failed: the long encode was never paused")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode CPU budget status and drain-time benchmark")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    status_parser = subparsers.add_parser('status', help="Show which processes hold encode CPUs")
+    status_parser.add_argument('--state-dir', default=DEFAULT_STATE_DIR, help="Shared claim directory")
+    bench_parser = subparsers.add_parser('benchmark', help="Compare drain time of a mixed backlog per policy")
+    bench_parser.add_argument('--cores', type=int, default=os.cpu_count() or 4, help="CPUs available to encodes")
+    bench_parser.add_argument('--jobs', type=int, default=40, help="Number of encodes in the backlog")
+    bench_parser.add_argument('--seed', type=int, default=23, help="Random seed")
+    demo_parser = subparsers.add_parser('preempt-demo', help="Show an urgent encode preempting a long one")
+    demo_parser.add_argument('--long-work', type=float, default=8.0, help="CPU-seconds of the long encode")
+    demo_parser.add_argument('--urgent-work', type=float, default=2.0, help="CPU-seconds of the urgent encode")
+    demo_parser.add_argument('--urgent-delay', type=float, default=1.0, help="Seconds before the urgent encode arrives")
+    demo_parser.add_argument('--slack', type=float, default=1.0,
+                             help="Seconds the preempting encode may take beyond its time alone")
+    encode_parser = subparsers.add_parser('demo-encode', help=argparse.SUPPRESS)
+    encode_parser.add_argument('--state-dir', required=True)
+    encode_parser.add_argument('--priority', type=int, default=0)
+    encode_parser.add_argument('--work', type=float, required=True)
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        run_benchmark(args.cores, args.jobs, args.seed)
+    elif args.command == 'preempt-demo':
+        run_preempt_demo(args.long_work, args.urgent_work, args.urgent_delay, args.slack)
+    elif args.command == 'demo-encode':
+        run_demo_encode(args.state_dir, args.priority, args.work)
+    else:
+        scheduler = EncodeScheduler(state_dir=args.state_dir)
+        with scheduler._locked_claims() as claims:
+            print(f"Budget CPUs: {scheduler.cpus} ({scheduler.threads_per_job} per encode)")
+            for pid, claim in sorted(claims.items()):
+                suspended = f", suspended by {claim['suspended_by']}" if claim["suspended_by"] else ""
+                print(f"  pid {pid}: CPUs {claim['cpus']}, priority {claim['priority']}{suspended}")
@@ -14,6 +14,13 @@ from pathlib import Path
 from typing import Tuple, Optional
 from pprint import pprint
 
+from concurrent.futures import ThreadPoolExecutor
+
+from encode_scheduler import EncodeScheduler
+from media_probe import probe_video, probe_keyframes, load_speculative, DEFAULT_SPECULATIVE_DIR
+from media_runner import run_media_command
+from toolchain import Toolchain, get_toolchain
+
 
 class HandBrakePreprocessor:
     """
@@ -32,15 +39,32 @@ class HandBrakePreprocessor:
         'Format .* detected only with low score'
     ]
     
-    def __init__(self, input_path: str, output_path: Optional[str] = None):
+    # x264 presets used by segmented encodes for each HandBrake preset
+    X264_PRESETS = {
+        'Fast 1080p30': 'fast',
+        'Very Fast 1080p30': 'veryfast',
+    }
+    
+    def __init__(self, input_path: str, output_path: Optional[str] = None,
+                 encode_scheduler: Optional[EncodeScheduler] = None,
+                 toolchain: Optional[Toolchain] = None,
+                 speculative_dir: str = DEFAULT_SPECULATIVE_DIR):
         """
         Initialize the preprocessor
         
         Args:
             input_path (str): Path to input video
             output_path (str, optional): Path for output video. If None, creates one with _fixed suffix
+            encode_scheduler (EncodeScheduler, optional): Shared CPU budget for encodes.
+                If None, a scheduler with default settings is used.
+            toolchain (Toolchain, optional): Capabilities of the installed ffmpeg and
+                HandBrake builds. If None, the cached process-wide registry is used.
+            speculative_dir (str): Directory of checks done while files were still syncing.
         """
         self.input_path = Path(input_path)
+        self.encode_scheduler = encode_scheduler or EncodeScheduler()
+        self.toolchain = toolchain or get_toolchain()
+        self.speculative_dir = speculative_dir
         
         if output_path:
             self.output_path = Path(output_path)
@@ -50,19 +74,11 @@ class HandBrakePreprocessor:
         
         self.needs_fixing = False
         self.detected_issues = []
+        self._progress_step = -1
     
     def check_handbrake_available(self) -> bool:
-        """Check if HandBrake CLI is available"""
-        try:
-            result = subprocess.run(
-                ['HandBrakeCLI', '--version'], 
-                capture_output=True, 
-                text=True, 
-                check=True
-            )
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            return False
+        """Check if HandBrake CLI is available (from the cached toolchain registry)"""
+        return self.toolchain.handbrake_available()
     
     def detect_video_issues(self) -> bool:
         """
@@ -76,13 +92,20 @@ class HandBrakePreprocessor:
         if not self.input_path.exists():
             raise FileNotFoundError(f"Input video not found: {self.input_path}")
         
+        # Reuse the checks run while the file was still syncing, if its content is unchanged
+        speculative = load_speculative(str(self.input_path), self.speculative_dir)
+        if speculative is not None and "issues" in speculative:
+            print(f"   Using the check done ahead of time on {speculative.get('source', 'a synced copy')}")
+            self.detected_issues = list(speculative["issues"])
+            return self._report_issues()
+        
         # Test 1: Try to get basic video info with ffprobe
         try:
             probe_cmd = [
                 'ffprobe', '-v', 'quiet', '-print_format', 'json',
                 '-show_format', '-show_streams', str(self.input_path)
             ]
-            result = subprocess.run(probe_cmd, capture_output=True, text=True, check=True)
+            result = run_media_command(probe_cmd, capture_stdout=True, check=True, timeout=120)
             video_info = json.loads(result.stdout)
             
             # Check for problematic color space in metadata
@@ -106,7 +129,7 @@ class HandBrakePreprocessor:
                 #     if data.get('side_data_type') == 'Display Matrix':
                 #         self.detected_issues.append("Has display matrix rotation")
         
-        except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        except (subprocess.SubprocessError, json.JSONDecodeError) as e:
             self.detected_issues.append(f"ffprobe failed: {str(e)}")
         
         # Test 2: Try to process a small sample of the video
@@ -117,6 +140,10 @@ class HandBrakePreprocessor:
         compatibility_issues = self._test_ffmpeg_compatibility()
         self.detected_issues.extend(compatibility_issues)
         
+        return self._report_issues()
+    
+    def _report_issues(self) -> bool:
+        """Set needs_fixing from the detected issues and print them"""
         self.needs_fixing = len(self.detected_issues) > 0
         
         if self.needs_fixing:
@@ -144,13 +171,12 @@ class HandBrakePreprocessor:
             ]
             
             try:
-                result = subprocess.run(extract_cmd, capture_output=True, text=True, check=False)
+                result = run_media_command(extract_cmd, timeout=300)
                 
                 # Check for specific error patterns
-                for pattern in self.ERROR_PATTERNS:
-                    if pattern in result.stderr:
-                        issues.append(f"Frame extraction error: {pattern}")
-                        break
+                pattern = result.find_pattern(self.ERROR_PATTERNS)
+                if pattern:
+                    issues.append(f"Frame extraction error: {pattern}")
                 
                 # Check if output was actually created
                 if not os.path.exists(test_output) or os.path.getsize(test_output) < 1000:
@@ -173,13 +199,12 @@ class HandBrakePreprocessor:
         ]
         
         try:
-            result = subprocess.run(test_cmd, capture_output=True, text=True, check=False)
+            result = run_media_command(test_cmd, timeout=300)
             
             # Check for specific error patterns
-            for pattern in self.ERROR_PATTERNS:
-                if pattern in result.stderr:
-                    issues.append(f"FFmpeg compatibility issue: {pattern}")
-                    break
+            pattern = result.find_pattern(self.ERROR_PATTERNS)
+            if pattern:
+                issues.append(f"FFmpeg compatibility issue: {pattern}")
             
             if result.returncode != 0 and not issues:
                 issues.append("FFmpeg cannot process video properly")
@@ -193,56 +218,224 @@ class HandBrakePreprocessor:
         """
         Fix the video using HandBrake
         
+        Long clips are split at keyframes and the segments encoded in parallel
+        when the encode slot has several CPUs; HandBrake is used otherwise, or
+        if the segmented encode fails.
+        
         Returns:
             str: Path to fixed video
         """
-        if not self.check_handbrake_available():
-            raise RuntimeError("HandBrake CLI not available. Install with: sudo apt install handbrake-cli")
-        
         print(f"🔧 Fixing video with HandBrake...")
         print(f"   Input: {self.input_path}")
         print(f"   Output: {self.output_path}")
         
-        # HandBrake command optimized for compatibility
-        handbrake_cmd = [
-            'HandBrakeCLI',
-            '-i', str(self.input_path),
-            '-o', str(self.output_path),
+        summary = probe_video(str(self.input_path), speculative_dir=self.speculative_dir)
+        duration = summary.get('duration') if summary else None
+        
+        with self.encode_scheduler.reserve(duration=duration) as slot:
+            print(f"   Encode slot: {slot.threads} threads on CPUs {slot.cpus}, preset '{slot.preset}'")
+            if self.toolchain.can_segment_encode() and self.encode_scheduler.use_segments(duration, slot):
+                try:
+                    return self.fix_video_segmented(slot, summary)
+                except (RuntimeError, subprocess.SubprocessError, OSError) as e:
+                    print(f"   Segmented encode failed ({e}), falling back to HandBrake...")
+            return self._run_handbrake(slot)
+    
+    def _plan_segments(self, keyframes: list, duration: float, count: int) -> list:
+        """Split [0, duration) at the keyframes nearest to equal-length boundaries"""
+        cuts = [0.0]
+        for i in range(1, count):
+            target = duration * i / count
+            nearest = min(keyframes, key=lambda t: abs(t - target))
+            if cuts[-1] < nearest < duration:
+                cuts.append(nearest)
+        return [(start, end) for start, end in zip(cuts, cuts[1:] + [None])]
+    
+    def _encode_segment(self, start: float, end: Optional[float], segment_path: str, slot, x264_preset: str):
+        """Encode one keyframe-aligned segment of the video stream on a single CPU"""
+        segment_cmd = [
+            'ffmpeg', '-v', 'error', '-y',
+            '-ss', f'{start:.6f}', '-i', str(self.input_path),
+        ]
+        if end is not None:
+            segment_cmd += ['-t', f'{end - start:.6f}']
+        segment_cmd += [
+            '-map', '0:v:0', '-an', '-sn', '-dn',
+            *self.toolchain.h264_args(x264_preset, threads=1),
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+            '-pix_fmt', 'yuv420p',
+            '-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709',
+            segment_path
+        ]
+        run_media_command(segment_cmd, check=True, timeout=1800, preexec_fn=slot.preexec(),
+                          suspend_check=slot.suspend_check)
+    
+    def _stream_durations(self, path) -> dict:
+        """Duration of the first video and audio stream of a file"""
+        probe_cmd = [
+            'ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,duration',
+            '-of', 'json', str(path)
+        ]
+        result = run_media_command(probe_cmd, capture_stdout=True, check=True, timeout=120)
+        durations = {}
+        for stream in json.loads(result.stdout).get('streams', []):
+            codec_type = stream.get('codec_type')
+            if codec_type in ('video', 'audio') and codec_type not in durations:
+                try:
+                    durations[codec_type] = float(stream['duration'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return durations
+    
+    def _check_av_sync(self, tolerance: float = 0.2) -> bool:
+        """Check that the fixed video kept the source's length and audio/video alignment"""
+        source = self._stream_durations(self.input_path)
+        fixed = self._stream_durations(self.output_path)
+        if 'video' in source and abs(fixed.get('video', 0.0) - source['video']) > tolerance:
+            return False
+        if 'audio' in source and 'video' in source:
+            source_gap = source['audio'] - source['video']
+            fixed_gap = fixed.get('audio', 0.0) - fixed.get('video', 0.0)
+            if abs(fixed_gap - source_gap) > tolerance:
+                return False
+        return True
+    
+    def fix_video_segmented(self, slot, summary: dict) -> str:
+        """
+        Fix the video by encoding keyframe-aligned segments in parallel
+        
+        The video stream is cut at keyframes from the probe's keyframe index and
+        each segment is encoded with x264 on one CPU of the slot, while the audio
+        is encoded once over its full length so its timeline is untouched. The
+        segments are joined losslessly with the concat demuxer and muxed with
+        the audio.
+        
+        Args:
+            slot (EncodeSlot): CPUs reserved for this encode
+            summary (dict): Probe summary of the input
+        
+        Returns:
+            str: Path to fixed video
+        """
+        duration = summary['duration']
+        keyframes = probe_keyframes(str(self.input_path))
+        if not keyframes or len(keyframes) < 2:
+            raise RuntimeError("no keyframe index available")
+        keyframes = [t - keyframes[0] for t in keyframes]
+        
+        cpu_slots = slot.split()
+        segments = self._plan_segments(keyframes, duration, len(cpu_slots))
+        if len(segments) < 2:
+            raise RuntimeError("video has too few keyframes to split")
+        x264_preset = self.X264_PRESETS.get(slot.preset, 'fast')
+        
+        print(f"   Encoding {len(segments)} segments in parallel (x264 preset '{x264_preset}')...")
+        with tempfile.TemporaryDirectory(prefix="segments_", dir=str(self.output_path.parent)) as work_dir:
+            segment_paths = [os.path.join(work_dir, f"segment_{i:03d}.mp4") for i in range(len(segments))]
+            audio_path = os.path.join(work_dir, "audio.m4a")
+            
+            # One worker per segment plus one so the audio encode runs alongside them
+            with ThreadPoolExecutor(max_workers=len(cpu_slots) + 1) as executor:
+                futures = [
+                    executor.submit(self._encode_segment, start, end, segment_path, cpu_slot, x264_preset)
+                    for (start, end), segment_path, cpu_slot in zip(segments, segment_paths, cpu_slots)
+                ]
+                if summary.get('has_audio'):
+                    audio_cmd = [
+                        'ffmpeg', '-v', 'error', '-y', '-i', str(self.input_path),
+                        '-map', '0:a:0', '-vn', '-c:a', self.toolchain.aac_encoder(), '-b:a', '192k', audio_path
+                    ]
+                    futures.append(executor.submit(
+                        run_media_command, audio_cmd, check=True, timeout=1800, preexec_fn=slot.preexec(),
+                        suspend_check=slot.suspend_check
+                    ))
+                for future in futures:
+                    future.result()
+            
+            concat_list = os.path.join(work_dir, "segments.txt")
+            with open(concat_list, 'w') as f:
+                for segment_path in segment_paths:
+                    f.write(f"file '{segment_path}'\n")
             
-            # Use a reliable preset
-            '--preset', 'Fast 1080p30',
+            concat_cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list]
+            if summary.get('has_audio'):
+                concat_cmd += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0']
+            concat_cmd += ['-c', 'copy', '-movflags', '+faststart', str(self.output_path)]
+            run_media_command(concat_cmd, check=True, timeout=1800)
+        
+        if not self.verify_fixed_video():
+            raise RuntimeError("segmented output failed verification")
+        if not self._check_av_sync():
+            raise RuntimeError("segmented output drifted from the source timeline")
+        
+        print(f"✅ Video fixed successfully ({len(segments)} segments)")
+        print(f"   Original size: {self.input_path.stat().st_size / 1024 / 1024:.1f} MB")
+        print(f"   Fixed size: {self.output_path.stat().st_size / 1024 / 1024:.1f} MB")
+        
+        return str(self.output_path)
+    
+    def _report_progress(self, progress: dict):
+        """Print HandBrake progress in 10% steps"""
+        step = int(progress.get('percent', 0) // 10)
+        if step > self._progress_step:
+            self._progress_step = step
+            print(f"   HandBrake: {progress['percent']:.0f}%")
+    
+    def _run_handbrake(self, slot) -> str:
+        """Run HandBrakeCLI pinned to the CPUs of an encode slot"""
+        if not self.check_handbrake_available():
+            raise RuntimeError("HandBrake CLI not available. Install with: sudo apt install handbrake-cli")
+        
+        # HandBrake options optimized for compatibility, as (option, value) pairs
+        handbrake_options = [
+            # Use a reliable preset (Very Fast when the backlog is deep or the clip is long)
+            ('--preset', slot.preset),
             
             # Video settings
-            '--encoder', 'x264',
-            '--quality', '23',  # Good quality
-            '--vfr',  # Variable frame rate
+            ('--encoder', 'x264'),
+            ('--quality', '23'),  # Good quality
+            ('--encopts', slot.x264_options()),  # Match x264 threads to the reserved CPUs
+            ('--vfr', None),  # Variable frame rate
             
             # Audio settings  
-            '--aencoder', 'aac',
-            '--ab', '192',  # 192kbps audio
+            ('--aencoder', 'aac'),
+            ('--ab', '192'),  # 192kbps audio
             
             # Format settings
-            '--format', 'av_mp4',
-            '--optimize',  # Optimize for streaming
+            ('--format', 'av_mp4'),
+            ('--optimize', None),  # Optimize for streaming
             
             # Compatibility settings
-            '--loose-anamorphic',  # Handle aspect ratio issues
-            '--color-matrix', 'bt709',  # Standard color matrix
+            ('--loose-anamorphic', None),  # Handle aspect ratio issues
+            ('--color-matrix', 'bt709'),  # Standard color matrix
         ]
         
+        # Leave out options this HandBrake build does not know instead of failing the first attempt
+        handbrake_cmd = ['HandBrakeCLI', '-i', str(self.input_path), '-o', str(self.output_path)]
+        for option, value in handbrake_options:
+            if not self.toolchain.handbrake_supports(option):
+                print(f"   HandBrake {self.toolchain.handbrake_version()} has no {option}; leaving it out")
+                continue
+            handbrake_cmd.append(option)
+            if value is not None:
+                handbrake_cmd.append(value)
+        
         try:
             print("   Running HandBrake...")
-            result = subprocess.run(
+            self._progress_step = -1
+            result = run_media_command(
                 handbrake_cmd,
-                capture_output=True,
-                text=True,
-                check=False,
-                timeout=1800  # 30 minute timeout
+                timeout=1800,  # 30 minute timeout
+                progress='handbrake',
+                progress_callback=self._report_progress,
+                preexec_fn=slot.preexec(),
+                suspend_check=slot.suspend_check
             )
             
             if result.returncode != 0:
                 # Try with simpler settings if first attempt fails
                 print("   First attempt failed, trying simplified settings...")
+                self._progress_step = -1
                 
                 simple_cmd = [
                     'HandBrakeCLI',
@@ -250,10 +443,17 @@ class HandBrakePreprocessor:
                     '-o', str(self.output_path),
                     '--preset', 'Very Fast 1080p30',
                     '--encoder', 'x264',
-                    '--quality', '25'
+                    '--quality', '25',
+                    '--encopts', slot.x264_options()
                 ]
                 
-                result = subprocess.run(simple_cmd, capture_output=True, text=True, check=True)
+                result = run_media_command(
+                    simple_cmd, check=True, timeout=1800,
+                    progress='handbrake',
+                    progress_callback=self._report_progress,
+                    preexec_fn=slot.preexec(),
+                    suspend_check=slot.suspend_check
+                )
             
             # Verify output
             if not self.output_path.exists() or self.output_path.stat().st_size < 1000:
@@ -270,6 +470,33 @@ class HandBrakePreprocessor:
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"HandBrake failed: {e.stderr}")
     
+    def streamable_fix_command(self, slot) -> list:
+        """
+        FFmpeg command that fixes the video into fragmented MP4
+
+        Unlike HandBrake's output, fragmented MP4 is valid while it grows, so
+        an upload can follow the file as it is written (see streaming_upload.py).
+
+        Args:
+            slot (EncodeSlot): CPUs reserved for this encode
+
+        Returns:
+            list: Command line for subprocess
+        """
+        x264_preset = self.X264_PRESETS.get(slot.preset, 'fast')
+        return [
+            'ffmpeg', '-v', 'error', '-y',
+            '-i', str(self.input_path),
+            '-map', '0:v:0', '-map', '0:a:0?',
+            *self.toolchain.h264_args(x264_preset, threads=slot.threads),
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+            '-pix_fmt', 'yuv420p',
+            '-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709',
+            '-c:a', self.toolchain.aac_encoder(), '-b:a', '192k',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-f', 'mp4', str(self.output_path)
+        ]
+
     def verify_fixed_video(self) -> bool:
         """
         Verify that the fixed video works properly
@@ -288,10 +515,10 @@ class HandBrakePreprocessor:
                 '-of', 'csv=p=0',
                 str(self.output_path)
             ]
-            result = subprocess.run(probe_cmd, capture_output=True, text=True, check=True)
+            result = run_media_command(probe_cmd, capture_stdout=True, check=True, timeout=120)
             if not result.stdout.strip():
                 return False
-        except subprocess.CalledProcessError:
+        except (subprocess.SubprocessError, OSError):
             return False
         
         # Test 2: Check if ffmpeg can process it
@@ -301,12 +528,11 @@ class HandBrakePreprocessor:
                 '-i', str(self.output_path),
                 '-t', '1', '-f', 'null', '-'
             ]
-            result = subprocess.run(test_cmd, capture_output=True, text=True, check=False)
+            result = run_media_command(test_cmd, timeout=300)
             
             # Check for error patterns
-            for pattern in self.ERROR_PATTERNS:
-                if pattern in result.stderr:
-                    return False
+            if result.find_pattern(self.ERROR_PATTERNS):
+                return False
             
             if result.returncode != 0:
                 return False
@@ -342,18 +568,23 @@ class HandBrakePreprocessor:
         return fixed_path, True
 
 
-def preprocess_video(input_path: str, output_path: Optional[str] = None) -> Tuple[str, bool]:
+def preprocess_video(input_path: str, output_path: Optional[str] = None,
+                     encode_scheduler: Optional[EncodeScheduler] = None,
+                     speculative_dir: str = DEFAULT_SPECULATIVE_DIR) -> Tuple[str, bool]:
     """
     Convenience function to preprocess a video
     
     Args:
         input_path (str): Path to input video
         output_path (str, optional): Path for output video
+        encode_scheduler (EncodeScheduler, optional): Shared CPU budget for encodes
+        speculative_dir (str): Directory of checks done while files were still syncing
     
     Returns:
         Tuple[str, bool]: (output_path, was_fixed)
     """
-    preprocessor = HandBrakePreprocessor(input_path, output_path)
+    preprocessor = HandBrakePreprocessor(input_path, output_path, encode_scheduler=encode_scheduler,
+                                         speculative_dir=speculative_dir)
     return preprocessor.process_video()
 
 
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# ingest.py - Bring completed files from the Nutstore folder into AUTOPUBLISH_DIR without copying when possible
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import fnmatch
+import tempfile
+import argparse
+
+from bandwidth_arbiter import TokenBucket
+
+DEFAULT_MANIFEST = os.path.expanduser('~/AutoPublishDATA/ingest_manifest.json')
+DEFAULT_PATTERN = "*_COMPLETED.*"
+METHODS = ("auto", "reflink", "hardlink", "copy", "move")
+COPY_BUFFER_BYTES = 8 * 1024 * 1024
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors meaning "this filesystem cannot do that", as opposed to real I/O failures
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.EPERM, errno.ENOSYS}
+
+
+def same_filesystem(path, directory):
+    return os.stat(path).st_dev == os.stat(directory).st_dev
+
+
+def reflink(source, target):
+    """Clone `source` into a new file `target` sharing its blocks (btrfs, XFS, bcachefs)."""
+    with open(source, 'rb') as src:
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+        except OSError:
+            os.close(fd)
+            os.remove(target)
+            raise
+        os.close(fd)
+
+
+def copy_file(source, target, bucket=None, buffer_bytes=COPY_BUFFER_BYTES):
+    """Copy through one large reused buffer and fsync, optionally rate-limited."""
+    buffer = bytearray(buffer_bytes)
+    view = memoryview(buffer)
+    with open(source, 'rb', buffering=0) as src, open(target, 'xb', buffering=0) as dst:
+        while True:
+            count = src.readinto(buffer)
+            if not count:
+                break
+            if bucket is not None:
+                bucket.consume(count)
+            written = 0
+            while written < count:
+                written += dst.write(view[written:count])
+        os.fsync(dst.fileno())
+
+
+def _temp_name(directory, name):
+    # A dot and several dots: monitor_autopublish.sh ignores it, and the final
+    # rename is seen as a moved_to event once the file is complete
+    return os.path.join(directory, f".{name}.{os.getpid()}.ingest")
+
+
+def ingest_file(source, directory, method="auto", bucket=None):
+    """
+    Make `source` appear in `directory` atomically, with as little I/O as possible.
+
+    auto tries a reflink and then a hardlink when both are on the same
+    filesystem, and copies across filesystems. move renames the source away
+    (same filesystem only), so it is not a mirror any more.
+
+    Returns:
+        str: The method used.
+    """
+    name = os.path.basename(source)
+    target = os.path.join(directory, name)
+    if method == "move":
+        os.rename(source, target)
+        return "move"
+
+    candidates = [method]
+    if method == "auto":
+        candidates = ["reflink", "hardlink", "copy"] if same_filesystem(source, directory) else ["copy"]
+
+    temp_path = _temp_name(directory, name)
+    for candidate in candidates:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        try:
+            if candidate == "reflink":
+                reflink(source, temp_path)
+            elif candidate == "hardlink":
+                os.link(source, temp_path)
+            else:
+                copy_file(source, temp_path, bucket)
+        except OSError as e:
+            if e.errno in _UNSUPPORTED and candidate != candidates[-1]:
+                continue
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+        if candidate != "hardlink":
+            stat = os.stat(source)
+            os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(temp_path, target)
+        return candidate
+    raise OSError(errno.EOPNOTSUPP, f"No ingest method worked for {source}")
+
+
+class Ingester:
+    """
+    Mirrors completed files from a source folder into AUTOPUBLISH_DIR.
+
+    Replaces `rsync --whole-file --delete`: only the source folder is listed
+    (the top level, like the rsync filter). A file is (re)ingested when the
+    manifest has no record of it or its size or mtime changed. Files the
+    manifest records that have left the source are removed from the
+    destination, which is what --delete did for them, without listing the
+    destination.
+    """
+
+    def __init__(self, source_dir, dest_dir, manifest_path=DEFAULT_MANIFEST, method="auto",
+                 pattern=DEFAULT_PATTERN, bwlimit_kib=0):
+        self.source_dir = source_dir
+        self.dest_dir = dest_dir
+        self.manifest_path = manifest_path
+        self.method = method
+        self.pattern = pattern
+        self.bucket = TokenBucket(bwlimit_kib * 1024) if bwlimit_kib else None
+        try:
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        temp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def _current(self, name, stat):
+        """
+        Whether the destination already holds this version of the file.
+
+        A file the manifest does not know yet counts as current when the
+        destination has the same size and mtime, as rsync -t left the files
+        it mirrored before the ingester took over; the manifest is seeded
+        with it rather than ingesting (and requeueing) it again.
+        """
+        try:
+            dest_stat = os.stat(os.path.join(self.dest_dir, name))
+        except OSError:
+            return False
+        entry = self.manifest.get(name)
+        if entry is None:
+            if dest_stat.st_size != stat.st_size or dest_stat.st_mtime_ns != stat.st_mtime_ns:
+                return False
+            self.manifest[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "method": "existing"}
+            self._seeded = True
+            return True
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return False
+        return dest_stat.st_size == stat.st_size
+
+    def sync(self):
+        """
+        One pass over the source folder.
+
+        Returns:
+            dict: Counts of files per method used, "unchanged" and "deleted".
+        """
+        os.makedirs(self.dest_dir, exist_ok=True)
+        counts = {}
+        seen = set()
+        self._seeded = False
+        with os.scandir(self.source_dir) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False) or not fnmatch.fnmatch(entry.name, self.pattern):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_size == 0:
+                    continue
+                seen.add(entry.name)
+                if self._current(entry.name, stat):
+                    counts["unchanged"] = counts.get("unchanged", 0) + 1
+                    continue
+                start_time = time.monotonic()
+                try:
+                    method = ingest_file(entry.path, self.dest_dir, self.method, self.bucket)
+                except OSError as e:
+                    print(f"Failed to ingest {entry.path}: {e}")
+                    continue
+                counts[method] = counts.get(method, 0) + 1
+                print(f"Ingested {entry.name} by {method} ({stat.st_size / 1024 ** 2:.0f} MB "
+                      f"in {time.monotonic() - start_time:.2f}s)")
+                if method == "move":
+                    continue
+                self.manifest[entry.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "method": method}
+                self._save()
+
+        for name in [name for name in self.manifest if name not in seen]:
+            try:
+                os.remove(os.path.join(self.dest_dir, name))
+                print(f"Removed {name}: it is gone from {self.source_dir}")
+            except FileNotFoundError:
+                pass
+            del self.manifest[name]
+            counts["deleted"] = counts.get("deleted", 0) + 1
+        if counts.get("deleted") or self._seeded:
+            self._save()
+        return counts
+
+
+def _process_write_bytes():
+    """Bytes this process has caused to be written to storage (Linux /proc/self/io)."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_benchmark(directory=None, size_mib=512):
+    """
+    Time and storage writes of each ingest method for one large file.
+
+    Source and destination are in the same directory tree, as with the Nutstore
+    folder and AUTOPUBLISH_DIR on one filesystem.
+    """
+    work_dir = tempfile.mkdtemp(prefix="ingest_bench_", dir=directory)
+    source_dir = os.path.join(work_dir, 'nutstore')
+    os.makedirs(source_dir)
+    source = os.path.join(source_dir, "IMG_0001_2025_07_01_13_23_55_COMPLETED.MOV")
+    chunk = os.urandom(1024 * 1024)
+    with open(source, 'wb') as f:
+        for _ in range(size_mib):
+            f.write(chunk)
+        os.fsync(f.fileno())
+
+    print(f"{size_mib} MiB file in {work_dir}")
+    print(f"{'method':<10}{'seconds':>9}{'written':>12}")
+    try:
+        for method in ("copy", "hardlink", "reflink"):
+            dest_dir = os.path.join(work_dir, f"dest_{method}")
+            os.makedirs(dest_dir)
+            written_before = _process_write_bytes()
+            start_time = time.monotonic()
+            try:
+                ingest_file(source, dest_dir, method)
+            except OSError as e:
+                print(f"{method:<10}{'unsupported here':>21} ({e.strerror})")
+                continue
+            elapsed = time.monotonic() - start_time
+            written_after = _process_write_bytes()
+            written = (f"{(written_after - written_before) / 1024 ** 2:.0f} MiB"
+                       if written_before is not None else "n/a")
+            print(f"{method:<10}{elapsed:>8.3f}s{written:>12}")
+    finally:
+        for root, dirs, files in os.walk(work_dir, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zero-copy ingest of completed files")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help="One ingest pass from SOURCE_DIR into DEST_DIR")
+    sync_parser.add_argument('source_dir')
+    sync_parser.add_argument('dest_dir')
+    sync_parser.add_argument('--method', choices=METHODS, default="auto",
+                             help="auto: reflink, else hardlink on one filesystem; copy across filesystems")
+    sync_parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help="Record of ingested files")
+    sync_parser.add_argument('--pattern', default=DEFAULT_PATTERN, help="Names to ingest")
+    sync_parser.add_argument('--bwlimit-kib', type=int, default=0, help="Rate limit for copies (KiB/s, 0 = none)")
+
+    bench_parser = subparsers.add_parser('benchmark', help="Compare ingest methods on one large file")
+    bench_parser.add_argument('--dir', help="Directory on the filesystem to test (default: temp dir)")
+    bench_parser.add_argument('--size-mib', type=int, default=512, help="Test file size")
+
+    args = parser.parse_args()
+    if args.command == 'sync':
+        ingester = Ingester(args.source_dir, args.dest_dir, args.manifest, args.method,
+                            args.pattern, args.bwlimit_kib)
+        counts = ingester.sync()
+        changed = {k: v for k, v in counts.items() if k != "unchanged"}
+        if changed:
+            print(f"Ingest pass: {changed}")
+        sys.exit(0)
+    run_benchmark(args.dir, args.size_mib)
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# ledger.py - Segmented processed ledger with Bloom filters and sorted indexes
+
+import os
+import re
+import csv
+import sys
+import math
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import argparse
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+from change_feed import atomic_write
+
+DEFAULT_ROTATE_ENTRIES = 1000
+DEFAULT_MAX_SEGMENTS = 8
+# Per segment: with up to DEFAULT_MAX_SEGMENTS + 1 segments about 1% of the
+# names not in the ledger still need an index search
+BLOOM_ERROR_RATE = 0.001
+
+_BLOOM_MAGIC = b"LBLOOM1\n"
+_INDEX_MAGIC = b"LINDEX1\n"
+# Size and mtime_ns of the segment's CSV when the sidecar was built
+_SIGNATURE = struct.Struct("<QQ")
+_BLOOM_SHAPE = struct.Struct("<QI")
+_COUNT = struct.Struct("<I")
+_OFFSET = struct.Struct("<Q")
+
+
+def _hashes(name):
+    """The two 64-bit hashes every Bloom filter derives its bit positions from."""
+    h1, h2 = struct.unpack("<QQ", hashlib.blake2b(name.encode('utf-8'), digest_size=16).digest())
+    return h1, h2 | 1
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def read_names(csv_path):
+    """Names in a ledger CSV, in file order (first column, blank rows skipped)."""
+    try:
+        with open(csv_path, newline='', encoding='utf-8', errors='replace') as f:
+            return [row[0] for row in csv.reader(f) if row and row[0]]
+    except FileNotFoundError:
+        return []
+
+
+class Segment:
+    """
+    One ledger CSV and its sidecars: a Bloom filter and a sorted index.
+
+    The sidecars record the size and mtime of the CSV they were built from and
+    are rebuilt when it no longer matches. The index is a sorted array of
+    UTF-8 names with an offset table, searched in place through mmap.
+    """
+
+    def __init__(self, csv_path, index_dir):
+        self.path = csv_path
+        self.name = os.path.basename(csv_path)
+        self.bloom_path = os.path.join(index_dir, f"{self.name}.bloom")
+        self.index_path = os.path.join(index_dir, f"{self.name}.idx")
+        self.signature = None
+        self.count = 0
+        self.bits = b""
+        self.num_bits = 0
+        self.num_hashes = 0
+        self._index = None
+        self._offsets_at = 0
+        self._names_at = 0
+
+    def __len__(self):
+        return self.count
+
+    def load(self):
+        """Bring the sidecars up to date with the CSV, rebuilding them if stale."""
+        signature = _file_signature(self.path)
+        if signature is not None and signature == self.signature:
+            return
+        if signature is None:
+            self._set_empty()
+        elif not (self._load_bloom(signature) and self._load_index(signature)):
+            self.build(signature)
+
+    def _set_empty(self):
+        self.signature = None
+        self.count = 0
+        self.bits, self.num_bits, self.num_hashes = b"", 0, 0
+        self._index = None
+
+    def _load_bloom(self, signature):
+        try:
+            with open(self.bloom_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        header = len(_BLOOM_MAGIC) + _SIGNATURE.size + _BLOOM_SHAPE.size
+        if len(data) < header or not data.startswith(_BLOOM_MAGIC):
+            return False
+        if _SIGNATURE.unpack_from(data, len(_BLOOM_MAGIC)) != signature:
+            return False
+        num_bits, num_hashes = _BLOOM_SHAPE.unpack_from(data, len(_BLOOM_MAGIC) + _SIGNATURE.size)
+        if len(data) - header != num_bits // 8:
+            return False
+        self.bits, self.num_bits, self.num_hashes = data[header:], num_bits, num_hashes
+        return True
+
+    def _load_index(self, signature):
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        except (FileNotFoundError, ValueError):
+            return False
+        header = len(_INDEX_MAGIC) + _SIGNATURE.size + _COUNT.size
+        if len(index) < header or index[:len(_INDEX_MAGIC)] != _INDEX_MAGIC:
+            return False
+        if _SIGNATURE.unpack_from(index, len(_INDEX_MAGIC)) != signature:
+            return False
+        count = _COUNT.unpack_from(index, len(_INDEX_MAGIC) + _SIGNATURE.size)[0]
+        if len(index) < header + (count + 1) * _OFFSET.size:
+            return False
+        self.count, self._index, self.signature = count, index, signature
+        self._offsets_at = header
+        self._names_at = header + (count + 1) * _OFFSET.size
+        return True
+
+    def build(self, signature=None):
+        """Rebuild both sidecars from the CSV."""
+        signature = signature or _file_signature(self.path)
+        if signature is None:
+            self._set_empty()
+            return
+        keys = sorted({name.encode('utf-8') for name in read_names(self.path)})
+        os.makedirs(os.path.dirname(self.bloom_path), exist_ok=True)
+
+        num_bits = max(64, math.ceil(-max(len(keys), 1) * math.log(BLOOM_ERROR_RATE) / math.log(2) ** 2))
+        num_bits += -num_bits % 8
+        num_hashes = min(16, max(1, round(num_bits / max(len(keys), 1) * math.log(2))))
+        bits = bytearray(num_bits // 8)
+        for key in keys:
+            h1, h2 = _hashes(key.decode('utf-8'))
+            for i in range(num_hashes):
+                bit = (h1 + i * h2) % num_bits
+                bits[bit >> 3] |= 1 << (bit & 7)
+        with atomic_write(self.bloom_path) as f:
+            f.write(_BLOOM_MAGIC + _SIGNATURE.pack(*signature) + _BLOOM_SHAPE.pack(num_bits, num_hashes))
+            f.write(bits)
+
+        offsets, position = [], 0
+        for key in keys:
+            offsets.append(position)
+            position += len(key)
+        offsets.append(position)
+        with atomic_write(self.index_path) as f:
+            f.write(_INDEX_MAGIC + _SIGNATURE.pack(*signature) + _COUNT.pack(len(keys)))
+            f.write(b"".join(_OFFSET.pack(offset) for offset in offsets))
+            f.write(b"".join(keys))
+
+        if not (self._load_bloom(signature) and self._load_index(signature)):
+            raise OSError(f"could not read back the index of {self.path}")
+
+    def might_contain(self, hashes):
+        """Bloom filter check: False means definitely absent."""
+        if not self.num_bits:
+            return False
+        h1, h2 = hashes
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def _key(self, position):
+        start, end = struct.unpack_from("<QQ", self._index, self._offsets_at + position * _OFFSET.size)
+        return self._index[self._names_at + start:self._names_at + end]
+
+    def lookup(self, key):
+        """Binary search of the sorted index for a UTF-8 encoded name."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low < self.count and self._key(low) == key
+
+
+class Ledger:
+    """
+    The processed ledger as an active segment plus sealed historical ones.
+
+    The active segment is the ledger path itself (processed.csv), so tools that
+    append to or read it directly keep working. Once it holds rotate_entries
+    names it is sealed as `processed.csv.YYYYMMDD` next to it, the naming the
+    hand-rotated snapshots already use, and those snapshots are picked up as
+    sealed segments. When the ledger has sealed more than max_segments
+    segments itself, the oldest of them are merged into one; snapshots it did
+    not create are read but never merged or removed.
+
+    "Already processed?" hashes the name once and checks each segment's Bloom
+    filter; only when a filter says maybe is the segment's sorted index
+    searched. Sidecars live in `.processed.csv.index/` next to the ledger and
+    appends, rotation and compaction happen under an flock in that directory.
+    """
+
+    def __init__(self, path, rotate_entries=DEFAULT_ROTATE_ENTRIES, max_segments=DEFAULT_MAX_SEGMENTS):
+        self.path = path
+        self.rotate_entries = rotate_entries
+        self.max_segments = max_segments
+        directory, base = os.path.split(os.path.abspath(path))
+        self.directory = directory
+        self.index_dir = os.path.join(directory, f".{base}.index")
+        self.lock_path = os.path.join(self.index_dir, "lock")
+        # Names of the sealed segments this ledger created, the only ones compaction touches
+        self.owned_path = os.path.join(self.index_dir, "sealed")
+        self._sealed_pattern = re.compile(rf"^{re.escape(base)}\.(\d{{8}})(?:_(\d+))?$")
+        self.active = Segment(path, self.index_dir)
+        self.sealed = []
+        self._active_inode = None
+        self._discovered = False
+        self.stats = {"lookups": 0, "index_searches": 0}
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sealed_keys(self):
+        """(date, sequence) and path of the sealed segment CSVs, newest first."""
+        found = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            match = self._sealed_pattern.match(name)
+            if match:
+                found.append(((match.group(1), int(match.group(2) or 1)), os.path.join(self.directory, name)))
+        return sorted(found, reverse=True)
+
+    def _owned(self):
+        try:
+            with open(self.owned_path, encoding='utf-8') as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _save_owned(self, names):
+        with atomic_write(self.owned_path, 'w') as f:
+            f.writelines(f"{name}\n" for name in sorted(names))
+
+    def _compactable(self):
+        """Sealed segments the ledger created itself, newest first."""
+        owned = self._owned()
+        return [segment for segment in self.sealed if segment.name in owned]
+
+    def _sealed_paths(self):
+        """Sealed segment CSVs, newest first."""
+        return [path for _, path in self._sealed_keys()]
+
+    def refresh(self):
+        """
+        Pick up changes by other processes.
+
+        The sealed segments are only listed again when the active segment was
+        replaced (a rotation, which is when they change); otherwise this is a
+        stat of the active segment.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if not self._discovered or inode != self._active_inode:
+            known = {segment.path: segment for segment in self.sealed}
+            self.sealed = [known.get(path) or Segment(path, self.index_dir) for path in self._sealed_paths()]
+            for segment in self.sealed:
+                segment.load()
+            self._active_inode = inode
+            self._discovered = True
+        self.active.load()
+
+    def segments(self):
+        """Active segment first, then sealed ones from newest to oldest."""
+        return [self.active, *self.sealed]
+
+    def contains(self, name, refresh=True):
+        if refresh:
+            self.refresh()
+        self.stats["lookups"] += 1
+        hashes = _hashes(name)
+        key = None
+        for segment in self.segments():
+            if segment.might_contain(hashes):
+                self.stats["index_searches"] += 1
+                key = key or name.encode('utf-8')
+                if segment.lookup(key):
+                    return True
+        return False
+
+    def __contains__(self, name):
+        return self.contains(name)
+
+    def add(self, name):
+        """
+        Record a name as processed unless any segment has it.
+
+        Returns:
+            bool: True if it was added.
+        """
+        return bool(self.add_many([name]))
+
+    def add_many(self, names):
+        """
+        Record several names, skipping those already in the ledger.
+
+        Returns:
+            list: The names that were added.
+        """
+        with self._locked():
+            self.refresh()
+            added, seen = [], set()
+            for name in names:
+                if name and name not in seen and not self.contains(name, refresh=False):
+                    added.append(name)
+                seen.add(name)
+            if not added:
+                return []
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerows([name] for name in added)
+            self.active.build()
+            if len(self.active) >= self.rotate_entries:
+                self._rotate()
+        return added
+
+    def rotate(self):
+        """Seal the active segment now (if it has entries)."""
+        with self._locked():
+            self.refresh()
+            if len(self.active):
+                self._rotate()
+
+    def _rotate(self):
+        stamp = datetime.now().strftime('%Y%m%d')
+        # Numbered past every segment of the day, also those merged away, to keep the order
+        sequence = max((key[1] for key, _ in self._sealed_keys() if key[0] == stamp), default=0) + 1
+        sealed_path = f"{self.path}.{stamp}" if sequence == 1 else f"{self.path}.{stamp}_{sequence}"
+        # A rename keeps size and mtime, so the sidecars stay valid under the sealed name
+        os.rename(self.path, sealed_path)
+        sealed = Segment(sealed_path, self.index_dir)
+        for old, new in ((self.active.bloom_path, sealed.bloom_path), (self.active.index_path, sealed.index_path)):
+            if os.path.exists(old):
+                os.replace(old, new)
+        open(self.path, 'a').close()
+        self._save_owned(self._owned() | {sealed.name})
+        print(f"Sealed {len(self.active)} ledger entries as {os.path.basename(sealed_path)}")
+        self.active = Segment(self.path, self.index_dir)
+        self._discovered = False
+        self.refresh()
+        if len(self._compactable()) > self.max_segments:
+            self._compact(self.max_segments)
+
+    def compact(self, max_segments=None):
+        """Merge the oldest segments the ledger sealed until at most max_segments of them remain."""
+        with self._locked():
+            self.refresh()
+            self._compact(self.max_segments if max_segments is None else max_segments)
+
+    def _compact(self, max_segments):
+        max_segments = max(1, max_segments)
+        compactable = self._compactable()
+        if len(compactable) <= max_segments:
+            return
+        merged = compactable[max_segments - 1:]
+        target = merged[0]
+        names, seen = [], set()
+        for segment in reversed(merged):
+            for name in read_names(segment.path):
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        with atomic_write(target.path, 'w') as f:
+            csv.writer(f).writerows([name] for name in names)
+        for segment in merged[1:]:
+            for path in (segment.path, segment.bloom_path, segment.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self._save_owned(self._owned() - {segment.name for segment in merged[1:]})
+        target.build()
+        print(f"Compacted {len(merged)} ledger segments into {target.name} ({len(names)} entries)")
+        self.sealed = [segment for segment in self.sealed if segment not in merged[1:]]
+
+    def names(self):
+        """Every name in the ledger, oldest segment first."""
+        self.refresh()
+        for segment in reversed(self.segments()):
+            yield from read_names(segment.path)
+
+    def signature(self):
+        """Changes whenever any segment changes, for callers that cache the ledger."""
+        self.refresh()
+        return ";".join(f"{segment.name}:{_file_signature(segment.path)}" for segment in self.segments())
+
+
+def run_benchmark(entries=20000, lookups=2000, rotate_entries=DEFAULT_ROTATE_ENTRIES):
+    """
+    Compare "already processed?" against one ever-growing CSV read on every
+    check (what autopub.py did) with the segmented ledger, over a history of
+    `entries` names, half of the lookups hits and half misses.
+    """
+    with tempfile.TemporaryDirectory(prefix="ledger_bench_") as work_dir:
+        names = [f"IMG_{index:06d}_2025_07_01_13_23_55_COMPLETED.MOV" for index in range(entries)]
+        flat_path = os.path.join(work_dir, 'flat', 'processed.csv')
+        os.makedirs(os.path.dirname(flat_path))
+        with open(flat_path, 'w', newline='') as f:
+            csv.writer(f).writerows([name] for name in names)
+
+        ledger_path = os.path.join(work_dir, 'segmented', 'processed.csv')
+        os.makedirs(os.path.dirname(ledger_path))
+        ledger = Ledger(ledger_path, rotate_entries=rotate_entries)
+        started = time.perf_counter()
+        for start in range(0, entries, rotate_entries // 4):
+            ledger.add_many(names[start:start + rotate_entries // 4])
+        build_seconds = time.perf_counter() - started
+
+        queries = [names[(index * 7919) % entries] for index in range(lookups // 2)]
+        queries += [f"IMG_{index:06d}_2026_01_01_00_00_00_COMPLETED.MOV" for index in range(lookups - len(queries))]
+
+        started = time.perf_counter()
+        flat_hits = sum(1 for name in queries if name in read_names(flat_path))
+        flat_seconds = time.perf_counter() - started
+
+        reader = Ledger(ledger_path)
+        started = time.perf_counter()
+        ledger_hits = sum(1 for name in queries if name in reader)
+        ledger_seconds = time.perf_counter() - started
+        # Every index search for a name that is not in the ledger is a Bloom false positive
+        misses = queries[lookups // 2:]
+        searches = reader.stats["index_searches"]
+        for name in misses:
+            reader.contains(name, refresh=False)
+        false_searches = reader.stats["index_searches"] - searches
+
+        print(f"{entries} ledger entries in {len(reader.segments())} segments "
+              f"(sealed every {rotate_entries}); {lookups} lookups, half hits")
+        print(f"{'method':<16}{'per lookup':>14}{'hits':>8}")
+        print(f"{'flat CSV':<16}{flat_seconds / lookups * 1e6:>12.1f}us{flat_hits:>8}")
+        print(f"{'segmented':<16}{ledger_seconds / lookups * 1e6:>12.1f}us{ledger_hits:>8}")
+        print(f"Misses needing an index search: {false_searches} of {len(misses)}; "
+              f"ledger built in {build_seconds:.2f}s")
+        return {"flat": flat_seconds, "segmented": ledger_seconds, "false_searches": false_searches}
+
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Segmented processed ledger")
+    parser.add_argument('--ledger', default=os.path.join(script_dir, 'processed.csv'), help="Active ledger CSV")
+    parser.add_argument('--rotate-entries', type=int, default=DEFAULT_ROTATE_ENTRIES,
+                        help="Seal the active segment at this many entries")
+    parser.add_argument('--max-segments', type=int, default=DEFAULT_MAX_SEGMENTS,
+                        help="Merge the oldest segments the ledger sealed beyond this many")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    contains_parser = subparsers.add_parser('contains', help="Check names (exit 1 if any is missing)")
+    contains_parser.add_argument('names', nargs='+')
+    add_parser = subparsers.add_parser('add', help="Record names as processed")
+    add_parser.add_argument('names', nargs='+')
+    subparsers.add_parser('rotate', help="Seal the active segment now")
+    compact_parser = subparsers.add_parser('compact', help="Merge the oldest sealed segments")
+    compact_parser.add_argument('--into', type=int, help="Number of ledger-sealed segments to keep (default --max-segments)")
+    subparsers.add_parser('stats', help="Show the segments and their filters")
+    bench_parser = subparsers.add_parser('benchmark', help="Flat CSV against segmented lookups")
+    bench_parser.add_argument('--entries', type=int, default=20000)
+    bench_parser.add_argument('--lookups', type=int, default=2000)
+
+    args = parser.parse_args()
+    if args.command == 'benchmark':
+        run_benchmark(args.entries, args.lookups, args.rotate_entries)
+        sys.exit(0)
+
+    ledger = Ledger(args.ledger, args.rotate_entries, args.max_segments)
+    if args.command == 'contains':
+        missing = False
+        for name in args.names:
+            found = name in ledger
+            missing = missing or not found
+            print(f"{name}: {'processed' if found else 'not processed'}")
+        sys.exit(1 if missing else 0)
+    elif args.command == 'add':
+        for name in ledger.add_many(args.names):
+            print(f"Added {name}")
+    elif args.command == 'rotate':
+        ledger.rotate()
+    elif args.command == 'compact':
+        ledger.compact(args.into)
+    else:
+        ledger.refresh()
+        for segment in ledger.segments():
+            rate = (1 - math.exp(-segment.num_hashes * len(segment) / segment.num_bits)) ** segment.num_hashes \
+                if segment.num_bits else 0.0
+            print(f"{segment.name:<32}{len(segment):>8} entries  {segment.num_bits // 8:>8} B filter  "
+                  f"k={segment.num_hashes}  ~{rate:.2%} false positives")
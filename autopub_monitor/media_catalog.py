@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# media_catalog.py - SQLite catalog of the AutoPublish directory with fast search
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+from datetime import datetime
+
+from media_probe import probe_video, load_cached_probe, DEFAULT_PROBE_CACHE_DIR, DEFAULT_SPECULATIVE_DIR
+from queue_scheduler import read_queue, load_state, parse_arrival
+from ledger import Ledger
+
+DEFAULT_CATALOG = os.path.expanduser('~/AutoPublishDATA/media_catalog.sqlite3')
+VIDEO_PATTERN = re.compile(r'.+\.(mp4|mov|avi|flv|wmv|mkv)$', re.IGNORECASE)
+# Rows a scan writes per transaction, so watcher updates get the database in between
+SCAN_BATCH_ROWS = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    arrival REAL,
+    probed INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    width INTEGER,
+    height INTEGER,
+    video_codec TEXT,
+    processed INTEGER NOT NULL DEFAULT 0,
+    queued INTEGER NOT NULL DEFAULT 0,
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_when ON files (coalesce(arrival, mtime));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _signature(path):
+    """Size and mtime of a state file, to notice when it changed."""
+    try:
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    except (OSError, TypeError):
+        return ""
+
+
+def parse_when(value):
+    """Epoch seconds from `2025-07-01` or `2025-07-01 13:00[:00]`."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{value}', expected YYYY-MM-DD[ HH:MM[:SS]]")
+
+
+class MediaCatalog:
+    """
+    Persistent index of the videos in the AutoPublish directory.
+
+    Rows hold each file's size and mtime, the arrival time from its name, the
+    cached probe summary, and its ledger and queue state. Files are added and
+    removed one at a time from watcher events (`update`), with `scan` as the
+    full reconcile. Ledger and queue state are re-read only when
+    processed.csv, the queue, the scheduler state or the failed list changed
+    since the last query.
+    """
+
+    def __init__(self, db_path=DEFAULT_CATALOG, root=None, processed_path=None, queue_path=None,
+                 queue_state_path=None, failed_list=None, probe_cache_dir=DEFAULT_PROBE_CACHE_DIR,
+                 speculative_dir=DEFAULT_SPECULATIVE_DIR):
+        self.db_path = db_path
+        self.root = root
+        self.processed_path = processed_path
+        self.ledger = Ledger(processed_path) if processed_path else None
+        self.queue_path = queue_path
+        self.queue_state_path = queue_state_path
+        self.failed_list = failed_list
+        self.probe_cache_dir = probe_cache_dir
+        self.speculative_dir = speculative_dir
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        # The watcher writes while searches read
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _probe_fields(self, path, probe):
+        summary = probe_video(path, cache_dir=self.probe_cache_dir, speculative_dir=self.speculative_dir) if probe else \
+            load_cached_probe(path, cache_dir=self.probe_cache_dir)
+        if not summary:
+            return {"probed": 1 if probe else 0, "duration": None, "width": None, "height": None, "video_codec": None}
+        return {
+            "probed": 1,
+            "duration": summary.get("duration"),
+            "width": summary.get("width"),
+            "height": summary.get("height"),
+            "video_codec": summary.get("video_codec"),
+        }
+
+    def _upsert(self, path, stat, probe=False):
+        name = os.path.basename(path)
+        arrival = parse_arrival(name)
+        fields = {
+            "path": path,
+            "name": name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "arrival": arrival.timestamp() if arrival else None,
+            **self._probe_fields(path, probe),
+        }
+        columns = ", ".join(fields)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in fields if column != "path")
+        self.db.execute(
+            f"INSERT INTO files ({columns}) VALUES ({', '.join('?' * len(fields))}) "
+            f"ON CONFLICT (path) DO UPDATE SET {updates}",
+            list(fields.values()),
+        )
+
+    def update(self, path, probe=False):
+        """
+        Reflect one watcher event: add or refresh the file, or drop it if it is gone.
+
+        Returns:
+            str: "added", "updated", "unchanged", "removed" or "ignored".
+        """
+        path = os.path.abspath(path)
+        name = os.path.basename(path)
+        row = self.db.execute("SELECT size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or not VIDEO_PATTERN.match(name) or name.startswith('.'):
+            if row is None:
+                return "ignored"
+            with self.db:
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                self._mark_root()
+            return "removed"
+        if row is not None and row["size"] == stat.st_size and row["mtime"] == stat.st_mtime:
+            return "unchanged"
+        with self.db:
+            self._upsert(path, stat, probe)
+            self._mark_root()
+        self._invalidate_state()
+        return "updated" if row is not None else "added"
+
+    def _mark_root(self):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('root_signature', ?)", (_signature(self.root),))
+
+    def stale(self):
+        """
+        Whether the directory changed since the catalog last saw it.
+
+        Watcher events keep this false; it turns true when files came or went
+        while the watcher was not running, and a scan catches up.
+        """
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'root_signature'").fetchone()
+        return row is None or row["value"] != _signature(self.root)
+
+    def scan(self, probe=False):
+        """
+        Reconcile the catalog with the directory (the full, slow path).
+
+        Changes are committed every SCAN_BATCH_ROWS rows rather than in one
+        transaction over the whole walk; the root is only marked as seen once
+        the walk completes, so an interrupted scan is simply run again.
+
+        Returns:
+            dict: Counts of added, updated and removed files.
+        """
+        known = {row["path"]: (row["size"], row["mtime"])
+                 for row in self.db.execute("SELECT path, size, mtime FROM files")}
+        counts = {"added": 0, "updated": 0, "removed": 0}
+        seen = set()
+        pending = 0
+
+        def written():
+            nonlocal pending
+            pending += 1
+            if pending >= SCAN_BATCH_ROWS:
+                self.db.commit()
+                pending = 0
+
+        try:
+            for directory, dirs, files in os.walk(self.root):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for name in files:
+                    if name.startswith('.') or not VIDEO_PATTERN.match(name):
+                        continue
+                    path = os.path.abspath(os.path.join(directory, name))
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    seen.add(path)
+                    previous = known.get(path)
+                    if previous == (stat.st_size, stat.st_mtime):
+                        if probe:
+                            self._probe_missing([path])
+                            written()
+                        continue
+                    self._upsert(path, stat, probe)
+                    counts["updated" if previous else "added"] += 1
+                    written()
+            for path in set(known) - seen:
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                counts["removed"] += 1
+                written()
+            self._mark_root()
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        self._invalidate_state()
+        return counts
+
+    def _probe_missing(self, paths):
+        for path in paths:
+            row = self.db.execute("SELECT probed FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and not row["probed"]:
+                fields = self._probe_fields(path, probe=True)
+                self.db.execute(
+                    f"UPDATE files SET {', '.join(f'{c} = ?' for c in fields)} WHERE path = ?",
+                    [*fields.values(), path],
+                )
+
+    def _invalidate_state(self):
+        with self.db:
+            self.db.execute("DELETE FROM meta WHERE key = 'state_signature'")
+
+    def refresh_state(self, force=False):
+        """Copy ledger and queue state into the catalog if any of their files changed."""
+        signature = "|".join([self.ledger.signature() if self.ledger else ""] + [_signature(p) for p in (
+            self.queue_path, self.queue_state_path, self.failed_list)])
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'state_signature'").fetchone()
+        if not force and row is not None and row["value"] == signature:
+            return False
+
+        # Sealed ledger segments count too, so rotated entries stay processed
+        processed = set(self.ledger.names()) if self.ledger else set()
+        queued = {os.path.abspath(path): priority for path, priority in read_queue(self.queue_path)} \
+            if self.queue_path else {}
+        state = {os.path.abspath(path): entry for path, entry in load_state(self.queue_state_path).items()} \
+            if self.queue_state_path else {}
+        failed = set()
+        if self.failed_list and os.path.exists(self.failed_list):
+            with open(self.failed_list) as f:
+                failed = {os.path.abspath(line.strip()) for line in f if line.strip()}
+
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS ledger (name TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM ledger")
+            self.db.executemany("INSERT OR IGNORE INTO ledger VALUES (?)", ((name,) for name in processed))
+            self.db.execute("UPDATE files SET processed = name IN (SELECT name FROM ledger), "
+                            "queued = 0, priority = 0, attempts = 0, last_error = NULL, failed = 0")
+            self.db.executemany("UPDATE files SET queued = 1, priority = ? WHERE path = ?",
+                                ((priority, path) for path, priority in queued.items()))
+            self.db.executemany("UPDATE files SET attempts = ?, last_error = ? WHERE path = ?",
+                                ((entry.get("attempts", 0), entry.get("last_error") or None, path)
+                                 for path, entry in state.items()))
+            self.db.executemany("UPDATE files SET failed = 1 WHERE path = ?", ((path,) for path in failed))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('state_signature', ?)", (signature,))
+        return True
+
+    def search(self, text=None, glob=None, since=None, until=None, processed=None, queued=None,
+               failed=None, min_duration=None, max_duration=None, limit=None, probe_missing=True):
+        """
+        Find videos by name and properties.
+
+        Args:
+            text (str, optional): Substring of the name (case-sensitive, like find -name "*text*").
+            glob (str, optional): Glob on the name.
+            since, until (float, optional): Epoch bounds on the arrival time from the
+                name, or the mtime for names without a timestamp.
+            processed, queued, failed (bool, optional): Ledger and queue state filters.
+            min_duration, max_duration (float, optional): Duration bounds in seconds;
+                unprobed candidates are probed first when probe_missing is set.
+            limit (int, optional): Maximum number of results.
+
+        Returns:
+            list: sqlite3.Row objects ordered by arrival.
+        """
+        self.refresh_state()
+        clauses, params = [], []
+        if text:
+            clauses.append("instr(name, ?) > 0")
+            params.append(text)
+        if glob:
+            clauses.append("name GLOB ?")
+            params.append(glob)
+        if since is not None:
+            clauses.append("coalesce(arrival, mtime) >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("coalesce(arrival, mtime) < ?")
+            params.append(until)
+        for column, value in (("processed", processed), ("queued", queued), ("failed", failed)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(int(value))
+
+        if probe_missing and (min_duration is not None or max_duration is not None):
+            where = " AND ".join(clauses + ["probed = 0"]) or "probed = 0"
+            unprobed = [row["path"] for row in self.db.execute(f"SELECT path FROM files WHERE {where}", params)]
+            if unprobed:
+                with self.db:
+                    self._probe_missing(unprobed)
+        if min_duration is not None:
+            clauses.append("duration >= ?")
+            params.append(min_duration)
+        if max_duration is not None:
+            clauses.append("duration <= ?")
+            params.append(max_duration)
+
+        query = "SELECT * FROM files"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY coalesce(arrival, mtime), name"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return self.db.execute(query, params).fetchall()
+
+    def stats(self):
+        self.refresh_state()
+        return dict(self.db.execute(
+            "SELECT count(*) AS files, coalesce(sum(size), 0) AS bytes, sum(processed) AS processed, "
+            "sum(queued) AS queued, sum(failed) AS failed, sum(probed) AS probed FROM files"
+        ).fetchone())
+
+
+def _format_row(row):
+    when = datetime.fromtimestamp(row["arrival"] or row["mtime"]).strftime('%Y-%m-%d %H:%M')
+    duration = f"{row['duration']:.0f}s" if row["duration"] is not None else "?"
+    state = "processed" if row["processed"] else "failed" if row["failed"] else \
+        f"queued({row['attempts']})" if row["queued"] else "new"
+    return f"{when}  {row['size'] / 1024 ** 2:>8.1f} MB  {duration:>6}  {state:<10}  {row['path']}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalog and search the AutoPublish directory")
+    parser.add_argument('--db', default=DEFAULT_CATALOG, help="Catalog database")
+    parser.add_argument('--root', default=os.path.expanduser('~/AutoPublishDATA/AutoPublish'),
+                        help="AutoPublish directory")
+    parser.add_argument('--ledger', help="processed.csv ledger")
+    parser.add_argument('--queue', help="queue_list.txt")
+    parser.add_argument('--queue-state', help="Scheduler state file")
+    parser.add_argument('--failed-list', help="Failed list")
+    parser.add_argument('--probe-cache-dir', default=DEFAULT_PROBE_CACHE_DIR, help="Probe cache directory")
+    parser.add_argument('--speculative-dir', default=DEFAULT_SPECULATIVE_DIR,
+                        help="Results checked while files were still syncing")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan_parser = subparsers.add_parser('scan', help="Reconcile the catalog with the directory")
+    scan_parser.add_argument('--probe', action='store_true', help="Also probe files without a cached probe")
+    update_parser = subparsers.add_parser('update', help="Refresh (or drop) the given files, e.g. from watcher events")
+    update_parser.add_argument('paths', nargs='+')
+    subparsers.add_parser('stats', help="Catalog totals")
+
+    search_parser = subparsers.add_parser('search', help="Find videos")
+    search_parser.add_argument('text', nargs='?', help="Substring of the name, or a glob if it contains * ? or [")
+    search_parser.add_argument('--since', type=parse_when, help="Arrived on or after (YYYY-MM-DD[ HH:MM])")
+    search_parser.add_argument('--until', type=parse_when, help="Arrived before")
+    state_group = search_parser.add_mutually_exclusive_group()
+    state_group.add_argument('--unprocessed', dest='processed', action='store_false', default=None)
+    state_group.add_argument('--processed', dest='processed', action='store_true')
+    search_parser.add_argument('--queued', dest='queued', action='store_true', default=None)
+    search_parser.add_argument('--not-queued', dest='queued', action='store_false')
+    search_parser.add_argument('--failed', action='store_true', default=None)
+    search_parser.add_argument('--min-duration', type=float, help="Seconds")
+    search_parser.add_argument('--max-duration', type=float, help="Seconds")
+    search_parser.add_argument('--limit', type=int)
+    search_parser.add_argument('--print0', action='store_true', help="NUL-separated paths only")
+
+    args = parser.parse_args()
+    catalog = MediaCatalog(args.db, args.root, args.ledger, args.queue, args.queue_state,
+                           args.failed_list, args.probe_cache_dir, args.speculative_dir)
+    if args.command == 'scan':
+        print(catalog.scan(probe=args.probe))
+    elif args.command == 'update':
+        for path in args.paths:
+            print(f"{catalog.update(path)}: {path}")
+    elif args.command == 'stats':
+        print(catalog.stats())
+    else:
+        if catalog.stale():
+            catalog.scan()
+        text = args.text
+        glob = text if text and any(c in text for c in '*?[') else None
+        rows = catalog.search(
+            None if glob else text, glob, args.since, args.until, args.processed, args.queued,
+            args.failed, args.min_duration, args.max_duration, args.limit,
+        )
+        if args.print0:
+            sys.stdout.write(''.join(f"{row['path']}\0" for row in rows))
+        else:
+            for row in rows:
+                print(_format_row(row))
+            print(f"{len(rows)} files", file=sys.stderr)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# media_probe.py - Cached ffprobe summaries for AutoPub Monitor
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+
+from media_runner import run_media_command
+from mp4_boxes import parse_mp4
+
+DEFAULT_PROBE_CACHE_DIR = os.path.expanduser('~/AutoPublishDATA/probe_cache')
+DEFAULT_SPECULATIVE_DIR = os.path.expanduser('~/AutoPublishDATA/speculative_probe')
+
+# Content fingerprints hash the size plus evenly spaced samples of the file
+FINGERPRINT_SAMPLES = 8
+FINGERPRINT_SAMPLE_BYTES = 64 * 1024
+
+
+def _cache_entry_path(video_path, cache_dir, kind="summary"):
+    """Return the cache file used for one kind of probe result of a video path."""
+    key = hashlib.sha1(os.path.realpath(video_path).encode('utf-8')).hexdigest()
+    suffix = "" if kind == "summary" else f".{kind}"
+    return os.path.join(cache_dir, f"{key}{suffix}.json")
+
+
+def _file_signature(video_path):
+    """Size and mtime identify one version of a file on disk."""
+    stat = os.stat(video_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def content_fingerprint(video_path, samples=FINGERPRINT_SAMPLES, sample_bytes=FINGERPRINT_SAMPLE_BYTES):
+    """
+    Identify a file by its content rather than its path.
+
+    Hashes the size plus the head, the tail and evenly spaced chunks between
+    them, so the fingerprint survives renames, hardlinks and copies while
+    reading well under a megabyte of even a multi-gigabyte clip.
+
+    Args:
+        video_path (str): Path to the file.
+        samples (int): Number of chunks hashed (at least 2).
+        sample_bytes (int): Size of each chunk.
+
+    Returns:
+        str: Hex digest.
+    """
+    size = os.path.getsize(video_path)
+    digest = hashlib.sha1(str(size).encode('ascii'))
+    with open(video_path, 'rb') as f:
+        if size <= samples * sample_bytes:
+            digest.update(f.read())
+        else:
+            for index in range(samples):
+                f.seek((size - sample_bytes) * index // (samples - 1))
+                digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+
+def load_speculative(video_path, speculative_dir=DEFAULT_SPECULATIVE_DIR):
+    """
+    Return the checks done on this content while it was still syncing, if any.
+
+    Args:
+        video_path (str): Path to the video.
+        speculative_dir (str): Directory of speculative results, keyed by fingerprint.
+
+    Returns:
+        dict or None: Entry with "summary", "issues" and "needs_fixing", or None
+        when nothing was checked ahead for this content.
+    """
+    if not os.path.isdir(speculative_dir):
+        return None
+    try:
+        fingerprint = content_fingerprint(video_path)
+        with open(os.path.join(speculative_dir, f"{fingerprint}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_speculative(fingerprint, entry, speculative_dir=DEFAULT_SPECULATIVE_DIR):
+    """Write a speculative result for a content fingerprint atomically."""
+    os.makedirs(speculative_dir, exist_ok=True)
+    entry_path = os.path.join(speculative_dir, f"{fingerprint}.json")
+    temp_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(temp_path, entry_path)
+
+
+def _parse_frame_rate(rate):
+    try:
+        num, den = rate.split('/')
+        return float(num) / float(den) if float(den) else None
+    except (AttributeError, ValueError):
+        return None
+
+
+def summarize_probe(probe_info):
+    """
+    Reduce raw `ffprobe -show_format -show_streams` JSON to the fields the pipeline uses.
+
+    Args:
+        probe_info (dict): Parsed ffprobe JSON output.
+
+    Returns:
+        dict: Summary with duration, dimensions, codecs and color metadata.
+    """
+    streams = probe_info.get('streams', [])
+    fmt = probe_info.get('format', {})
+    video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+
+    duration = fmt.get('duration') or video.get('duration')
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        duration = None
+
+    return {
+        "duration": duration,
+        "format_name": fmt.get('format_name'),
+        "bit_rate": int(fmt['bit_rate']) if str(fmt.get('bit_rate', '')).isdigit() else None,
+        "width": video.get('width'),
+        "height": video.get('height'),
+        "video_codec": video.get('codec_name'),
+        "pix_fmt": video.get('pix_fmt'),
+        "color_space": video.get('color_space'),
+        "color_primaries": video.get('color_primaries'),
+        "frame_rate": _parse_frame_rate(video.get('avg_frame_rate')),
+        "has_audio": bool(audio),
+        "audio_codec": audio.get('codec_name'),
+    }
+
+
+def run_ffprobe(video_path):
+    """Run ffprobe on a file and return the summary, or None if it cannot be parsed."""
+    probe_cmd = [
+        'ffprobe', '-v', 'quiet', '-print_format', 'json',
+        '-show_format', '-show_streams', str(video_path)
+    ]
+    try:
+        result = run_media_command(probe_cmd, capture_stdout=True, check=True, timeout=120)
+        return summarize_probe(json.loads(result.stdout))
+    except (subprocess.SubprocessError, FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def read_summary(video_path):
+    """
+    Summarize a video without the cache.
+
+    MP4/MOV files are read from their boxes in-process (mp4_boxes.py); other
+    containers and files the box parser rejects go through ffprobe.
+
+    Returns:
+        dict or None: Probe summary, or None if the file cannot be probed.
+    """
+    summary = parse_mp4(video_path)
+    return summary if summary is not None else run_ffprobe(video_path)
+
+
+def load_cached_probe(video_path, cache_dir=DEFAULT_PROBE_CACHE_DIR, kind="summary"):
+    """
+    Return the cached summary for a file if it still matches the file on disk.
+
+    Args:
+        video_path (str): Path to the video.
+        cache_dir (str): Directory holding cached probe results.
+        kind (str): Which probe result to load ("summary" or "keyframes").
+
+    Returns:
+        dict or None: Cached summary, or None on a miss or a stale entry.
+    """
+    try:
+        signature = _file_signature(video_path)
+        with open(_cache_entry_path(video_path, cache_dir, kind)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if entry.get("signature") != signature:
+        return None
+    return entry.get("summary")
+
+
+def store_cached_probe(video_path, summary, cache_dir=DEFAULT_PROBE_CACHE_DIR, kind="summary"):
+    """Write a probe summary to the cache atomically."""
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = _cache_entry_path(video_path, cache_dir, kind)
+    entry = {
+        "path": os.path.realpath(video_path),
+        "signature": _file_signature(video_path),
+        "summary": summary,
+    }
+    temp_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(temp_path, entry_path)
+
+
+def probe_video(video_path, cache_dir=DEFAULT_PROBE_CACHE_DIR, use_cache=True,
+                speculative_dir=DEFAULT_SPECULATIVE_DIR):
+    """
+    Probe a video, reusing the cached summary when the file is unchanged.
+
+    On a cache miss the summary taken while the file was still syncing is used
+    when one exists for the same content (see speculative_probe.py).
+
+    Args:
+        video_path (str): Path to the video.
+        cache_dir (str): Directory holding cached probe results.
+        use_cache (bool): Read and write the cache.
+        speculative_dir (str): Directory of speculative results to consult on a miss.
+
+    Returns:
+        dict or None: Probe summary, or None if the file cannot be probed.
+    """
+    summary = None
+    if use_cache:
+        summary = load_cached_probe(video_path, cache_dir)
+        if summary is not None:
+            return summary
+        speculative = load_speculative(video_path, speculative_dir)
+        summary = speculative.get("summary") if speculative else None
+
+    if summary is None:
+        summary = read_summary(video_path)
+    if summary is not None and use_cache:
+        try:
+            store_cached_probe(video_path, summary, cache_dir)
+        except OSError as e:
+            print(f"Warning: Unable to cache probe for {video_path}: {e}", file=sys.stderr)
+    return summary
+
+
+def run_keyframe_probe(video_path):
+    """
+    List keyframe timestamps of the first video stream.
+
+    Reads packet flags only, so no frame is decoded.
+
+    Returns:
+        list or None: Sorted keyframe times in seconds, or None if ffprobe fails.
+    """
+    probe_cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', str(video_path)
+    ]
+    try:
+        result = run_media_command(probe_cmd, capture_stdout=True, check=True, timeout=600)
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return None
+
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                keyframes.append(float(pts_time))
+            except ValueError:
+                continue
+    return sorted(set(keyframes))
+
+
+def probe_keyframes(video_path, cache_dir=DEFAULT_PROBE_CACHE_DIR, use_cache=True):
+    """
+    Keyframe index of a video, cached alongside the probe summary.
+
+    Returns:
+        list or None: Keyframe times in seconds, or None if the file cannot be probed.
+    """
+    if use_cache:
+        keyframes = load_cached_probe(video_path, cache_dir, kind="keyframes")
+        if keyframes is not None:
+            return keyframes
+
+    keyframes = run_keyframe_probe(video_path)
+    if keyframes is not None and use_cache:
+        try:
+            store_cached_probe(video_path, keyframes, cache_dir, kind="keyframes")
+        except OSError as e:
+            print(f"Warning: Unable to cache keyframes for {video_path}: {e}", file=sys.stderr)
+    return keyframes
+
+
+def estimate_processing_cost(summary, seconds_per_hd_second=1.0, fixed_overhead=30.0, default_cost=120.0):
+    """
+    Estimate how many seconds a video will occupy the pipeline.
+
+    The estimate scales the clip duration by its pixel count relative to 1080p,
+    so a 4K clip costs four times an HD clip of the same length.
+
+    Args:
+        summary (dict or None): Probe summary from probe_video.
+        seconds_per_hd_second (float): Processing seconds per second of 1080p video.
+        fixed_overhead (float): Per-job cost independent of the clip (upload setup, publish).
+        default_cost (float): Cost used when the clip could not be probed.
+
+    Returns:
+        float: Estimated processing time in seconds.
+    """
+    if not summary or not summary.get("duration"):
+        return default_cost
+    width = summary.get("width") or 1920
+    height = summary.get("height") or 1080
+    pixel_scale = (width * height) / (1920 * 1080)
+    return fixed_overhead + summary["duration"] * pixel_scale * seconds_per_hd_second
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the cached probe summary for videos")
+    parser.add_argument('paths', nargs='+', help="Video files to probe")
+    parser.add_argument('--cache-dir', default=DEFAULT_PROBE_CACHE_DIR, help="Probe cache directory")
+    parser.add_argument('--no-cache', action='store_true', help="Bypass the probe cache")
+    parser.add_argument('--speculative-dir', default=DEFAULT_SPECULATIVE_DIR,
+                        help="Results checked while files were still syncing")
+    parser.add_argument('--check', action='store_true',
+                        help="Print nothing; exit 1 if any file cannot be probed")
+    args = parser.parse_args()
+
+    unreadable = False
+    for path in args.paths:
+        summary = probe_video(path, cache_dir=args.cache_dir, use_cache=not args.no_cache,
+                              speculative_dir=args.speculative_dir)
+        unreadable = unreadable or summary is None
+        if not args.check:
+            print(json.dumps({"path": path, "summary": summary}))
+    sys.exit(1 if args.check and unreadable else 0)
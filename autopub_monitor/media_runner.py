@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# media_runner.py - Shared runner for ffmpeg, ffprobe and HandBrakeCLI
+
+import os
+import re
+import signal
+import time
+import threading
+import subprocess
+from collections import deque
+from dataclasses import dataclass, field
+
+import resource_accounting
+
+DEFAULT_TAIL_LINES = 200
+_HANDBRAKE_PROGRESS = re.compile(r'Encoding: task \d+ of \d+, ([\d.]+) %')
+
+
+class CommandCancelled(RuntimeError):
+    """The command was stopped through its cancel event."""
+
+
+class MediaCommandError(subprocess.CalledProcessError):
+    """A media command exited with a non-zero code; stderr holds the last lines of its log."""
+
+    def __str__(self):
+        tail = (self.stderr or '').strip().splitlines()[-5:]
+        message = super().__str__()
+        return message + ('\n' + '\n'.join(tail) if tail else '')
+
+
+@dataclass
+class RunResult:
+    """Outcome of a media command."""
+    args: list
+    returncode: int
+    stdout: str = ''
+    tail: list = field(default_factory=list)
+    progress: dict = field(default_factory=dict)
+    elapsed: float = 0.0
+    suspended: float = 0.0
+    usage: dict = field(default_factory=dict)
+
+    @property
+    def stderr(self):
+        """Last lines of the command's log output."""
+        return '\n'.join(self.tail)
+
+    def find_pattern(self, patterns):
+        """Return the first pattern that occurs in the retained log lines, or None."""
+        for pattern in patterns:
+            if any(pattern in line for line in self.tail):
+                return pattern
+        return None
+
+
+def _read_stderr(stream, tail):
+    for line in stream:
+        tail.append(line.rstrip('\n'))
+
+
+def _read_ffmpeg_progress(stream, progress, callback):
+    """Parse `-progress pipe:1` blocks of key=value lines, each ending with progress=..."""
+    block = {}
+    for line in stream:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        block[key] = value
+        if key == 'progress':
+            try:
+                block['out_time_seconds'] = int(block.get('out_time_us') or block.get('out_time_ms') or 0) / 1e6
+            except ValueError:
+                pass
+            progress.clear()
+            progress.update(block)
+            if callback:
+                callback(dict(block))
+            block = {}
+
+
+def _read_handbrake_progress(stream, progress, callback):
+    """Parse HandBrakeCLI's `Encoding: task 1 of 1, 45.30 %` status lines."""
+    for line in stream:
+        match = _HANDBRAKE_PROGRESS.search(line)
+        if match:
+            progress['percent'] = float(match.group(1))
+            if callback:
+                callback(dict(progress))
+
+
+def _reap(process, block=False):
+    """
+    Reap the child with wait4 so its resource usage is not lost to Popen's waitpid.
+
+    Returns:
+        resource.struct_rusage or None: The child's usage, or None if it is still running.
+    """
+    pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def _stop(process, grace=5.0):
+    # A stopped child would not act on SIGTERM until continued
+    process.send_signal(signal.SIGCONT)
+    process.terminate()
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        rusage = _reap(process)
+        if rusage is not None:
+            return rusage
+        time.sleep(0.1)
+    process.kill()
+    return _reap(process, block=True)
+
+
+def _account(args, start_time, rusage, returncode, suspended=0.0):
+    """Charge a reaped command to the current job and stage; returns its usage."""
+    wall = time.monotonic() - start_time
+    resource_accounting.record_process(args, wall, rusage, returncode, suspended)
+    return {"wall": wall, "suspended": suspended, **resource_accounting.usage_from_rusage(rusage)}
+
+
+def run_media_command(
+    args,
+    timeout=None,
+    check=False,
+    capture_stdout=False,
+    progress=None,
+    progress_callback=None,
+    cancel_event=None,
+    tail_lines=DEFAULT_TAIL_LINES,
+    preexec_fn=None,
+    poll_interval=0.2,
+    suspend_check=None,
+):
+    """
+    Run ffmpeg, ffprobe or HandBrakeCLI without a shell and without holding
+    the whole log in memory.
+
+    stderr is streamed into a ring buffer of the last `tail_lines` lines, which
+    is enough for error-pattern matching and error messages even for
+    HandBrake's verbose logs. The child is reaped with wait4 and its CPU time,
+    peak RSS and block I/O are charged to the current job and stage (see
+    resource_accounting).
+
+    An encode can be preempted: while `suspend_check()` returns true the child
+    is stopped with SIGSTOP, and SIGCONT resumes it where it left off. Time
+    spent stopped does not count towards the timeout and is reported as
+    `suspended`.
+
+    Args:
+        args (list): Command and arguments; strings are rejected to rule out shells.
+        timeout (float, optional): Seconds before the command is stopped and
+            subprocess.TimeoutExpired is raised.
+        check (bool): Raise MediaCommandError on a non-zero exit code.
+        capture_stdout (bool): Return stdout (e.g. ffprobe JSON). Not combinable with progress.
+        progress (str, optional): "ffmpeg" adds `-progress pipe:1` and parses it;
+            "handbrake" parses HandBrakeCLI's status lines on stdout.
+        progress_callback (callable, optional): Called with each progress snapshot.
+        cancel_event (threading.Event, optional): Stops the command when set and
+            raises CommandCancelled.
+        tail_lines (int): Log lines kept for pattern matching.
+        preexec_fn (callable, optional): Run in the child before exec (CPU pinning, niceness).
+        poll_interval (float): Seconds between timeout/cancellation checks.
+        suspend_check (callable, optional): Returns True while the command should
+            be paused (see EncodeSlot.suspend_check).
+
+    Returns:
+        RunResult: Exit code, captured stdout, log tail, last progress snapshot and resource usage.
+    """
+    if isinstance(args, str):
+        raise TypeError("run_media_command takes an argument list, not a shell string")
+    if capture_stdout and progress:
+        raise ValueError("capture_stdout and progress both need stdout")
+
+    args = [str(arg) for arg in args]
+    if progress == 'ffmpeg':
+        args = args[:1] + ['-progress', 'pipe:1', '-nostats'] + args[1:]
+
+    start_time = time.monotonic()
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE if (capture_stdout or progress) else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors='replace',
+        preexec_fn=preexec_fn,
+    )
+
+    tail = deque(maxlen=tail_lines)
+    snapshot = {}
+    stdout_chunks = []
+    readers = [threading.Thread(target=_read_stderr, args=(process.stderr, tail), daemon=True)]
+    if progress == 'ffmpeg':
+        readers.append(threading.Thread(
+            target=_read_ffmpeg_progress, args=(process.stdout, snapshot, progress_callback), daemon=True))
+    elif progress == 'handbrake':
+        readers.append(threading.Thread(
+            target=_read_handbrake_progress, args=(process.stdout, snapshot, progress_callback), daemon=True))
+    elif capture_stdout:
+        readers.append(threading.Thread(
+            target=lambda: stdout_chunks.append(process.stdout.read()), daemon=True))
+    for reader in readers:
+        reader.start()
+
+    deadline = None if timeout is None else start_time + timeout
+    suspended = 0.0
+    stopped_at = None
+    while True:
+        rusage = _reap(process)
+        if rusage is not None:
+            break
+        if cancel_event is not None and cancel_event.is_set():
+            if stopped_at is not None:
+                suspended += time.monotonic() - stopped_at
+            _account(args, start_time, _stop(process), process.returncode, suspended)
+            raise CommandCancelled(f"Cancelled: {' '.join(args[:2])}")
+        if suspend_check is not None:
+            if stopped_at is None and suspend_check():
+                process.send_signal(signal.SIGSTOP)
+                stopped_at = time.monotonic()
+                print(f"   Suspended {os.path.basename(args[0])} for a higher-priority encode")
+            elif stopped_at is not None and not suspend_check():
+                process.send_signal(signal.SIGCONT)
+                paused = time.monotonic() - stopped_at
+                suspended += paused
+                stopped_at = None
+                if deadline is not None:
+                    deadline += paused
+                print(f"   Resumed {os.path.basename(args[0])} after {paused:.0f}s")
+        if stopped_at is None and deadline is not None and time.monotonic() > deadline:
+            _account(args, start_time, _stop(process), process.returncode, suspended)
+            raise subprocess.TimeoutExpired(args, timeout, stderr='\n'.join(tail))
+        time.sleep(poll_interval)
+
+    for reader in readers:
+        reader.join()
+
+    result = RunResult(
+        args=args,
+        returncode=process.returncode,
+        stdout=''.join(stdout_chunks),
+        tail=list(tail),
+        progress=snapshot,
+        elapsed=time.monotonic() - start_time,
+        suspended=suspended,
+        usage=_account(args, start_time, rusage, process.returncode, suspended),
+    )
+    if check and result.returncode != 0:
+        raise MediaCommandError(result.returncode, args, output=result.stdout, stderr=result.stderr)
+    return result
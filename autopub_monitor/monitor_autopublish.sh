@@ -15,6 +15,13 @@ touch "${TEMP_QUEUE}"
 touch "${CHECKED_LIST}"
 touch "${QUEUE_LOCK}"
 
+# Whether a file parses as a video. MP4/MOV files are read from their boxes
+# without starting ffprobe; the summary is cached for the queue scheduler.
+probe_check() {
+    python3 "${MEDIA_PROBE_PY}" --check --cache-dir "${PROBE_CACHE_DIR}" \
+        --speculative-dir "${SPECULATIVE_DIR}" "$1" 2>/dev/null
+}
+
 check_and_queue_file() {
     local full_path=$1
 
@@ -26,7 +33,7 @@ check_and_queue_file() {
 
     local file_size=$(stat -c %s "$full_path")
 
-    if [ "$file_size" -eq 0 ] || ! ffprobe -v error -show_entries format=filename -of default=noprint_wrappers=1:nokey=1 "$full_path" > /dev/null; then
+    if [ "$file_size" -eq 0 ] || ! probe_check "$full_path"; then
         sleep 3 # Wait before moving to TEMP_QUEUE
         handle_potential_conflict_file "$full_path"
     else
@@ -56,7 +63,7 @@ handle_potential_conflict_file() {
 
     # Search for conflict files, considering variable timestamp and NSConflict marker
     for file in "$directory"/*; do
-        if [[ "$file" =~ ${prefix}-NSConflict-.* ]] && ffprobe -v error -show_entries format=filename -of default=noprint_wrappers=1:nokey=1 "$file" > /dev/null; then
+        if [[ "$file" =~ ${prefix}-NSConflict-.* ]] && probe_check "$file"; then
             echo_with_timestamp "Valid conflict version found: $file. Original file $original_file_path will be skipped from further processing."
             # Mark original file as checked (invalid)
             echo "$original_file_path" >> "${CHECKED_LIST}"
@@ -69,6 +76,12 @@ handle_potential_conflict_file() {
     echo "$original_file_path" >> "$TEMP_QUEUE"
 }
 
+# Keep the media catalog in step with the directory
+catalog_update() {
+    python3 "${MEDIA_CATALOG_PY}" --db "${MEDIA_CATALOG_DB}" --root "${AUTOPUBLISH_DIR}" \
+        --probe-cache-dir "${PROBE_CACHE_DIR}" --speculative-dir "${SPECULATIVE_DIR}" update "$1" > /dev/null
+}
+
 monitor_temp_queue() {
     while true; do
         if [ ! -s "$TEMP_QUEUE" ]; then
@@ -90,7 +103,7 @@ monitor_temp_queue() {
 
 monitor_temp_queue &
 
-inotifywait -m -e close_write -e moved_to "$AUTOPUBLISH_DIR" |
+inotifywait -m -e close_write -e moved_to -e delete -e moved_from "$AUTOPUBLISH_DIR" |
 while read -r directory events filename; do
     if [[ "$filename" =~ ^\..*\..*\..*$ ]]; then
         echo_with_timestamp "Skipping temporary or system file: $filename"
@@ -98,6 +111,10 @@ while read -r directory events filename; do
     fi
 
     full_path="${directory}${filename}"
+    catalog_update "$full_path"
+    if [[ "$events" == *DELETE* || "$events" == *MOVED_FROM* ]]; then
+        continue
+    fi
     echo_with_timestamp "Significant change detected: $full_path"
     check_and_queue_file "$full_path"
 done
\ No newline at end of file
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# mp4_boxes.py - Read duration and stream metadata from MP4/MOV boxes without ffprobe
+
+import os
+import sys
+import mmap
+import time
+import struct
+import shutil
+import argparse
+import tempfile
+
+# ffprobe's name for the demuxer that handles MP4, MOV and their relatives
+MOV_FORMAT_NAME = "mov,mp4,m4a,3gp,3g2,mj2"
+
+# Boxes an MP4/MOV file can start with; anything else is left to ffprobe
+FIRST_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid'}
+
+VIDEO_CODECS = {
+    b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc', b'hev1': 'hevc', b'dvh1': 'hevc', b'dvhe': 'hevc',
+    b'av01': 'av1', b'vp09': 'vp9', b'mp4v': 'mpeg4', b'jpeg': 'mjpeg',
+    b'apch': 'prores', b'apcn': 'prores', b'apcs': 'prores', b'apco': 'prores', b'ap4h': 'prores',
+    b'ap4x': 'prores',
+}
+AUDIO_CODECS = {
+    b'mp4a': 'aac', b'ac-3': 'ac3', b'ec-3': 'eac3', b'alac': 'alac', b'Opus': 'opus', b'fLaC': 'flac',
+    b'sowt': 'pcm_s16le', b'twos': 'pcm_s16be', b'.mp3': 'mp3',
+}
+# MPEG-4 objectTypeIndication values in esds that are not AAC
+MP4A_OBJECT_TYPES = {0x69: 'mp3', 0x6B: 'mp3', 0xA5: 'ac3', 0xA6: 'eac3', 0xAD: 'opus'}
+
+# ISO/IEC 23091-2 code points, spelled as ffprobe prints them
+COLOR_PRIMARIES = {
+    1: 'bt709', 3: 'reserved', 4: 'bt470m', 5: 'bt470bg', 6: 'smpte170m', 7: 'smpte240m', 8: 'film',
+    9: 'bt2020', 10: 'smpte428', 11: 'smpte431', 12: 'smpte432', 22: 'jedec-p22',
+}
+COLOR_SPACES = {
+    0: 'gbr', 1: 'bt709', 3: 'reserved', 4: 'fcc', 5: 'bt470bg', 6: 'smpte170m', 7: 'smpte240m',
+    8: 'ycgco', 9: 'bt2020nc', 10: 'bt2020c', 11: 'smpte2085', 14: 'ictcp',
+}
+CHROMA_FORMATS = {0: 'gray', 1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}
+AVC_HIGH_PROFILES = {100, 110, 122, 144}
+
+# Child boxes start this far into a visual sample entry (after its 8-byte header)
+VISUAL_ENTRY_FIELDS = 78
+AUDIO_ENTRY_FIELDS = {0: 28, 1: 44, 2: 64}
+
+
+class MalformedBox(ValueError):
+    """A box runs past its parent or has an impossible size."""
+
+
+def _iter_boxes(buf, start, end):
+    """Yield (type, payload start, box end) for the boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise MalformedBox(f"truncated {kind!r} header at {offset}")
+            size = struct.unpack_from('>Q', buf, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise MalformedBox(f"{kind!r} box at {offset} runs past its parent")
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def _child(buf, start, end, kind):
+    for child_kind, child_start, child_end in _iter_boxes(buf, start, end):
+        if child_kind == kind:
+            return child_start, child_end
+    return None
+
+
+def _path(buf, start, end, *kinds):
+    """Find a nested box, e.g. _path(buf, s, e, b'mdia', b'minf', b'stbl')."""
+    span = (start, end)
+    for kind in kinds:
+        span = _child(buf, span[0], span[1], kind)
+        if span is None:
+            return None
+    return span
+
+
+def _timescale_duration(buf, start):
+    """Timescale and duration of an mvhd or mdhd box (version 0 or 1)."""
+    if buf[start] == 1:
+        return struct.unpack_from('>IQ', buf, start + 20)
+    return struct.unpack_from('>II', buf, start + 12)
+
+
+def _color(buf, start, end):
+    """
+    Primaries, matrix and full-range flag from a colr box, or None for ICC profiles.
+
+    QuickTime's nclc variant has no range flag, so the flag is None for it.
+    """
+    colour_type = bytes(buf[start:start + 4])
+    if colour_type not in (b'nclx', b'nclc') or start + 10 > end:
+        return None
+    primaries, _transfer, matrix = struct.unpack_from('>HHH', buf, start + 4)
+    full_range = None
+    if colour_type == b'nclx' and start + 11 <= end:
+        full_range = bool(buf[start + 10] & 0x80)
+    return primaries, matrix, full_range
+
+
+def _avc_format(buf, start, end):
+    """Chroma format and luma bit depth from an avcC box."""
+    profile = buf[start + 1]
+    if profile not in AVC_HIGH_PROFILES:
+        return 1, 8
+    offset = start + 5
+    for count_mask in (0x1F, 0xFF):
+        count = buf[offset] & count_mask
+        offset += 1
+        for _ in range(count):
+            offset += 2 + struct.unpack_from('>H', buf, offset)[0]
+    if offset + 2 > end:
+        return None
+    return buf[offset] & 0x03, (buf[offset + 1] & 0x07) + 8
+
+
+def _hevc_format(buf, start, end):
+    """Chroma format and luma bit depth from an hvcC box."""
+    if start + 18 > end:
+        return None
+    return buf[start + 16] & 0x03, (buf[start + 17] & 0x07) + 8
+
+
+def _pix_fmt(codec, sample_format, color):
+    """
+    ffprobe's pixel format name, where the sample description pins it down.
+
+    The range and the RGB matrix are only known from an nclx colr box
+    (otherwise they are in the bitstream's VUI), so without one the format is
+    left unknown.
+    """
+    if sample_format is None or sample_format[0] not in CHROMA_FORMATS or color is None or color[2] is None:
+        return None
+    chroma, depth = sample_format
+    _primaries, matrix, full_range = color
+    name = 'gbrp' if matrix == 0 and chroma == 3 else CHROMA_FORMATS[chroma]
+    if depth > 8:
+        return f"{name}{depth}le"
+    # The h264 and hevc decoders report full-range 8-bit video as the yuvj formats
+    if full_range and chroma and (codec == 'h264' or (codec == 'hevc' and chroma == 1)):
+        return name.replace('yuv', 'yuvj')
+    return name
+
+
+def _esds_codec(buf, start, end):
+    """Codec of an mp4a entry from the objectTypeIndication in its esds box."""
+    offset = start + 4
+    for expected_tag in (0x03, 0x04):
+        if offset >= end or buf[offset] != expected_tag:
+            return 'aac'
+        offset += 1
+        for _ in range(4):
+            offset += 1
+            if not buf[offset - 1] & 0x80:
+                break
+        if expected_tag == 0x03:
+            flags = buf[offset + 2]
+            offset += 3
+            if flags & 0x80:
+                offset += 2
+            if flags & 0x40:
+                offset += 1 + buf[offset]
+            if flags & 0x20:
+                offset += 2
+    return MP4A_OBJECT_TYPES.get(buf[offset], 'aac') if offset < end else 'aac'
+
+
+def _parse_track(buf, start, end):
+    """Handler, codec, dimensions, color and timing of one trak box."""
+    mdia = _child(buf, start, end, b'mdia')
+    if mdia is None:
+        return None
+    hdlr = _child(buf, *mdia, b'hdlr')
+    mdhd = _child(buf, *mdia, b'mdhd')
+    stbl = _path(buf, *mdia, b'minf', b'stbl')
+    if hdlr is None or mdhd is None or stbl is None:
+        return None
+    track = {"handler": bytes(buf[hdlr[0] + 8:hdlr[0] + 12])}
+    timescale, duration = _timescale_duration(buf, mdhd[0])
+    track["duration"] = duration / timescale if timescale else None
+
+    stts = _child(buf, *stbl, b'stts')
+    if stts is not None and duration:
+        entries = struct.unpack_from('>I', buf, stts[0] + 4)[0]
+        if stts[0] + 8 + entries * 8 > stts[1]:
+            raise MalformedBox("stts entries run past the box")
+        samples = sum(struct.unpack_from('>I', buf, stts[0] + 8 + index * 8)[0] for index in range(entries))
+        track["frame_rate"] = samples * timescale / duration
+
+    stsd = _child(buf, *stbl, b'stsd')
+    if stsd is None or stsd[0] + 16 > stsd[1]:
+        return track
+    entry_start = stsd[0] + 8
+    entry_size, fourcc = struct.unpack_from('>I4s', buf, entry_start)
+    entry_end = entry_start + entry_size
+    if entry_size < 16 or entry_end > stsd[1]:
+        raise MalformedBox("sample description runs past stsd")
+    track["fourcc"] = fourcc
+
+    if track["handler"] == b'vide' and entry_start + 8 + VISUAL_ENTRY_FIELDS <= entry_end:
+        codec = VIDEO_CODECS.get(fourcc, fourcc.decode('latin-1').strip())
+        track["codec"] = codec
+        track["width"], track["height"] = struct.unpack_from('>HH', buf, entry_start + 32)
+        sample_format = None
+        color = None
+        for kind, child_start, child_end in _iter_boxes(buf, entry_start + 8 + VISUAL_ENTRY_FIELDS, entry_end):
+            if kind == b'avcC':
+                sample_format = _avc_format(buf, child_start, child_end)
+            elif kind == b'hvcC':
+                sample_format = _hevc_format(buf, child_start, child_end)
+            elif kind == b'colr':
+                color = _color(buf, child_start, child_end) or color
+        primaries, matrix, _full_range = color or (None, None, False)
+        track["color_primaries"] = COLOR_PRIMARIES.get(primaries)
+        track["color_space"] = COLOR_SPACES.get(matrix)
+        track["pix_fmt"] = _pix_fmt(codec, sample_format, color)
+    elif track["handler"] == b'soun':
+        codec = AUDIO_CODECS.get(fourcc, fourcc.decode('latin-1').strip())
+        if fourcc == b'mp4a':
+            version = struct.unpack_from('>H', buf, entry_start + 16)[0]
+            children_start = entry_start + 8 + AUDIO_ENTRY_FIELDS.get(version, 28)
+            if children_start <= entry_end:
+                for kind, child_start, child_end in _iter_boxes(buf, children_start, entry_end):
+                    if kind == b'esds':
+                        codec = _esds_codec(buf, child_start, child_end)
+                    elif kind == b'wave':
+                        esds = _child(buf, child_start, child_end, b'esds')
+                        if esds is not None:
+                            codec = _esds_codec(buf, *esds)
+        track["codec"] = codec
+    return track
+
+
+def _parse(buf, size):
+    moov = None
+    for index, (kind, start, end) in enumerate(_iter_boxes(buf, 0, size)):
+        if index == 0 and kind not in FIRST_BOXES:
+            return None
+        if kind == b'moov':
+            moov = (start, end)
+    if moov is None:
+        return None
+
+    mvhd = _child(buf, *moov, b'mvhd')
+    if mvhd is None:
+        return None
+    timescale, duration = _timescale_duration(buf, mvhd[0])
+    tracks = [track for kind, start, end in _iter_boxes(buf, *moov)
+              if kind == b'trak' for track in [_parse_track(buf, start, end)] if track]
+    seconds = duration / timescale if timescale and duration else None
+    if not seconds:
+        # Fragmented files keep the duration in their fragments; leave them to ffprobe
+        seconds = max((track["duration"] or 0 for track in tracks), default=0) or None
+    if not seconds:
+        return None
+
+    video = next((track for track in tracks if track["handler"] == b'vide' and "codec" in track), {})
+    audio = next((track for track in tracks if track["handler"] == b'soun'), {})
+    return {
+        "duration": seconds,
+        "format_name": MOV_FORMAT_NAME,
+        "bit_rate": int(size * 8 / seconds),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "video_codec": video.get("codec"),
+        "pix_fmt": video.get("pix_fmt"),
+        "color_space": video.get("color_space"),
+        "color_primaries": video.get("color_primaries"),
+        "frame_rate": video.get("frame_rate"),
+        "has_audio": bool(audio),
+        "audio_codec": audio.get("codec"),
+    }
+
+
+def parse_mp4(video_path):
+    """
+    Summarize an MP4/MOV file from its boxes, in the shape of media_probe.summarize_probe.
+
+    The file is memory-mapped and only the box headers and the moov box are
+    touched, so the media data is never read and no process is started.
+
+    Args:
+        video_path (str): Path to the video.
+
+    Returns:
+        dict or None: Probe summary, or None if the file is not MP4/MOV, is
+        malformed or truncated, or is fragmented (use ffprobe for those).
+    """
+    try:
+        with open(video_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 16:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _parse(buf, size)
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+
+def _box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _full_box(kind, payload, version=0):
+    return _box(kind, bytes([version, 0, 0, 0]) + payload)
+
+
+def write_sample_mp4(path, duration=30.0, width=1920, height=1080, fps=30, media_bytes=64 * 1024 ** 2):
+    """
+    Write a MOV-style file (ftyp, mdat, then moov, as phones record them) for benchmarks.
+
+    The media data is a sparse hole, so large files cost nothing to create.
+    """
+    timescale = 600
+    ticks = int(duration * timescale)
+    frames = int(duration * fps)
+    identity = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+    avcc = bytes([1, 100, 0, 40, 0xFF, 0xE1]) + struct.pack('>H', 2) + b'\x67\x64' + \
+        bytes([1]) + struct.pack('>H', 1) + b'\x68' + bytes([0xFD, 0xF8, 0xF8, 0])
+    colr = b'nclx' + struct.pack('>HHH', 1, 1, 1) + bytes([0x80])
+    visual_entry = bytes(6) + struct.pack('>H', 1) + bytes(16) + struct.pack('>HH', width, height) + \
+        struct.pack('>III', 0x480000, 0x480000, 0) + struct.pack('>H', 1) + bytes(32) + \
+        struct.pack('>Hh', 24, -1) + _box(b'avcC', avcc) + _box(b'colr', colr)
+    esds = bytes([0x03, 0x19]) + struct.pack('>H', 1) + bytes([0]) + bytes([0x04, 0x11, 0x40]) + bytes(16)
+    audio_entry = bytes(6) + struct.pack('>H', 1) + bytes(8) + struct.pack('>HHHH', 2, 16, 0, 0) + \
+        struct.pack('>I', 48000 << 16) + _full_box(b'esds', esds)
+
+    def trak(track_id, handler, entry_kind, entry, samples, sample_delta, media_timescale, dims):
+        tkhd = struct.pack('>IIIII', 0, 0, track_id, 0, ticks) + bytes(8) + bytes(8) + identity + dims
+        mdhd = struct.pack('>IIII', 0, 0, media_timescale, samples * sample_delta) + bytes(4)
+        stbl = _box(b'stbl', _full_box(b'stsd', struct.pack('>I', 1) + _box(entry_kind, entry)) +
+                    _full_box(b'stts', struct.pack('>III', 1, samples, sample_delta)))
+        return _box(b'trak', _full_box(b'tkhd', tkhd) + _box(b'mdia', _full_box(b'mdhd', mdhd) +
+                    _full_box(b'hdlr', bytes(4) + handler + bytes(12) + b'\x00') +
+                    _box(b'minf', stbl)))
+
+    mvhd = struct.pack('>IIII', 0, 0, timescale, ticks) + struct.pack('>IH', 0x10000, 0x100) + bytes(10) + \
+        identity + bytes(24) + struct.pack('>I', 3)
+    moov = _box(b'moov', _full_box(b'mvhd', mvhd) +
+                trak(1, b'vide', b'avc1', visual_entry, frames, timescale // fps, timescale,
+                     struct.pack('>II', width << 16, height << 16)) +
+                trak(2, b'soun', b'mp4a', audio_entry, int(duration * 48000 / 1024), 1024, 48000, bytes(8)))
+
+    with open(path, 'wb') as f:
+        f.write(_box(b'ftyp', b'qt  ' + struct.pack('>I', 0) + b'qt  '))
+        f.write(struct.pack('>I4s', 8 + media_bytes, b'mdat'))
+        f.seek(media_bytes, os.SEEK_CUR)
+        f.write(moov)
+
+
+def run_benchmark(paths=None, files=20, rounds=3):
+    """
+    Probes per second of the box parser against ffprobe, as the watcher probes new files.
+
+    Args:
+        paths (list, optional): Videos to probe. Default: sample MOV files in a temp dir.
+        files (int): Number of sample files to write when no paths are given.
+        rounds (int): Passes over the files per method.
+    """
+    from media_probe import run_ffprobe
+
+    work_dir = None
+    if not paths:
+        work_dir = tempfile.mkdtemp(prefix="mp4_boxes_bench_")
+        paths = []
+        for index in range(files):
+            path = os.path.join(work_dir, f"IMG_{index:04d}_COMPLETED.MOV")
+            write_sample_mp4(path, duration=20 + index)
+            paths.append(path)
+    try:
+        parsed = sum(parse_mp4(path) is not None for path in paths)
+        print(f"{len(paths)} files, {parsed} readable from their boxes, {rounds} rounds")
+        print(f"{'method':<12}{'probes/s':>12}{'per probe':>14}")
+        for name, probe in (("boxes", parse_mp4), ("ffprobe", run_ffprobe)):
+            if name == "ffprobe" and shutil.which('ffprobe') is None:
+                print(f"{name:<12}{'not installed':>26}")
+                continue
+            start_time = time.perf_counter()
+            for _ in range(rounds):
+                for path in paths:
+                    probe(path)
+            elapsed = time.perf_counter() - start_time
+            count = rounds * len(paths)
+            print(f"{name:<12}{count / elapsed:>12.0f}{elapsed / count * 1000:>12.2f}ms")
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process-free MP4/MOV metadata")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    show_parser = subparsers.add_parser('show', help="Print the summary read from each file's boxes")
+    show_parser.add_argument('paths', nargs='+')
+
+    bench_parser = subparsers.add_parser('benchmark', help="Probes per second: box parser vs ffprobe")
+    bench_parser.add_argument('paths', nargs='*', help="Videos to probe (default: generated MOV files)")
+    bench_parser.add_argument('--files', type=int, default=20, help="Sample files to generate")
+    bench_parser.add_argument('--rounds', type=int, default=3, help="Passes over the files")
+
+    args = parser.parse_args()
+    if args.command == 'show':
+        unreadable = False
+        for path in args.paths:
+            summary = parse_mp4(path)
+            unreadable = unreadable or summary is None
+            print(f"{path}: {summary if summary is not None else 'not readable from boxes (use ffprobe)'}")
+        sys.exit(1 if unreadable else 0)
+    run_benchmark(args.paths, args.files, args.rounds)
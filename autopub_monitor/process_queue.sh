@@ -16,15 +16,73 @@ touch "${QUEUE_LIST}"
 touch "${QUEUE_LOCK}"
 echo_with_timestamp "Starting process_queue.sh script..."
 
+# Run the queue scheduler (callers must hold QUEUE_LOCK)
+queue_scheduler() {
+    python3 "${QUEUE_SCHEDULER_PY}" \
+        --queue "${QUEUE_LIST}" \
+        --state "${QUEUE_STATE}" \
+        --policy "${QUEUE_POLICY}" \
+        --probe-cache-dir "${PROBE_CACHE_DIR}" \
+        --speculative-dir "${SPECULATIVE_DIR}" \
+        --aging-seconds "${QUEUE_AGING_SECONDS}" \
+        --max-attempts "${QUEUE_MAX_ATTEMPTS}" \
+        --backoff-base "${QUEUE_BACKOFF_BASE}" \
+        --backoff-max "${QUEUE_BACKOFF_MAX}" \
+        --failed-list "${FAILED_LIST}" \
+        "$@"
+}
+
+# Record the exit code of a finished job in the queue
+finish_job() {
+    local job_path="$1"
+    local result="$2"
+    if [ "$result" -eq 0 ]; then
+        echo_with_timestamp "Processing completed for: ${job_path}"
+        {
+            flock -x 200
+            queue_scheduler done "$job_path"
+            echo_with_timestamp "Removed from queue: $job_path"
+        } 200>"$QUEUE_LOCK"
+    elif [ "$result" -eq 75 ]; then
+        # autopub.py exits with EX_TEMPFAIL when there is not enough disk space for the job
+        echo_with_timestamp "Deferred for lack of disk space: ${job_path}"
+        {
+            flock -x 200
+            queue_scheduler defer "$job_path" --delay "${QUEUE_DEFER_SECONDS}"
+        } 200>"$QUEUE_LOCK"
+    elif [ "$result" -eq 76 ]; then
+        # The processing server has the job; the collector makes it due again once the result is in
+        echo_with_timestamp "Handed off to the processing server: ${job_path}"
+        {
+            flock -x 200
+            queue_scheduler defer "$job_path" --delay "${PROCESSING_HANDOFF_SECONDS}"
+        } 200>"$QUEUE_LOCK"
+    else
+        echo_with_timestamp "Processing failed for: ${job_path} with error code $result"
+        {
+            flock -x 200
+            queue_scheduler fail "$job_path" --error "exit code $result"
+        } 200>"$QUEUE_LOCK"
+    fi
+}
+
+# Print a queued job that outranks the running one, if any
+urgent_job() {
+    {
+        flock -x 200
+        queue_scheduler urgent --running "$1"
+    } 200>"$QUEUE_LOCK"
+}
+
 # Main loop to process files from the queue
-echo_with_timestamp "Entering main processing loop..."
+echo_with_timestamp "Entering main processing loop (policy: ${QUEUE_POLICY})..."
 while true; do
     TIMESTAMP=$(date +%s)
     TMP_FILE="/dev/shm/queue_path_$TIMESTAMP.txt"
     {
         flock -x 200
         if [ -s "$QUEUE_LIST" ]; then
-            full_path=$(head -n 1 "$QUEUE_LIST")
+            full_path=$(queue_scheduler next)
             echo "$full_path" > "$TMP_FILE"
             echo_with_timestamp "Read from queue inside lock: $full_path"
         else
@@ -37,22 +95,24 @@ while true; do
     
     if [ -n "$full_path" ]; then
         echo_with_timestamp "Processing: ${full_path}"
-        bash "$AUTOPUB_SH" "${full_path}" &>> "${AUTOPUB_LOGS_DIR}/autopub.log"
-        result=$?
-        if [ $result -eq 0 ]; then
-            echo_with_timestamp "Processing completed for: ${full_path}"
-            {
-                flock -x 200
-                sed -i '1d' "$QUEUE_LIST"
-                echo_with_timestamp "Removed from queue: $full_path"
-            } 200>"$QUEUE_LOCK"
-        else
-            echo_with_timestamp "Processing failed for: ${full_path} with error code $result"
-        fi
-        
-        # rm "$TMP_FILE"
+        bash "$AUTOPUB_SH" "${full_path}" &>> "${AUTOPUB_LOGS_DIR}/autopub.log" &
+        job_pid=$!
+
+        # While it runs, a job queued with a higher priority (queue_file_utility.sh -p)
+        # starts at once; its encodes suspend this job's until they are done
+        while kill -0 "$job_pid" 2>/dev/null; do
+            sleep "${QUEUE_PREEMPT_POLL_SECONDS}"
+            urgent_path=$(urgent_job "$full_path")
+            if [ -n "$urgent_path" ] && kill -0 "$job_pid" 2>/dev/null; then
+                echo_with_timestamp "Preempting ${full_path} for urgent job: ${urgent_path}"
+                AUTOPUB_PREEMPT=1 bash "$AUTOPUB_SH" "${urgent_path}" &>> "${AUTOPUB_LOGS_DIR}/autopub.log"
+                finish_job "$urgent_path" $?
+            fi
+        done
+        wait "$job_pid"
+        finish_job "$full_path" $?
     else
-        echo_with_timestamp "No valid file to process. Waiting for new files in the queue..."
+        echo_with_timestamp "No eligible file to process. Waiting for new files or retry backoff..."
         sleep 10
     fi
 
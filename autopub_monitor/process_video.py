@@ -9,24 +9,46 @@ from requests_toolbelt import MultipartEncoder
 import subprocess
 import tempfile
 import shutil
+import time
 import numpy as np
 from tqdm import tqdm
-import json
 
 from video_utils import preprocess_if_needed
+from handbrake import HandBrakePreprocessor
+from streaming_upload import StreamingEncode, StreamingEncodeFailed
+from media_runner import run_media_command
+from mp4_boxes import parse_mp4
+from media_probe import DEFAULT_SPECULATIVE_DIR
+from toolchain import get_toolchain
+from encode_scheduler import EncodeScheduler
+from bandwidth_arbiter import BandwidthArbiter
+from upload_client import AudioFirstUpload, send_file
+from striped_upload import StripedUpload
+from processing_jobs import ProcessingHandedOff, save_processing_result
+from publish_coalescer import format_video_url
+import resource_accounting
 
 def get_video_length(filename):
-    """Returns the length of the video in seconds or None if unable to determine."""
+    """Returns the length of the video in seconds or None if unable to determine.
+
+    MP4/MOV durations are read from the mvhd box; other containers go through ffprobe.
+    """
+    summary = parse_mp4(filename)
+    if summary is not None:
+        return summary["duration"]
     try:
-        cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{filename}\""
-        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        video_length = float(output)
+        cmd = [
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', filename
+        ]
+        result = run_media_command(cmd, capture_stdout=True, check=True, timeout=120)
+        video_length = float(result.stdout)
         return video_length
     except Exception as e:
         print(f"Warning: Failed to get video length for {filename}. Error: {e}")
         return None
 
-def augment_video(video_path, augmented_length, output_path):
+def augment_video(video_path, augmented_length, output_path, concat_file_path=None):
     """
     Repeats the video to ensure it reaches at least the specified minimum length.
     If the video already meets or exceeds the minimum length, no repetition is performed.
@@ -35,7 +57,10 @@ def augment_video(video_path, augmented_length, output_path):
         video_path (str): Path to the input video.
         augmented_length (int): Minimum desired length of the video in seconds.
         output_path (str): Path to the output augmented video.
+        concat_file_path (str, optional): Where to write the ffmpeg concat list.
+            Defaults to concat_list.txt in the working directory.
     """
+    concat_file_path = concat_file_path or "concat_list.txt"
     try:
         # Get the length of the input video
         video_length = get_video_length(video_path)
@@ -51,41 +76,34 @@ def augment_video(video_path, augmented_length, output_path):
         print(f"Repeating the video {repeat_count} times to meet the minimum length requirement.")
 
         # Generate a temporary file listing for ffmpeg
-        concat_file_path = "concat_list.txt"
         with open(concat_file_path, "w") as file:
             for _ in range(repeat_count):
                 file.write(f"file '{video_path}'\n")
 
         # Update ffmpeg command to re-encode audio for MP4 compatibility
         ffmpeg_command = [
-            "ffmpeg", '-y', "-f", "concat", "-safe", "0", "-i", concat_file_path,
-            "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", output_path
+            "ffmpeg", '-y', '-v', 'error', "-f", "concat", "-safe", "0", "-i", concat_file_path,
+            "-c:v", "copy", "-c:a", get_toolchain().aac_encoder(), "-b:a", "192k", output_path
         ]
         print(f"Executing FFmpeg command: {' '.join(ffmpeg_command)}")
         
-        # Use tqdm to show progress
-        process = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        
-        # Create progress bar for the augmentation process
+        # Create progress bar for the augmentation process, fed by ffmpeg's -progress output
+        total_time = video_length * repeat_count
         with tqdm(total=100, desc="Augmenting video", unit="%") as pbar:
-            for line in process.stdout:
-                if 'time=' in line:
-                    # Extract progress from ffmpeg output
-                    try:
-                        time_str = line.split('time=')[1].split()[0]
-                        h, m, s = time_str.split(':')
-                        current_time = float(h) * 3600 + float(m) * 60 + float(s)
-                        progress = min(100, int(100 * current_time / (video_length * repeat_count)))
-                        pbar.update(progress - pbar.n)  # Update to current progress
-                    except:
-                        pass
+            def update_progress(progress):
+                percent = min(100, int(100 * progress.get('out_time_seconds', 0) / total_time))
+                pbar.update(max(0, percent - pbar.n))
+            
+            run_media_command(
+                ffmpeg_command, check=True, timeout=3600,
+                progress='ffmpeg', progress_callback=update_progress
+            )
             
             # Ensure we reach 100% in the progress bar
             pbar.update(100 - pbar.n)
             
-        process.wait()
         print(f"Video successfully augmented and saved to {output_path}")
-    except subprocess.CalledProcessError as e:
+    except subprocess.SubprocessError as e:
         print(f"Error during video augmentation: {e}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
@@ -106,6 +124,21 @@ class VideoProcessor:
         preprocess_dir=None,
         use_app_api=False,
         upload_source=None,
+        encode_scheduler=None,
+        stream_upload_url=None,
+        pipelined_upload=False,
+        checkpoint=None,
+        workspace=None,
+        upload_planner=None,
+        bandwidth_arbiter=None,
+        audio_upload_url=None,
+        audio_first_upload=False,
+        upload_session_url=None,
+        striped_upload=False,
+        striped_upload_settings=None,
+        change_feed=None,
+        processing_client=None,
+        speculative_dir=DEFAULT_SPECULATIVE_DIR,
     ):
         self.upload_url = upload_url
         self.process_url = process_url
@@ -114,8 +147,34 @@ class VideoProcessor:
         self.preprocess_dir = preprocess_dir
         self.use_app_api = use_app_api
         self.upload_source = upload_source or ("api" if use_app_api else None)
+        self.encode_scheduler = encode_scheduler
+        self.stream_upload_url = stream_upload_url
+        self.streaming_encode = None
+        self.checkpoint = checkpoint
+        self.workspace = workspace
+        self.upload_planner = upload_planner
+        self.bandwidth = bandwidth_arbiter or BandwidthArbiter()
+        self.audio_upload_url = audio_upload_url if audio_first_upload else None
+        self.upload_session_url = upload_session_url if striped_upload else None
+        self.striped_upload_settings = striped_upload_settings or {}
+        self.change_feed = change_feed
+        self.processing_client = processing_client
+        self.speculative_dir = speculative_dir
         os.makedirs(self.transcription_path, exist_ok=True)
 
+        # A previous attempt that got past augmentation (or the upload) left the final video
+        if self.checkpoint:
+            uploaded = self.checkpoint.get("upload")
+            augmented = self.checkpoint.get("augment")
+            if uploaded is not None:
+                print("Resuming from checkpoint: preprocessing skipped, video already uploaded.")
+                self.video_path = uploaded["video_path"]
+                return
+            if augmented is not None:
+                print(f"Resuming from checkpoint: using prepared video {augmented['video']}")
+                self.video_path = augmented["video"]
+                return
+
         input_file = self.video_path
 
         ## Preprocessing ##
@@ -123,15 +182,39 @@ class VideoProcessor:
         # Preprocess video if needed (replace the existing preprocess_if_needed call)
         base_name, extension = os.path.splitext(os.path.basename(input_file))
         
-        # Use specified temp directory or create one
-        if self.preprocess_dir:
+        # Use the job's workspace, the specified directory, or a new temp directory
+        if self.workspace:
+            temp_dir = self.workspace.job_dir
+        elif self.preprocess_dir:
             os.makedirs(self.preprocess_dir, exist_ok=True)
             temp_dir = self.preprocess_dir
         else:
             temp_dir = tempfile.mkdtemp(prefix="video_preprocess_")
         
-        preprocessed_file = preprocess_if_needed(input_file, temp_dir)
-        input_file = preprocessed_file
+        preprocessed = self.checkpoint.get("preprocess") if self.checkpoint else None
+        if preprocessed is not None:
+            print(f"Resuming from checkpoint: using preprocessed video {preprocessed['video']}")
+            input_file = preprocessed["video"]
+        else:
+            # A fix writes a new copy of the video (plus segments while a
+            # segmented encode runs); defer the job rather than fill the disk
+            if self.workspace:
+                self.workspace.admit("preprocess", 2 * os.path.getsize(input_file))
+
+            # Pipelined mode: defer the fix so the upload can follow its output
+            deferred = False
+            if pipelined_upload and stream_upload_url:
+                deferred = self.prepare_streaming_fix(input_file, temp_dir)
+                if deferred:
+                    return
+            
+            if deferred is not None:
+                preprocessed_file = preprocess_if_needed(
+                    input_file, temp_dir, encode_scheduler=self.encode_scheduler, speculative_dir=self.speculative_dir
+                )
+                input_file = preprocessed_file
+            if self.checkpoint:
+                self.checkpoint.complete("preprocess", artifacts={"video": input_file})
 
         ## Augmentation ##
         # Define the minimum length for the video in seconds
@@ -152,35 +235,200 @@ class VideoProcessor:
         else:
             # Proceed with augmentation if the video is shorter than the augmented_length
             print(f"Video length {video_length} is shorter than {threshold_length}. Augmenting to {augmented_length}s.")
-            input_file = self.augment_video_if_needed(input_file, augmented_length)
+            with resource_accounting.stage("augment"):
+                input_file = self.augment_video_if_needed(input_file, augmented_length, video_length)
 
-       
+        if self.checkpoint:
+            self.checkpoint.complete("augment", artifacts={"video": input_file})
 
         self.video_path = input_file
 
-    def augment_video_if_needed(self, input_file, augmented_length):
+    def prepare_streaming_fix(self, input_file, output_dir, min_length=7):
+        """
+        Detect whether the video needs a fix and, if so, set up a streaming
+        encode instead of fixing it now. The encode starts when the upload does.
+
+        Clips too short to skip augmentation are fixed the usual way, since
+        augmentation needs the finished file.
+
+        Returns:
+            bool or None: True if the fix was deferred to a streaming encode,
+            None if the video needs no fix, False to use the regular path.
+        """
+        video_length = get_video_length(input_file)
+        if video_length is None or video_length <= min_length:
+            return False
+
+        base_name = Path(input_file).stem
+        output_path = os.path.join(output_dir, f"{base_name}_compatible.mp4")
+        preprocessor = HandBrakePreprocessor(
+            input_file, output_path, encode_scheduler=self.encode_scheduler,
+            speculative_dir=self.speculative_dir
+        )
+        try:
+            if not preprocessor.detect_video_issues():
+                return None
+        except Exception as e:
+            print(f"Warning: Issue detection failed ({e}); using the regular preprocessing path.")
+            return False
+
+        print(f"Deferring fix of {input_file}: it will be uploaded while it is encoded.")
+        self.streaming_encode = StreamingEncode(preprocessor, duration=video_length)
+        self.video_path = output_path
+        return True
+
+    def upload_while_encoding(self, upload_data):
+        """
+        Start the deferred fix and upload its fragmented MP4 output as it grows.
+
+        If the encode fails, the body generator raises before the final chunk,
+        so the request is aborted and the server discards the partial stream.
+
+        Returns:
+            requests.Response or None: Upload response, or None if the encode failed.
+        """
+        encode = self.streaming_encode
+        start_time = time.time()
+        encode.start()
+        try:
+            with self.bandwidth.transfer("upload", os.path.basename(self.video_path)) as bucket:
+                response = requests.put(
+                    self.stream_upload_url,
+                    data=bucket.throttle(encode.chunks()),
+                    params=upload_data,
+                    headers={'Content-Type': 'video/mp4'},
+                )
+        except StreamingEncodeFailed:
+            encode.wait()
+            print("Aborted the upload of an incomplete encode.")
+            return None
+        except requests.RequestException:
+            # Nobody will read the rest of the output; stop the encoder
+            encode.cancel()
+            encode.wait()
+            raise
+        if not encode.wait():
+            print("Discarding upload of an incomplete encode.")
+            return None
+
+        total = time.time() - start_time
+        print(
+            f"Pipelined upload finished: {encode.bytes_streamed / 1024 / 1024:.1f} MB in {total:.1f}s "
+            f"(encode {encode.encode_seconds:.1f}s, upload tail {max(0.0, total - encode.encode_seconds):.1f}s)"
+        )
+        return response
+
+    def augment_video_if_needed(self, input_file, augmented_length, video_length=None):
         print("Input file:", input_file)
 
         base_name, extension = os.path.splitext(os.path.basename(input_file))
-        # Using tempfile to create a temporary directory
-        temp_dir = tempfile.mkdtemp()
-        augmented_video_path = os.path.join(temp_dir, f"{base_name}_augmented_{augmented_length}s{extension}")
+        augmented_name = f"{base_name}_augmented_{augmented_length}s{extension}"
+        concat_file_path = None
+        if self.workspace:
+            repeat_count = int(np.ceil(augmented_length / video_length)) if video_length else 1
+            self.workspace.admit("augment", repeat_count * os.path.getsize(input_file))
+            augmented_video_path = self.workspace.artifact_path(augmented_name)
+            concat_file_path = self.workspace.scratch_path("concat_list.txt", estimated_bytes=4096)
+        else:
+            # Using tempfile to create a temporary directory
+            temp_dir = tempfile.mkdtemp()
+            augmented_video_path = os.path.join(temp_dir, augmented_name)
 
         print("Augmented video path:", augmented_video_path)
 
         # Perform the augmentation
-        new_path = augment_video(input_file, augmented_length, augmented_video_path)
+        new_path = augment_video(input_file, augmented_length, augmented_video_path, concat_file_path)
         return new_path
 
     @staticmethod
     def format_video_url(url, video_id):
-        if not url or video_id is None:
-            return url
-        if "{video_id}" in url:
-            return url.replace("{video_id}", str(video_id))
-        if "{id}" in url:
-            return url.replace("{id}", str(video_id))
-        return url
+        return format_video_url(url, video_id)
+
+    def upload_video(self):
+        """
+        Upload the video and return the server's JSON response.
+
+        Returns:
+            dict or None: Upload response payload, or None if the upload failed.
+        """
+        upload_data = {
+            "filename": os.path.basename(self.video_path),
+            "title": Path(self.video_path).stem,
+        }
+        if self.upload_source:
+            upload_data["source"] = self.upload_source
+
+        if self.streaming_encode is not None:
+            response = self.upload_while_encoding(upload_data)
+            if response is None:
+                return None
+        elif not self.upload_url.endswith("stream"):
+            upload_path, plan = self.prepare_upload_file()
+            start_time = time.time()
+            response = None
+            if self.audio_upload_url:
+                # Audio first so the server can start transcribing, then the video in the background
+                audio_first = AudioFirstUpload(
+                    upload_path, self.upload_url, self.audio_upload_url, upload_data,
+                    bandwidth=self.bandwidth,
+                    work_dir=self.workspace.scratch_dir() if self.workspace else None,
+                    filename=os.path.basename(self.video_path),
+                )
+                if audio_first.start():
+                    response = audio_first.wait()
+                    start_time += audio_first.audio_seconds
+            if response is None and self.upload_session_url and StripedUpload.worthwhile(
+                os.path.getsize(upload_path), self.striped_upload_settings.get('part_size')
+            ):
+                # Ranges over several connections, for large files on links a single stream cannot fill
+                try:
+                    response = StripedUpload(
+                        upload_path, self.upload_session_url, upload_data,
+                        bandwidth=self.bandwidth, **self.striped_upload_settings,
+                    ).upload()
+                except requests.RequestException as e:
+                    print(f"Striped upload failed ({e}); uploading over one connection.")
+            if response is None:
+                response = send_file(
+                    'post', self.upload_url, 'video', upload_path,
+                    fields=upload_data, bandwidth=self.bandwidth,
+                    filename=os.path.basename(self.video_path),
+                )
+            if response.ok and self.upload_planner:
+                self.upload_planner.record_upload(upload_path, time.time() - start_time, plan)
+        else:
+            # Preprocess the file for streaming upload (a transcode is already faststart)
+            upload_path, plan = self.prepare_upload_file()
+            if upload_path == self.video_path:
+                upload_path = self.preprocess_for_streaming(self.video_path)
+            start_time = time.time()
+            response = send_file(
+                'put', self.upload_url, 'video', upload_path,
+                params=upload_data, bandwidth=self.bandwidth,
+            )
+            if response.ok and self.upload_planner:
+                self.upload_planner.record_upload(upload_path, time.time() - start_time, plan)
+
+        if not response.ok:
+            print(f'Failed to upload file. Status code: {response.status_code}, Message: {response.text}')
+            return None
+
+        # Extract the file path from the response
+        try:
+            upload_payload = response.json()
+        except Exception:
+            print(f"Failed to parse upload response: {response.text}")
+            return None
+
+        if self.checkpoint and upload_payload.get('file_path'):
+            self.checkpoint.complete(
+                "upload",
+                video_path=self.video_path,
+                file_path=upload_payload.get('file_path'),
+                video_id=upload_payload.get('video_id'),
+                upload=upload_payload,
+            )
+        return upload_payload
 
     def process_video(self, 
         use_cache=False,
@@ -192,6 +440,12 @@ class VideoProcessor:
         os.makedirs(zip_file_root, exist_ok=True)
         zip_file_path = os.path.join(zip_file_root, f"{video_name}.zip")
 
+        # A previous attempt already downloaded the processing results
+        processed = self.checkpoint.get("process") if (self.checkpoint and not self.use_app_api) else None
+        if processed is not None:
+            print(f"Resuming from checkpoint: processed files already at {processed['zip']}.")
+            return processed["zip"]
+
         # Check cache (legacy zip flow only)
         if use_cache and os.path.isfile(zip_file_path):
             if self.use_app_api:
@@ -206,43 +460,16 @@ class VideoProcessor:
             else:
                 print("Cache ignored: use_cache=false.")
         
-        # Upload the video file
-        upload_data = {
-            "filename": os.path.basename(self.video_path),
-            "title": Path(self.video_path).stem,
-        }
-        if self.upload_source:
-            upload_data["source"] = self.upload_source
-
-        if not self.upload_url.endswith("stream"):
-            with open(self.video_path, 'rb') as f:
-                files = {'video': (os.path.basename(self.video_path), f)}
-                response = requests.post(
-                    self.upload_url, 
-                    files=files, 
-                    data=upload_data
-                )
+        # Upload the video file (skipped when a previous attempt already uploaded it)
+        uploaded = self.checkpoint.get("upload") if self.checkpoint else None
+        if uploaded is not None:
+            print(f"Resuming from checkpoint: already uploaded as {uploaded.get('file_path')}")
+            upload_payload = uploaded["upload"]
         else:
-            # Preprocess the file for streaming upload
-            preprocessed_file_path = self.preprocess_for_streaming(self.video_path)
-            with open(preprocessed_file_path, 'rb') as f:
-                files = {'video': (os.path.basename(preprocessed_file_path), f)}
-                response = requests.put(
-                    self.upload_url, 
-                    files=files, 
-                    params=upload_data
-                )
-
-        if not response.ok:
-            print(f'Failed to upload file. Status code: {response.status_code}, Message: {response.text}')
-            return
-
-        # Extract the file path from the response
-        try:
-            upload_payload = response.json()
-        except Exception:
-            print(f"Failed to parse upload response: {response.text}")
-            return
+            with resource_accounting.stage("upload"):
+                upload_payload = self.upload_video()
+            if upload_payload is None:
+                return
 
         uploaded_file_path = upload_payload.get('file_path')
         uploaded_video_id = upload_payload.get('video_id')
@@ -288,64 +515,123 @@ class VideoProcessor:
             #     "process": process_payload,
             # }
 
+        options = {
+            "use_cache": use_cache,
+            "use_translation_cache": use_translation_cache,
+            "use_metadata_cache": use_metadata_cache
+        }
+
+        # Background processing: hand the job to the server and let the worker move on
+        if self.processing_client and self.checkpoint:
+            submitted = self.checkpoint.get("submit")
+            if submitted is not None:
+                return self.collect_processing(submitted["job_id"], zip_file_path, options)
+            try:
+                job_id = self.processing_client.submit(
+                    self.checkpoint.source_path, uploaded_file_path, self.video_path, zip_file_path,
+                    options, self.checkpoint.checkpoint_dir,
+                )
+            except requests.RequestException as e:
+                print(f"Failed to submit the video for processing: {e}")
+                return
+            if job_id is not None:
+                self.checkpoint.complete("submit", job_id=job_id)
+                raise ProcessingHandedOff(job_id)
+
         # Request processing of the uploaded file (legacy zip flow)
-        process_response = requests.post(
-            self.process_url,
-            data={
-                'file_path': uploaded_file_path,
-                "use_translation_cache": use_translation_cache,
-                "use_metadata_cache": use_metadata_cache
-            }
-        )
+        with resource_accounting.stage("process"):
+            process_response = requests.post(
+                self.process_url,
+                data={
+                    'file_path': uploaded_file_path,
+                    "use_translation_cache": use_translation_cache,
+                    "use_metadata_cache": use_metadata_cache
+                },
+                stream=True,
+            )
         
         if process_response.ok:
             # Save the processing results with progress bar
-            content_length = int(process_response.headers.get('content-length', 0))
-            
-            with open(zip_file_path, 'wb') as f, tqdm(
-                desc=f"Downloading processed files",
-                total=content_length,
-                unit='B',
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as pbar:
-                for chunk in process_response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-            
-            print(f'Success! Processed files are downloaded and saved to {zip_file_path}.')
-            
-            # Save the data alongside the figure/results
-            data_file_path = os.path.join(zip_file_root, f"{video_name}_data.json")
-            try:
-                data = {
-                    "processed_date": str(datetime.now()),
-                    "video_path": self.video_path,
-                    "video_name": video_name,
-                    "processing_options": {
-                        "use_cache": use_cache,
-                        "use_translation_cache": use_translation_cache,
-                        "use_metadata_cache": use_metadata_cache
-                    }
-                }
-                with open(data_file_path, 'w') as f:
-                    json.dump(data, f, indent=4)
-            except:
-                print("Unable to save processing data file.")
-                
-            return zip_file_path
+            with resource_accounting.stage("download"):
+                return save_processing_result(
+                    process_response, zip_file_path, self.video_path, options,
+                    self.change_feed, self.checkpoint,
+                )
         else:
             print(f'Failed to process file. Status code: {process_response.status_code}, Message: {process_response.text}')
+
+    def collect_processing(self, job_id, zip_file_path, options):
+        """
+        Pick up a processing job submitted by an earlier attempt.
+
+        The collector (processing_jobs.py) normally downloads the result before
+        this attempt starts, so this only runs when it has not: the result is
+        downloaded if the job is done, and the job is handed off again if it
+        is still running.
+
+        Returns:
+            str or None: Path of the zip, or None if the job failed (the next
+            attempt submits the video again).
+        """
+        try:
+            status = self.processing_client.status(job_id)
+        except requests.RequestException as e:
+            print(f"Processing server unreachable while checking job {job_id}: {e}")
+            return None
+        if status in ("failed", "unknown"):
+            print(f"Processing job {job_id} {status}; the video will be submitted again.")
+            self.processing_client.store.remove(job_id)
+            self.checkpoint.invalidate_from("submit")
+            return None
+        if status != "done":
+            raise ProcessingHandedOff(job_id)
+
+        entry = self.processing_client.store.pending().get(job_id) or {
+            "source": self.checkpoint.source_path,
+            "checkpoint_dir": self.checkpoint.checkpoint_dir,
+        }
+        entry.update({"video_path": self.video_path, "zip": zip_file_path, "options": options})
+        with resource_accounting.stage("download"):
+            return self.processing_client.download(job_id, entry, self.change_feed)
     
+    def prepare_upload_file(self):
+        """
+        Pick the file to upload: the video itself, or a lower-bitrate transcode
+        when the upload planner predicts that transcoding first finishes sooner.
+
+        Returns:
+            tuple: (path to upload, UploadPlan or None)
+        """
+        if not self.upload_planner:
+            return self.video_path, None
+        stem = Path(self.video_path).stem
+        if self.workspace:
+            output_path = self.workspace.artifact_path(f"{stem}_upload.mp4")
+        else:
+            output_dir = self.preprocess_dir or os.path.dirname(self.video_path)
+            output_path = os.path.join(output_dir, f"{stem}_upload.mp4")
+        return self.upload_planner.prepare(
+            self.video_path, output_path, self.encode_scheduler or EncodeScheduler(), self.workspace
+        )
+
     def preprocess_for_streaming(self, file_path):
-        output_file_path = os.path.join(os.path.dirname(file_path), 'preprocessed_' + os.path.basename(file_path))
+        if not get_toolchain().has_muxer('mp4'):
+            print("This ffmpeg build has no mp4 muxer; uploading the file without a faststart remux.")
+            return file_path
+        if self.workspace:
+            self.workspace.admit("stream remux", os.path.getsize(file_path))
+            output_file_path = self.workspace.artifact_path('preprocessed_' + os.path.basename(file_path))
+        else:
+            output_file_path = os.path.join(os.path.dirname(file_path), 'preprocessed_' + os.path.basename(file_path))
         # Explicitly specify the video and audio codec along with copying the streams and moving the moov atom
-        command = f"ffmpeg -y -i \"{file_path}\" -vcodec copy -acodec copy -movflags faststart \"{output_file_path}\""
+        command = [
+            'ffmpeg', '-y', '-v', 'error', '-i', file_path,
+            '-vcodec', 'copy', '-acodec', 'copy', '-movflags', 'faststart', output_file_path
+        ]
         try:
-            subprocess.run(command, shell=True, check=True)
+            run_media_command(command, check=True, timeout=1800)
             print(f"Successfully preprocessed {file_path} to {output_file_path}")
-        except subprocess.CalledProcessError as e:
+        except subprocess.SubprocessError as e:
             print(f"Failed to preprocess file with FFmpeg: {e}")
             return file_path  # Return original file path in case of failure
         return output_file_path
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+# processing_jobs.py - Server-side processing as background jobs: submit, then poll or take callbacks
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from tqdm import tqdm
+
+from change_feed import ChangeFeed, atomic_write
+from checkpoint import JobCheckpoint, DEFAULT_CHECKPOINT_DIR
+from publish_coalescer import format_video_url
+from queue_scheduler import load_state, read_queue, record_deferral, save_state
+
+DEFAULT_STORE = os.path.expanduser('~/AutoPublishDATA/processing_jobs.json')
+DEFAULT_CALLBACK_PORT = 8767
+DEFAULT_POLL_SECONDS = 30.0
+
+# Exit status of autopub.py when the server is still processing the job (76
+# is free in the sysexits range used for EXIT_DEFERRED)
+EXIT_HANDED_OFF = 76
+
+# Statuses meaning "this server has no job endpoint"
+_NO_JOB_ENDPOINT = {404, 405, 501}
+
+
+class ProcessingHandedOff(Exception):
+    """The server is processing the video in the background; the job resumes when it is done."""
+
+    def __init__(self, job_id):
+        super().__init__(f"server-side processing job {job_id} is still running")
+        self.job_id = job_id
+
+    def __reduce__(self):
+        # Survives the trip back from process_batch's worker processes
+        return type(self), (self.job_id,)
+
+
+def save_processing_result(response, zip_file_path, video_path, options,
+                           change_feed=None, checkpoint=None):
+    """
+    Save the processing results (a zip streamed in the response) and record them.
+
+    Writes `<video_name>_data.json` next to the zip, lists both in the change
+    feed and completes the checkpoint's "process" stage.
+
+    Args:
+        response (requests.Response): Streamed response carrying the zip.
+        zip_file_path (str): Where the zip goes.
+        video_path (str): The video that was processed.
+        options (dict): use_cache, use_translation_cache and use_metadata_cache.
+        change_feed (ChangeFeed, optional): Feed of files written under transcription_data.
+        checkpoint (JobCheckpoint, optional): The job's checkpoint.
+
+    Returns:
+        str: zip_file_path.
+    """
+    content_length = int(response.headers.get('content-length', 0))
+    with atomic_write(zip_file_path) as f, tqdm(
+        desc=f"Downloading processed files",
+        total=content_length,
+        unit='B',
+        unit_scale=True,
+        unit_divisor=1024,
+    ) as pbar:
+        for chunk in response.iter_content(chunk_size=8192):
+            if chunk:
+                f.write(chunk)
+                pbar.update(len(chunk))
+
+    print(f'Success! Processed files are downloaded and saved to {zip_file_path}.')
+    if change_feed:
+        change_feed.record(zip_file_path)
+    if checkpoint:
+        checkpoint.complete("process", artifacts={"zip": zip_file_path})
+
+    # Save the data alongside the figure/results
+    video_name = os.path.splitext(os.path.basename(zip_file_path))[0]
+    data_file_path = os.path.join(os.path.dirname(zip_file_path), f"{video_name}_data.json")
+    try:
+        data = {
+            "processed_date": str(datetime.now()),
+            "video_path": video_path,
+            "video_name": video_name,
+            "processing_options": options,
+        }
+        with atomic_write(data_file_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        if change_feed:
+            change_feed.record(data_file_path)
+    except Exception:
+        print("Unable to save processing data file.")
+    return zip_file_path
+
+
+@contextmanager
+def _flocked(lock_path):
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class JobStore:
+    """
+    Jobs handed to the processing server and not collected yet, by job id.
+
+    Shared by the autopub.py runs that submit jobs and the collector that
+    finishes them; every change happens under an flock of `<store>.lock`.
+    """
+
+    def __init__(self, path=DEFAULT_STORE):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, jobs):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(jobs, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def add(self, job_id, entry):
+        with _flocked(f"{self.path}.lock"):
+            jobs = self._load()
+            jobs[str(job_id)] = entry
+            self._save(jobs)
+
+    def remove(self, job_id):
+        with _flocked(f"{self.path}.lock"):
+            jobs = self._load()
+            if jobs.pop(str(job_id), None) is not None:
+                self._save(jobs)
+
+    def pending(self):
+        return self._load()
+
+
+class ProcessingClient:
+    """
+    Submit-then-poll access to the processing server (legacy zip flow).
+
+    POST `submit_url` with the form fields of the blocking request (plus
+    `callback_url` when a callback listener runs) answers {"job_id"} at once.
+    GET `status_url` reports {"status": "queued" | "running" | "done" |
+    "failed"}, and GET `result_url` returns the zip. Both are `{video_id}`
+    templates, filled with the job id by format_video_url like the app-API
+    endpoints.
+    """
+
+    def __init__(self, submit_url, status_url, result_url, callback_url=None,
+                 store_path=DEFAULT_STORE, timeout=60):
+        self.submit_url = submit_url
+        self.status_url = status_url
+        self.result_url = result_url
+        self.callback_url = callback_url or None
+        self.store = JobStore(store_path)
+        self.timeout = timeout
+
+    def submit(self, source_path, uploaded_file_path, video_path, zip_file_path, options,
+               checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+        """
+        Start processing an uploaded video in the background.
+
+        Returns:
+            str or None: The job id, or None if the server has no job endpoint
+            (the caller falls back to the blocking request).
+
+        Raises:
+            requests.RequestException: The server refused or could not be reached.
+        """
+        data = {'file_path': uploaded_file_path}
+        data.update({name: value for name, value in options.items() if name != "use_cache"})
+        if self.callback_url:
+            data['callback_url'] = self.callback_url
+        response = requests.post(self.submit_url, data=data, timeout=self.timeout)
+        if response.status_code in _NO_JOB_ENDPOINT:
+            print(f"{self.submit_url} does not take background jobs; waiting for the result instead")
+            return None
+        response.raise_for_status()
+        job_id = str(response.json()["job_id"])
+        self.store.add(job_id, {
+            "source": os.path.realpath(source_path),
+            "video_path": video_path,
+            "zip": zip_file_path,
+            "options": options,
+            "checkpoint_dir": checkpoint_dir,
+            "submitted_at": time.time(),
+        })
+        print(f"Submitted {os.path.basename(video_path)} for processing as job {job_id}")
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns:
+            str: "queued", "running", "done", "failed", or "unknown" if the server lost the job.
+        """
+        response = requests.get(format_video_url(self.status_url, job_id), timeout=self.timeout)
+        if response.status_code == 404:
+            return "unknown"
+        response.raise_for_status()
+        return response.json().get("status", "unknown")
+
+    def download(self, job_id, entry, change_feed=None):
+        """
+        Download a finished job's zip and complete the job's "process" stage.
+
+        Returns:
+            str or None: Path of the zip, or None if the result could not be fetched.
+        """
+        response = requests.get(format_video_url(self.result_url, job_id), stream=True, timeout=self.timeout)
+        if not response.ok:
+            print(f"Failed to fetch the result of job {job_id}: status {response.status_code}")
+            return None
+        checkpoint = JobCheckpoint(entry["source"], entry.get("checkpoint_dir", DEFAULT_CHECKPOINT_DIR))
+        zip_file_path = save_processing_result(
+            response, entry["zip"], entry["video_path"], entry["options"], change_feed, checkpoint
+        )
+        self.store.remove(job_id)
+        return zip_file_path
+
+
+class Collector:
+    """
+    Completion handler for handed-off jobs.
+
+    Checks every pending job each `poll_seconds`, and a job at once when the
+    server calls back. A finished job's zip is downloaded and its queue entry,
+    deferred when it was handed off, is made due again, so the next autopub.py
+    run resumes it at the publish stage. A failed job is woken as well; that
+    run sees the failure and the queue's retry accounting takes over.
+    """
+
+    def __init__(self, client, queue_path, queue_state_path, queue_lock_path,
+                 poll_seconds=DEFAULT_POLL_SECONDS, change_feed=None):
+        self.client = client
+        self.queue_path = queue_path
+        self.queue_state_path = queue_state_path
+        self.queue_lock_path = queue_lock_path
+        self.poll_seconds = poll_seconds
+        self.change_feed = change_feed
+        self.wake = threading.Event()
+        self.counters = {"collected": 0, "failed": 0, "callbacks": 0}
+
+    def notify(self, job_id):
+        """A callback arrived: check the pending jobs now."""
+        self.counters["callbacks"] += 1
+        self.wake.set()
+
+    def wake_job(self, source_path):
+        """Make a queued job due now (callers need not hold QUEUE_LOCK)."""
+        if not self.queue_path:
+            return
+        with _flocked(self.queue_lock_path):
+            queued = {os.path.realpath(path): path for path, _ in read_queue(self.queue_path)}
+            path = queued.get(os.path.realpath(source_path))
+            if path is None:
+                return
+            state = load_state(self.queue_state_path)
+            record_deferral(state, path, 0)
+            save_state(self.queue_state_path, state)
+
+    def check(self):
+        """
+        One pass over the pending jobs.
+
+        Returns:
+            int: Number of jobs still running on the server.
+        """
+        running = 0
+        for job_id, entry in self.client.store.pending().items():
+            try:
+                status = self.client.status(job_id)
+                if status == "done":
+                    if self.client.download(job_id, entry, self.change_feed) is None:
+                        running += 1
+                        continue
+                    self.counters["collected"] += 1
+                elif status in ("failed", "unknown"):
+                    print(f"Processing job {job_id} for {os.path.basename(entry['source'])} {status}")
+                    self.client.store.remove(job_id)
+                    self.counters["failed"] += 1
+                else:
+                    running += 1
+                    continue
+            except requests.RequestException as e:
+                print(f"Processing server unreachable for job {job_id}: {e}")
+                running += 1
+                continue
+            self.wake_job(entry["source"])
+        return running
+
+    def run(self, stop=None):
+        """Check pending jobs until interrupted (or until `stop`, an Event, is set)."""
+        while stop is None or not stop.is_set():
+            self.wake.clear()
+            self.check()
+            self.wake.wait(self.poll_seconds)
+
+
+def serve_callbacks(collector, host='127.0.0.1', port=DEFAULT_CALLBACK_PORT):
+    """
+    Run the callback listener.
+
+    POST /processed {"job_id", "status"} (or /processed/<job_id>) -> the collector checks its jobs now
+    GET  /status                                                  -> counters and pending job count
+
+    Returns:
+        ThreadingHTTPServer: The running server (serve_forever runs in a thread).
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            route = urlparse(self.path).path
+            if not route.startswith('/processed'):
+                self._send_json(404, {"error": "unknown endpoint"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            except ValueError:
+                payload = {}
+            collector.notify(payload.get("job_id") or route[len('/processed/'):])
+            self._send_json(200, {"ok": True})
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/status':
+                self._send_json(200, {**collector.counters, "pending": len(collector.client.store.pending())})
+            else:
+                self._send_json(404, {"error": "unknown endpoint"})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _standin_processing_server(process_seconds, workers=4):
+    """
+    A local stand-in for the processing server: the blocking endpoint and the
+    job endpoints, `workers` videos processed at a time, `process_seconds` each.
+    """
+    slots = threading.Semaphore(workers)
+    jobs = {}
+    result = b"PK\x05\x06" + bytes(18)
+
+    def process(job_id, callback_url):
+        with slots:
+            jobs[job_id] = "running"
+            time.sleep(process_seconds)
+        jobs[job_id] = "done"
+        if callback_url:
+            try:
+                requests.post(callback_url, json={"job_id": job_id, "status": "done"}, timeout=10)
+            except requests.RequestException:
+                pass
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode())
+            route = urlparse(self.path).path
+            if route == '/video-processing':
+                with slots:
+                    time.sleep(process_seconds)
+                self._send(200, result, 'application/zip')
+            elif route == '/video-processing/jobs':
+                job_id = f"job{len(jobs) + 1:03d}"
+                jobs[job_id] = "queued"
+                callback_url = form.get('callback_url', [''])[0]
+                threading.Thread(target=process, args=(job_id, callback_url), daemon=True).start()
+                self._send(202, json.dumps({"job_id": job_id}).encode())
+            else:
+                self._send(404, b'{}')
+
+        def do_GET(self):
+            parts = urlparse(self.path).path.strip('/').split('/')
+            if len(parts) >= 3 and parts[:2] == ['video-processing', 'jobs'] and parts[2] in jobs:
+                if len(parts) == 4 and parts[3] == 'result' and jobs[parts[2]] == "done":
+                    self._send(200, result, 'application/zip')
+                    return
+                if len(parts) == 3:
+                    self._send(200, json.dumps({"status": jobs[parts[2]]}).encode())
+                    return
+            self._send(404, b'{}')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_demo(videos=6, process_seconds=2.0, workers=4, poll_seconds=1.0):
+    """
+    Blocking requests vs submit-then-poll vs callbacks against a local stand-in server.
+
+    The worker's busy time is how long it is tied up before it can move on to
+    other files; "all results" is when the last zip is on disk.
+    """
+    print(f"{videos} videos, {process_seconds:.1f}s of server-side processing each, "
+          f"{workers} at a time on the server; polling every {poll_seconds:.1f}s")
+    print(f"{'mode':<10}{'worker busy':>13}{'all results':>13}{'zips':>7}{'woken':>7}")
+    options = {"use_cache": False, "use_translation_cache": False, "use_metadata_cache": False}
+
+    for mode in ("blocking", "poll", "callback"):
+        server = _standin_processing_server(process_seconds, workers)
+        base = f"http://127.0.0.1:{server.server_port}/video-processing"
+        work_dir = tempfile.mkdtemp(prefix="processing_jobs_demo_")
+        queue_path = os.path.join(work_dir, "queue_list.txt")
+        state_path = os.path.join(work_dir, "queue_state.json")
+        sources = []
+        for index in range(videos):
+            source = os.path.join(work_dir, f"IMG_{index:04d}.MOV")
+            with open(source, 'wb') as f:
+                f.write(b"\0" * 1024)
+            sources.append(source)
+        with open(queue_path, 'w') as f:
+            f.writelines(f"{source}\n" for source in sources)
+        state = {}
+        for source in sources:
+            record_deferral(state, source, 3600)
+        save_state(state_path, state)
+
+        listener = None
+        client = ProcessingClient(f"{base}/jobs", f"{base}/jobs/{{video_id}}", f"{base}/jobs/{{video_id}}/result",
+                                  store_path=os.path.join(work_dir, "processing_jobs.json"))
+        collector = Collector(client, queue_path, state_path, os.path.join(work_dir, "queue.lock"),
+                              poll_seconds if mode == "poll" else 3600)
+        if mode == "callback":
+            listener = serve_callbacks(collector, port=0)
+            client.callback_url = f"http://127.0.0.1:{listener.server_port}/processed"
+
+        zip_paths = [os.path.join(work_dir, f"{os.path.basename(source)}.zip") for source in sources]
+        stop = threading.Event()
+        start_time = time.monotonic()
+        with open(os.devnull, 'w') as quiet:
+            stdout, sys.stdout = sys.stdout, quiet
+            stderr, sys.stderr = sys.stderr, quiet
+            try:
+                for source, zip_path in zip(sources, zip_paths):
+                    if mode == "blocking":
+                        response = requests.post(base, data={'file_path': source}, stream=True, timeout=600)
+                        save_processing_result(response, zip_path, source, options)
+                    else:
+                        client.submit(source, source, source, zip_path, options, os.path.join(work_dir, "ckpt"))
+                busy = time.monotonic() - start_time
+                if mode != "blocking":
+                    threading.Thread(target=collector.run, args=(stop,), daemon=True).start()
+                    while client.store.pending():
+                        time.sleep(0.05)
+                    stop.set()
+                    collector.wake.set()
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+        finished = time.monotonic() - start_time
+        zips = [path for path in zip_paths if os.path.exists(path)]
+        woken = sum(1 for entry in load_state(state_path).values() if entry["next_attempt_at"] <= time.time())
+        print(f"{mode:<10}{busy:>12.1f}s{finished:>12.1f}s{len(zips):>5}/{videos}{woken:>7}")
+        server.shutdown()
+        if listener is not None:
+            listener.shutdown()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Background server-side processing jobs")
+    parser.add_argument('--store', default=DEFAULT_STORE, help="Pending job store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    collect_parser = subparsers.add_parser('collect', help="Collect finished jobs and wake their queue entries")
+    collect_parser.add_argument('--status-url', required=True, help="Job status endpoint ({video_id} = job id)")
+    collect_parser.add_argument('--result-url', required=True, help="Job result endpoint ({video_id} = job id)")
+    collect_parser.add_argument('--queue', help="Path to queue_list.txt")
+    collect_parser.add_argument('--queue-state', help="Path to the queue scheduler state")
+    collect_parser.add_argument('--queue-lock', help="QUEUE_LOCK file")
+    collect_parser.add_argument('--change-feed', help="Transcription change feed")
+    collect_parser.add_argument('--transcription-dir', help="Root of the change feed")
+    collect_parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS)
+    collect_parser.add_argument('--callback-host', default='127.0.0.1')
+    collect_parser.add_argument('--callback-port', type=int, help="Run the callback listener on this port")
+
+    subparsers.add_parser('list', help="Print the jobs still on the server")
+
+    demo_parser = subparsers.add_parser('demo', help="Blocking vs background processing against a local stand-in")
+    demo_parser.add_argument('--videos', type=int, default=6)
+    demo_parser.add_argument('--process-seconds', type=float, default=2.0)
+    demo_parser.add_argument('--workers', type=int, default=4, help="Videos the stand-in processes at a time")
+    demo_parser.add_argument('--poll-seconds', type=float, default=1.0)
+
+    args = parser.parse_args()
+    if args.command == 'demo':
+        run_demo(args.videos, args.process_seconds, args.workers, args.poll_seconds)
+    elif args.command == 'list':
+        for job_id, entry in JobStore(args.store).pending().items():
+            age = time.time() - entry["submitted_at"]
+            print(f"{job_id}\t{entry['source']}\tsubmitted {age / 60:.0f} min ago")
+    else:
+        if args.queue and not (args.queue_state and args.queue_lock):
+            parser.error("--queue needs --queue-state and --queue-lock")
+        client = ProcessingClient(None, args.status_url, args.result_url, store_path=args.store)
+        change_feed = ChangeFeed(args.change_feed, args.transcription_dir) if args.change_feed else None
+        collector = Collector(client, args.queue, args.queue_state, args.queue_lock, args.poll_seconds, change_feed)
+        if args.callback_port:
+            serve_callbacks(collector, args.callback_host, args.callback_port)
+            print(f"Processing callbacks on {args.callback_host}:{args.callback_port}")
+        print(f"Collecting background processing jobs from {args.store} every {args.poll_seconds:.0f}s")
+        try:
+            collector.run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# publish_coalescer.py - Collects app-API publish requests and submits them to the publish service in batches
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_PORT = 8766
+DEFAULT_LINGER_SECONDS = 1.0
+DEFAULT_MAX_DELAY_SECONDS = 5.0
+DEFAULT_MAX_BATCH = 10
+
+# Statuses meaning "this service has no batch endpoint"
+_NO_BATCH_ENDPOINT = {404, 405, 501}
+
+
+def format_video_url(url, video_id):
+    """
+    Fill an app-API endpoint template with a video (or job) id.
+
+    The `{video_id}` placeholder is used if present, otherwise `{id}`; a URL
+    without either is returned unchanged.
+    """
+    if not url or video_id is None:
+        return url
+    if "{video_id}" in url:
+        return url.replace("{video_id}", str(video_id))
+    if "{id}" in url:
+        return url.replace("{id}", str(video_id))
+    return url
+
+
+class PendingPublish:
+    """One publish request waiting for its batch."""
+
+    def __init__(self, video_id, payload):
+        self.video_id = str(video_id)
+        self.payload = payload
+        self.arrived = time.monotonic()
+        self.done = threading.Event()
+        self.status = None
+        self.body = None
+
+    def resolve(self, status, body):
+        self.status, self.body = status, body
+        self.done.set()
+
+
+class PublishCoalescer:
+    """
+    Coalesces publish requests for several videos into one batched call.
+
+    A batch is sent when `max_batch` requests are waiting, when no new request
+    arrived for `linger_seconds`, or at the latest `max_delay_seconds` after
+    its first request, so a lone video waits at most `linger_seconds`. The
+    batch is one POST of {"items": [{"video_id", "platforms", "test"}, ...]}
+    to `batch_url`; the reply maps each video_id to its result, under
+    "results" ({video_id: result}) or as an "items" list. Each result is
+    handed back to the request that submitted it in the shape the single
+    publish endpoint returns, so callers cannot tell the difference. If the
+    service has no batch endpoint, requests are sent one by one to
+    `publish_url` (a `{video_id}` template).
+    """
+
+    def __init__(self, publish_url, batch_url=None, linger_seconds=DEFAULT_LINGER_SECONDS,
+                 max_delay_seconds=DEFAULT_MAX_DELAY_SECONDS, max_batch=DEFAULT_MAX_BATCH, timeout=600):
+        self.publish_url = publish_url
+        self.batch_url = batch_url
+        self.linger_seconds = linger_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.pending = []
+        self.condition = threading.Condition()
+        self.counters = {"requests": 0, "batches": 0, "single_calls": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name="publish-coalescer", daemon=True)
+        self._thread.start()
+
+    def submit(self, video_id, payload):
+        """
+        Queue one publish request and wait for its result.
+
+        The wait is bounded by the batch delay plus a batch call and a single
+        call; past that the request is answered with a 504 of its own.
+
+        Returns:
+            tuple: (HTTP status, JSON body) for this video.
+        """
+        item = PendingPublish(video_id, payload)
+        with self.condition:
+            self.pending.append(item)
+            self.counters["requests"] += 1
+            self.condition.notify()
+        if not item.done.wait(self.max_delay_seconds + 2 * self.timeout):
+            with self.condition:
+                if item in self.pending:
+                    self.pending.remove(item)
+                self.counters["failed"] += 1
+            return 504, {"error": "publish coalescer did not answer in time"}
+        return item.status, item.body
+
+    def _due(self, now):
+        """Seconds until the pending batch must go out (0 = now)."""
+        if len(self.pending) >= self.max_batch:
+            return 0.0
+        first, last = self.pending[0].arrived, self.pending[-1].arrived
+        return max(0.0, min(last + self.linger_seconds, first + self.max_delay_seconds) - now)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                wait = self._due(time.monotonic())
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # Keep the thread alive; whoever is still waiting gets an error
+                self._fail([item for item in batch if not item.done.is_set()], 502,
+                           f"publish coalescer error: {e}")
+
+    def _flush(self, batch):
+        if self.batch_url and len(batch) > 1:
+            try:
+                self._send_batch(batch)
+                return
+            except _NoBatchEndpoint:
+                print(f"{self.batch_url} has no batch endpoint; publishing one by one")
+                self.batch_url = None
+        for item in batch:
+            self._send_single(item)
+
+    def _send_batch(self, batch):
+        body = {"items": [{"video_id": item.video_id, **item.payload} for item in batch]}
+        self.counters["batches"] += 1
+        try:
+            response = requests.post(self.batch_url, json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            self._fail(batch, 502, f"batch publish failed: {e}")
+            return
+        if response.status_code in _NO_BATCH_ENDPOINT:
+            raise _NoBatchEndpoint()
+        if not response.ok:
+            self._fail(batch, response.status_code, f"batch publish returned {response.status_code}")
+            return
+        try:
+            results = _results_by_video(response.json())
+        except ValueError:
+            self._fail(batch, 502, "batch publish returned invalid JSON")
+            return
+        print(f"Published a batch of {len(batch)}: {', '.join(item.video_id for item in batch)}")
+        for item in batch:
+            result = results.get(item.video_id)
+            if result is None:
+                self.counters["failed"] += 1
+                item.resolve(502, {"error": "missing from the batch response"})
+            else:
+                item.resolve(*_as_single_response(result))
+
+    def _send_single(self, item):
+        self.counters["single_calls"] += 1
+        try:
+            response = requests.post(format_video_url(self.publish_url, item.video_id),
+                                     json=item.payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            self._fail([item], 502, f"publish failed: {e}")
+            return
+        try:
+            body = response.json()
+        except ValueError:
+            body = {"text": response.text}
+        item.resolve(response.status_code, body)
+
+    def _fail(self, batch, status, message):
+        print(message)
+        self.counters["failed"] += len(batch)
+        for item in batch:
+            item.resolve(status, {"error": message})
+
+    def status(self):
+        with self.condition:
+            return {**self.counters, "pending": len(self.pending)}
+
+
+class _NoBatchEndpoint(Exception):
+    pass
+
+
+def _results_by_video(payload):
+    """Per-video results of a batch reply: {"results": {id: ...}} or {"items": [{"video_id", ...}]}."""
+    if isinstance(payload, dict) and isinstance(payload.get("results"), dict):
+        return {str(video_id): result for video_id, result in payload["results"].items()}
+    items = payload.get("items") if isinstance(payload, dict) else payload
+    if isinstance(items, list):
+        return {str(item["video_id"]): item for item in items if isinstance(item, dict) and "video_id" in item}
+    raise ValueError("unrecognised batch response")
+
+
+def _as_single_response(result):
+    """
+    (status, body) of one batch item as the single publish endpoint would answer.
+
+    An item may carry its own "status"/"ok"; a bare platform mapping becomes
+    {"results": mapping}, which published_platforms_from_response understands.
+    """
+    if not isinstance(result, dict):
+        return (200 if result else 502), {"results": {}} if result else {"error": str(result)}
+    status = result.get("status")
+    if not isinstance(status, int):
+        status = 200 if result.get("ok", True) else 502
+    if "results" in result or "platforms" in result or "error" in result:
+        return status, result
+    return status, {"results": {k: v for k, v in result.items() if k not in ("video_id", "status", "ok")}}
+
+
+def serve(coalescer, host='127.0.0.1', port=DEFAULT_PORT):
+    """
+    Run the coalescer's HTTP API.
+
+    POST /publish/<video_id> {"platforms", "test"} -> the publish service's answer for this video
+    GET  /status                                   -> request, batch and fallback counters
+
+    Returns:
+        ThreadingHTTPServer: The running server (serve_forever runs in a thread).
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            route = urlparse(self.path).path
+            if not route.startswith('/publish/') or not route[len('/publish/'):]:
+                self._send_json(404, {"error": "unknown endpoint"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            except ValueError:
+                self._send_json(400, {"error": "invalid JSON"})
+                return
+            status, body = coalescer.submit(route[len('/publish/'):], payload)
+            self._send_json(status, body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/status':
+                self._send_json(200, coalescer.status())
+            else:
+                self._send_json(404, {"error": "unknown endpoint"})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _standin_publish_service(call_seconds, batch=True):
+    """
+    A local stand-in for the publish service: every call, single or batched,
+    costs `call_seconds` (starting the browser automation) and calls are
+    handled one at a time, as the backends do.
+    """
+    lock = threading.Lock()
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            route = urlparse(self.path).path
+            with lock:
+                time.sleep(call_seconds)
+                calls.append(route)
+            if route.endswith('/batch'):
+                if not batch:
+                    code, body = 404, {"error": "not found"}
+                else:
+                    code, body = 200, {"results": {
+                        item["video_id"]: {name: "published" for name, on in item["platforms"].items() if on}
+                        for item in payload["items"]
+                    }}
+            else:
+                code, body = 200, {"results": {name: "published" for name, on in payload["platforms"].items() if on}}
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, calls
+
+
+def run_demo(burst=12, call_seconds=0.5, linger_seconds=DEFAULT_LINGER_SECONDS,
+             max_delay_seconds=DEFAULT_MAX_DELAY_SECONDS, max_batch=DEFAULT_MAX_BATCH):
+    """
+    A burst of publish requests plus a lone one, sent directly and through
+    the coalescer, against a local stand-in of the publish service.
+    """
+    payload = {"platforms": {"bilibili": True, "youtube": True, "douyin": False}, "test": True}
+    print(f"Burst of {burst} publish requests, then a lone one; each publish service call takes "
+          f"{call_seconds:.1f}s. Coalescer: linger {linger_seconds:.1f}s, max delay {max_delay_seconds:.1f}s, "
+          f"max batch {max_batch}")
+    print(f"{'mode':<12}{'service calls':>14}{'burst p50':>11}{'burst max':>11}{'lone':>8}{'published':>11}")
+
+    for mode in ("direct", "coalesced"):
+        service, calls = _standin_publish_service(call_seconds)
+        base = f"http://127.0.0.1:{service.server_port}"
+        publish_url = f"{base}/api/videos/{{video_id}}/publish"
+        coalescer_server = None
+        if mode == "coalesced":
+            coalescer = PublishCoalescer(publish_url, f"{base}/api/videos/publish/batch",
+                                         linger_seconds, max_delay_seconds, max_batch)
+            coalescer_server = serve(coalescer, port=0)
+            publish_url = f"http://127.0.0.1:{coalescer_server.server_port}/publish/{{video_id}}"
+
+        def publish(video_id):
+            start_time = time.monotonic()
+            response = requests.post(format_video_url(publish_url, video_id), json=payload, timeout=120)
+            ok = response.ok and response.json().get("results", {}).get("bilibili") == "published"
+            return time.monotonic() - start_time, ok
+
+        with ThreadPoolExecutor(max_workers=burst) as executor:
+            results = list(executor.map(publish, [f"v{i:03d}" for i in range(burst)]))
+        lone_latency, lone_ok = publish("lone")
+        latencies = sorted(latency for latency, _ in results)
+        published = sum(ok for _, ok in results) + lone_ok
+        print(f"{mode:<12}{len(calls):>14}{latencies[len(latencies) // 2]:>10.1f}s{latencies[-1]:>10.1f}s"
+              f"{lone_latency:>7.1f}s{published:>7}/{burst + 1}")
+        service.shutdown()
+        if coalescer_server is not None:
+            coalescer_server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch app-API publish requests")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="Accept publish requests and forward them in batches")
+    serve_parser.add_argument('--publish-url', required=True, help="Single publish endpoint ({video_id} template)")
+    serve_parser.add_argument('--batch-url', help="Batch publish endpoint (one by one if unset or missing)")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument('--linger', type=float, default=DEFAULT_LINGER_SECONDS,
+                              help="Send the batch once no request arrived for this long (s)")
+    serve_parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY_SECONDS,
+                              help="Longest a request waits for its batch (s)")
+    serve_parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH, help="Requests per batch")
+
+    demo_parser = subparsers.add_parser('demo', help="Direct vs coalesced publishing against a local stand-in")
+    demo_parser.add_argument('--burst', type=int, default=12, help="Requests in the burst")
+    demo_parser.add_argument('--call-seconds', type=float, default=0.5, help="Cost of one publish service call")
+    demo_parser.add_argument('--linger', type=float, default=DEFAULT_LINGER_SECONDS)
+    demo_parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY_SECONDS)
+    demo_parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH)
+
+    args = parser.parse_args()
+    if args.command == 'demo':
+        run_demo(args.burst, args.call_seconds, args.linger, args.max_delay, args.max_batch)
+    else:
+        coalescer = PublishCoalescer(args.publish_url, args.batch_url, args.linger, args.max_delay, args.max_batch)
+        server = serve(coalescer, args.host, args.port)
+        print(f"Publish coalescer on {args.host}:{args.port} -> {args.batch_url or args.publish_url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -9,12 +9,11 @@ echo_with_timestamp() {
     echo "$(date '+%Y-%m-%d %H:%M:%S') - $1"
 }
 
-# Define video file pattern
-VIDEO_PATTERN=".*\.(mp4|mov|avi|flv|wmv|mkv)$"
-
 # Initialize variables
 AUTO_CONFIRM=false
 PATTERN=""
+PRIORITY=0
+SEARCH_FILTERS=()
 
 # Parse command line arguments
 while [[ $# -gt 0 ]]; do
@@ -23,6 +22,18 @@ while [[ $# -gt 0 ]]; do
             AUTO_CONFIRM=true
             shift
             ;;
+        -p|--priority)
+            PRIORITY="$2"
+            shift 2
+            ;;
+        -u|--unprocessed)
+            SEARCH_FILTERS+=(--unprocessed)
+            shift
+            ;;
+        --min-duration|--max-duration|--since|--until)
+            SEARCH_FILTERS+=("$1" "$2")
+            shift 2
+            ;;
         *)
             PATTERN="$1"
             shift
@@ -30,10 +41,19 @@ while [[ $# -gt 0 ]]; do
     esac
 done
 
-if [ -z "$PATTERN" ]; then
-    echo "Usage: $0 [-y|--yes] <pattern_or_filepath>"
+if [ -z "$PATTERN" ] && [ ${#SEARCH_FILTERS[@]} -eq 0 ]; then
+    echo "Usage: $0 [-y|--yes] [-p|--priority N] [filters] <pattern_or_filepath>"
     echo "  -y, --yes    Auto-confirm file selection (no prompt)"
-    echo "  pattern      Search pattern or full filepath"
+    echo "  -p, --priority N  Scheduling priority (higher runs first, default 0)"
+    echo "  -u, --unprocessed   Only files not in the processed ledger yet"
+    echo "  --min-duration S, --max-duration S  Duration bounds in seconds"
+    echo "  --since DATE, --until DATE  Recording date range (YYYY-MM-DD[ HH:MM])"
+    echo "  pattern      Search pattern (substring, or glob with * ? [) or full filepath"
+    exit 1
+fi
+
+if ! [[ "$PRIORITY" =~ ^-?[0-9]+$ ]]; then
+    echo "Priority must be an integer: $PRIORITY"
     exit 1
 fi
 
@@ -41,17 +61,21 @@ fi
 add_to_queue() {
     local file_path="$1"
     
-    echo_with_timestamp "Adding to queue: $file_path"
+    echo_with_timestamp "Adding to queue: $file_path (priority $PRIORITY)"
     
     {
         flock -x 200
-        echo "$file_path" >> "$QUEUE_LIST"
+        if [ "$PRIORITY" -eq 0 ]; then
+            echo "$file_path" >> "$QUEUE_LIST"
+        else
+            printf '%s\t%s\n' "$file_path" "$PRIORITY" >> "$QUEUE_LIST"
+        fi
         echo_with_timestamp "Successfully added to queue: $file_path"
     } 200>"$QUEUE_LOCK"
 }
 
 # Check if the pattern is a full file path
-if [ -f "$PATTERN" ]; then
+if [ -n "$PATTERN" ] && [ -f "$PATTERN" ]; then
     # It's a direct file path
     add_to_queue "$PATTERN"
 else
@@ -60,11 +84,14 @@ else
     
     while IFS= read -r -d $'\0' file; do
         MATCHING_FILES+=("$file")
-    done < <(find "$AUTOPUBLISH_DIR" -type f -regex "$VIDEO_PATTERN" -name "*${PATTERN}*" -print0)
+    done < <(python3 "${MEDIA_CATALOG_PY}" --db "${MEDIA_CATALOG_DB}" --root "${AUTOPUBLISH_DIR}" \
+        --ledger "${PROCESSED_PATH}" --queue "${QUEUE_LIST}" --queue-state "${QUEUE_STATE}" \
+        --failed-list "${FAILED_LIST}" --probe-cache-dir "${PROBE_CACHE_DIR}" \
+        search ${PATTERN:+"$PATTERN"} "${SEARCH_FILTERS[@]}" --print0)
     
     # No matching files found
     if [ ${#MATCHING_FILES[@]} -eq 0 ]; then
-        echo_with_timestamp "No matching files found for pattern: $PATTERN"
+        echo_with_timestamp "No matching files found for pattern: $PATTERN ${SEARCH_FILTERS[*]}"
         exit 1
     fi
     
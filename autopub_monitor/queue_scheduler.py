@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# queue_scheduler.py - Scheduling policies and retry backoff for the processing queue
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+from dataclasses import dataclass, field
+
+from media_probe import probe_video, estimate_processing_cost, DEFAULT_PROBE_CACHE_DIR, DEFAULT_SPECULATIVE_DIR
+
+POLICIES = ("fifo", "priority", "sjf", "aging")
+DEFAULT_POLICY = "aging"
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE = 60.0
+DEFAULT_BACKOFF_MAX = 3600.0
+DEFAULT_AGING_SECONDS = 600.0
+
+# Arrival timestamps that autopub_sync.sh and the cameras put into filenames
+TIMESTAMP_PATTERNS = (
+    (re.compile(r'(\d{4})_(\d{2})_(\d{2})_(\d{2})_(\d{2})_(\d{2})_COMPLETED'), '%Y%m%d%H%M%S'),
+    (re.compile(r'VID_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})'), '%Y%m%d%H%M%S'),
+    (re.compile(r'(\d{4})-(\d{2})-(\d{2})'), '%Y%m%d'),
+)
+
+
+@dataclass
+class Job:
+    """One entry of queue_list.txt together with its scheduling state."""
+    path: str
+    priority: int = 0
+    index: int = 0
+    enqueued_at: float = 0.0
+    attempts: int = 0
+    next_attempt_at: float = 0.0
+    cost: float = 0.0
+    last_error: str = ""
+    extra: dict = field(default_factory=dict)
+
+
+def parse_queue_line(line):
+    """
+    Split a queue line into path and manual priority.
+
+    Lines are either a bare path (priority 0) or `path<TAB>priority`, as
+    written by `queue_file_utility.sh --priority`.
+    """
+    line = line.rstrip('\n')
+    if '\t' in line:
+        path, _, priority = line.rpartition('\t')
+        try:
+            return path, int(priority)
+        except ValueError:
+            return line, 0
+    return line, 0
+
+
+def parse_arrival(filename):
+    """Arrival time encoded in a ledger filename, or None."""
+    for pattern, fmt in TIMESTAMP_PATTERNS:
+        matches = pattern.findall(filename)
+        if matches:
+            try:
+                return datetime.strptime(''.join(matches[-1]), fmt)
+            except ValueError:
+                continue
+    return None
+
+
+def read_queue(queue_path):
+    """Return (path, priority) tuples for every non-empty line of the queue file."""
+    if not os.path.exists(queue_path):
+        return []
+    with open(queue_path) as f:
+        return [parse_queue_line(line) for line in f if line.strip()]
+
+
+def job_priority(queue_path, job_path):
+    """Manual priority of a queued path (the highest if it is queued twice), 0 if not queued."""
+    priorities = [priority for path, priority in read_queue(queue_path) if path == job_path]
+    return max(priorities, default=0)
+
+
+def remove_from_queue(queue_path, job_path):
+    """Remove the first queue line that refers to job_path. Returns True if a line was removed."""
+    if not os.path.exists(queue_path):
+        return False
+    with open(queue_path) as f:
+        lines = f.readlines()
+
+    kept, removed = [], False
+    for line in lines:
+        if not removed and line.strip() and parse_queue_line(line)[0] == job_path:
+            removed = True
+            continue
+        kept.append(line)
+
+    if removed:
+        temp_path = f"{queue_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.writelines(kept)
+        os.replace(temp_path, queue_path)
+    return removed
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_path, state):
+    temp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(temp_path, state_path)
+
+
+def backoff_delay(attempts, base=DEFAULT_BACKOFF_BASE, maximum=DEFAULT_BACKOFF_MAX):
+    """Exponential backoff after the given number of failed attempts."""
+    return min(maximum, base * (2 ** max(0, attempts - 1)))
+
+
+def schedule_key(job, policy, now, aging_seconds=DEFAULT_AGING_SECONDS):
+    """
+    Sort key for a job under a policy; the smallest key runs first.
+
+    - fifo: queue order only.
+    - priority: manual priority, then queue order.
+    - sjf: shortest estimated cost, then queue order.
+    - aging: manual priority, then estimated cost discounted by waiting time,
+      so a long job is not starved forever by a stream of short ones.
+    """
+    if policy == "fifo":
+        return (job.index,)
+    if policy == "priority":
+        return (-job.priority, job.index)
+    if policy == "sjf":
+        return (job.cost, job.index)
+    if policy == "aging":
+        waited = max(0.0, now - job.enqueued_at)
+        return (-job.priority, job.cost / (1.0 + waited / aging_seconds), job.index)
+    raise ValueError(f"Unknown scheduling policy: {policy}")
+
+
+def pick_next(jobs, policy=DEFAULT_POLICY, now=None, aging_seconds=DEFAULT_AGING_SECONDS):
+    """
+    Choose the next job to run among jobs whose backoff has expired.
+
+    Returns:
+        Job or None: The selected job, or None if nothing is eligible yet.
+    """
+    now = time.time() if now is None else now
+    eligible = [job for job in jobs if job.next_attempt_at <= now]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda job: schedule_key(job, policy, now, aging_seconds))
+
+
+def pick_urgent(jobs, running_path, policy=DEFAULT_POLICY, now=None, aging_seconds=DEFAULT_AGING_SECONDS):
+    """
+    Choose a job that should preempt the running one: an eligible job with a
+    higher manual priority. Returns None if nothing outranks it.
+    """
+    running_priority = max((job.priority for job in jobs if job.path == running_path), default=0)
+    candidates = [job for job in jobs if job.path != running_path and job.priority > running_priority]
+    return pick_next(candidates, policy, now, aging_seconds)
+
+
+def load_jobs(queue_path, state, probe_cache_dir=DEFAULT_PROBE_CACHE_DIR, now=None,
+              speculative_dir=DEFAULT_SPECULATIVE_DIR):
+    """
+    Build Job objects for the queue and reconcile the persisted state with it.
+
+    New queue entries get an enqueue time and a cost estimate from the probe
+    cache; state for paths no longer in the queue is dropped.
+    """
+    now = time.time() if now is None else now
+    jobs = []
+    for index, (path, priority) in enumerate(read_queue(queue_path)):
+        entry = state.get(path)
+        if entry is None:
+            summary = probe_video(path, cache_dir=probe_cache_dir, speculative_dir=speculative_dir) \
+                if os.path.exists(path) else None
+            entry = {
+                "enqueued_at": now,
+                "attempts": 0,
+                "next_attempt_at": 0.0,
+                "cost": estimate_processing_cost(summary),
+            }
+            state[path] = entry
+        jobs.append(Job(
+            path=path,
+            priority=priority,
+            index=index,
+            enqueued_at=entry.get("enqueued_at", now),
+            attempts=entry.get("attempts", 0),
+            next_attempt_at=entry.get("next_attempt_at", 0.0),
+            cost=entry.get("cost", 0.0),
+            last_error=entry.get("last_error", ""),
+        ))
+
+    queued_paths = {job.path for job in jobs}
+    for path in list(state):
+        if path not in queued_paths:
+            del state[path]
+    return jobs
+
+
+def record_failure(state, job_path, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                   backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                   error="", now=None):
+    """
+    Count a failed attempt and schedule the retry.
+
+    Returns:
+        bool: True if the job has exhausted its attempts and should be dropped.
+    """
+    now = time.time() if now is None else now
+    entry = state.setdefault(job_path, {"enqueued_at": now, "attempts": 0, "cost": 0.0})
+    entry["attempts"] = entry.get("attempts", 0) + 1
+    entry["last_error"] = error
+    entry["next_attempt_at"] = now + backoff_delay(entry["attempts"], backoff_base, backoff_max)
+    return entry["attempts"] >= max_attempts
+
+
+def fail_job(queue_path, state, job_path, max_attempts=DEFAULT_MAX_ATTEMPTS,
+             backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+             error="", failed_list=None):
+    """
+    Record a failed attempt; drop the job to the failed list once its attempts are exhausted.
+
+    Returns:
+        bool: True if the job was dropped.
+    """
+    exhausted = record_failure(
+        state, job_path, max_attempts=max_attempts,
+        backoff_base=backoff_base, backoff_max=backoff_max, error=error,
+    )
+    if exhausted:
+        remove_from_queue(queue_path, job_path)
+        state.pop(job_path, None)
+        if failed_list:
+            with open(failed_list, 'a') as f:
+                f.write(f"{job_path}\n")
+        print(f"Dropped after {max_attempts} attempts: {job_path}", file=sys.stderr)
+    else:
+        entry = state[job_path]
+        delay = entry["next_attempt_at"] - time.time()
+        print(f"Retry {entry['attempts']}/{max_attempts} for {job_path} in {delay:.0f}s", file=sys.stderr)
+    return exhausted
+
+
+def record_deferral(state, job_path, delay, now=None):
+    """Postpone a job without counting an attempt (e.g. not enough disk space right now)."""
+    now = time.time() if now is None else now
+    entry = state.setdefault(job_path, {"enqueued_at": now, "attempts": 0, "cost": 0.0})
+    entry["next_attempt_at"] = now + delay
+
+
+def simulate(policy, arrivals, service_time, failure_rate=0.0, max_attempts=DEFAULT_MAX_ATTEMPTS,
+             backoff_base=DEFAULT_BACKOFF_BASE, aging_seconds=DEFAULT_AGING_SECONDS, seed=23):
+    """
+    Replay arrivals through a single worker using pick_next.
+
+    Args:
+        policy (str): Scheduling policy name.
+        arrivals (list): Job objects with enqueued_at and cost set.
+        service_time (callable): Maps a Job to its actual processing time.
+        failure_rate (float): Probability that an attempt fails.
+
+    Returns:
+        dict: Completion time-to-publish per path and the paths that were dropped.
+    """
+    rng = random.Random(seed)
+    pending = sorted(arrivals, key=lambda job: job.enqueued_at)
+    queue, done, dropped = [], {}, []
+    now = 0.0
+    next_index = 0
+
+    while pending or queue:
+        while pending and pending[0].enqueued_at <= now:
+            job = pending.pop(0)
+            job.index = next_index
+            next_index += 1
+            queue.append(job)
+
+        job = pick_next(queue, policy, now, aging_seconds)
+        if job is None:
+            wake_times = [j.next_attempt_at for j in queue]
+            if pending:
+                wake_times.append(pending[0].enqueued_at)
+            now = min(wake_times)
+            continue
+
+        now += service_time(job)
+        if rng.random() < failure_rate:
+            job.attempts += 1
+            if job.attempts >= max_attempts:
+                queue.remove(job)
+                dropped.append(job.path)
+            else:
+                job.next_attempt_at = now + backoff_delay(job.attempts, backoff_base)
+            continue
+
+        queue.remove(job)
+        done[job.path] = now - job.enqueued_at
+
+    return {"time_to_publish": done, "dropped": dropped}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def synthetic_workload(count=200, long_fraction=0.05, mean_interarrival=150.0, seed=23):
+    """Mostly 15-second phone clips with occasional 40-minute screen recordings."""
+    rng = random.Random(seed)
+    jobs, now = [], 0.0
+    for i in range(count):
+        now += rng.expovariate(1.0 / mean_interarrival)
+        is_long = rng.random() < long_fraction
+        duration = 2400.0 if is_long else rng.uniform(8.0, 40.0)
+        summary = {"duration": duration, "width": 1920, "height": 1080}
+        jobs.append(Job(
+            path=f"clip_{i:04d}_{'long' if is_long else 'short'}.mp4",
+            priority=1 if rng.random() < 0.05 else 0,
+            enqueued_at=now,
+            cost=estimate_processing_cost(summary),
+        ))
+    return jobs
+
+
+def run_benchmark(count, failure_rate, seed):
+    print(f"Simulating {count} jobs (failure rate {failure_rate:.0%}) on one worker")
+    print(f"{'policy':<10} {'mean (s)':>10} {'p95 (s)':>10} {'max (s)':>10} {'dropped':>8}")
+    for policy in POLICIES:
+        workload = synthetic_workload(count=count, seed=seed)
+        rng = random.Random(seed)
+        result = simulate(
+            policy, workload,
+            service_time=lambda job: job.cost * rng.uniform(0.8, 1.2),
+            failure_rate=failure_rate, seed=seed,
+        )
+        times = list(result["time_to_publish"].values())
+        mean = sum(times) / len(times) if times else 0.0
+        print(f"{policy:<10} {mean:>10.1f} {percentile(times, 95):>10.1f} "
+              f"{max(times, default=0.0):>10.1f} {len(result['dropped']):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick, complete and retry jobs from queue_list.txt")
+    parser.add_argument('--queue', help="Path to queue_list.txt")
+    parser.add_argument('--state', help="Path to the scheduler state file")
+    parser.add_argument('--policy', default=DEFAULT_POLICY, choices=POLICIES, help="Scheduling policy")
+    parser.add_argument('--probe-cache-dir', default=DEFAULT_PROBE_CACHE_DIR, help="Probe cache directory")
+    parser.add_argument('--speculative-dir', default=DEFAULT_SPECULATIVE_DIR,
+                        help="Results checked while files were still syncing")
+    parser.add_argument('--aging-seconds', type=float, default=DEFAULT_AGING_SECONDS,
+                        help="Waiting time after which a job's cost counts half")
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help="Attempts before a job is dropped")
+    parser.add_argument('--backoff-base', type=float, default=DEFAULT_BACKOFF_BASE, help="Backoff after the first failure (s)")
+    parser.add_argument('--backoff-max', type=float, default=DEFAULT_BACKOFF_MAX, help="Maximum backoff (s)")
+    parser.add_argument('--failed-list', help="File that receives paths dropped after max attempts")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('next', help="Print the next job to run (empty if none is eligible)")
+    urgent_parser = subparsers.add_parser('urgent', help="Print a job that outranks the running one (empty if none)")
+    urgent_parser.add_argument('--running', required=True, help="Path of the job currently running")
+    done_parser = subparsers.add_parser('done', help="Remove a finished job from the queue")
+    done_parser.add_argument('path')
+    fail_parser = subparsers.add_parser('fail', help="Record a failed attempt and schedule a retry")
+    fail_parser.add_argument('path')
+    fail_parser.add_argument('--error', default="", help="Short description of the failure")
+    defer_parser = subparsers.add_parser('defer', help="Postpone a job without counting an attempt")
+    defer_parser.add_argument('path')
+    defer_parser.add_argument('--delay', type=float, default=DEFAULT_BACKOFF_BASE, help="Seconds to wait before retrying")
+    bench_parser = subparsers.add_parser('simulate', help="Compare policies on a synthetic backlog")
+    bench_parser.add_argument('--jobs', type=int, default=200, help="Number of simulated jobs")
+    bench_parser.add_argument('--failure-rate', type=float, default=0.02, help="Probability an attempt fails")
+    bench_parser.add_argument('--seed', type=int, default=23, help="Random seed")
+    args = parser.parse_args()
+
+    if args.command == 'simulate':
+        run_benchmark(args.jobs, args.failure_rate, args.seed)
+        return 0
+
+    if not args.queue or not args.state:
+        parser.error("--queue and --state are required")
+
+    # Callers hold QUEUE_LOCK (flock) around every invocation.
+    state = load_state(args.state)
+    jobs = load_jobs(args.queue, state, probe_cache_dir=args.probe_cache_dir, speculative_dir=args.speculative_dir)
+
+    if args.command == 'next':
+        job = pick_next(jobs, args.policy, aging_seconds=args.aging_seconds)
+        save_state(args.state, state)
+        if job is not None:
+            print(job.path)
+    elif args.command == 'urgent':
+        job = pick_urgent(jobs, args.running, args.policy, aging_seconds=args.aging_seconds)
+        save_state(args.state, state)
+        if job is not None:
+            print(job.path)
+    elif args.command == 'done':
+        remove_from_queue(args.queue, args.path)
+        state.pop(args.path, None)
+        save_state(args.state, state)
+    elif args.command == 'fail':
+        fail_job(
+            args.queue, state, args.path, max_attempts=args.max_attempts,
+            backoff_base=args.backoff_base, backoff_max=args.backoff_max,
+            error=args.error, failed_list=args.failed_list,
+        )
+        save_state(args.state, state)
+    elif args.command == 'defer':
+        record_deferral(state, args.path, args.delay)
+        save_state(args.state, state)
+        print(f"Deferred {args.path} for {args.delay:.0f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
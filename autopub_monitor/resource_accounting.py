@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# resource_accounting.py - Per-job CPU, memory and disk I/O accounting for media tools and Python
+
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import argparse
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_USAGE_LOG = os.path.expanduser('~/AutoPublishDATA/resource_usage.jsonl')
+DEFAULT_STAGE = "setup"
+
+# ru_inblock/ru_oublock count 512-byte blocks
+BLOCK_BYTES = 512
+
+_lock = threading.Lock()
+_job = None
+
+
+def usage_from_rusage(rusage):
+    """The fields of a struct rusage this module records (max RSS in KiB, I/O in bytes)."""
+    return {
+        "user": rusage.ru_utime,
+        "sys": rusage.ru_stime,
+        "max_rss_kib": rusage.ru_maxrss,
+        "read_bytes": rusage.ru_inblock * BLOCK_BYTES,
+        "write_bytes": rusage.ru_oublock * BLOCK_BYTES,
+    }
+
+
+class JobAccounting:
+    """
+    Resource usage of one job, attributed to the stage it was spent in.
+
+    Children reaped by media_runner are recorded one by one. The Python side
+    is measured with getrusage(RUSAGE_SELF) deltas taken whenever the current
+    stage changes, so a stage nested inside another (a fix inside the upload)
+    is charged only for its own time.
+    """
+
+    def __init__(self, job, log_path=DEFAULT_USAGE_LOG):
+        self.job = job
+        self.log_path = log_path
+        self.records = []
+        self.stages = [DEFAULT_STAGE]
+        self.python = {}
+        self._mark = (time.monotonic(), resource.getrusage(resource.RUSAGE_SELF))
+
+    @property
+    def stage(self):
+        return self.stages[-1]
+
+    def _charge_python(self):
+        """Add the Python usage since the last stage change to the current stage."""
+        now, rusage = time.monotonic(), resource.getrusage(resource.RUSAGE_SELF)
+        last_time, last = self._mark
+        self._mark = (now, rusage)
+        totals = self.python.setdefault(self.stage, {
+            "wall": 0.0, "user": 0.0, "sys": 0.0, "max_rss_kib": 0, "read_bytes": 0, "write_bytes": 0,
+        })
+        totals["wall"] += now - last_time
+        totals["user"] += rusage.ru_utime - last.ru_utime
+        totals["sys"] += rusage.ru_stime - last.ru_stime
+        totals["max_rss_kib"] = max(totals["max_rss_kib"], rusage.ru_maxrss)
+        totals["read_bytes"] += (rusage.ru_inblock - last.ru_inblock) * BLOCK_BYTES
+        totals["write_bytes"] += (rusage.ru_oublock - last.ru_oublock) * BLOCK_BYTES
+
+    def push(self, stage):
+        with _lock:
+            self._charge_python()
+            self.stages.append(stage)
+
+    def pop(self):
+        with _lock:
+            self._charge_python()
+            if len(self.stages) > 1:
+                self.stages.pop()
+
+    def record_process(self, args, wall, rusage, returncode, suspended=0.0):
+        with _lock:
+            self.records.append({
+                "kind": "child",
+                "job": self.job,
+                "stage": self.stage,
+                "command": os.path.basename(args[0]),
+                "args": " ".join(args[1:])[:200],
+                "wall": wall,
+                "suspended": suspended,
+                "returncode": returncode,
+                **usage_from_rusage(rusage),
+            })
+
+    def finish(self):
+        """Close the Python accounting and append every record to the usage log."""
+        with _lock:
+            self._charge_python()
+            records = self.records + [
+                {"kind": "python", "job": self.job, "stage": stage, "command": "python", **totals}
+                for stage, totals in self.python.items()
+            ]
+        finished = time.time()
+        for record in records:
+            record["at"] = finished
+        try:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            with open(self.log_path, 'a') as f:
+                f.write(''.join(json.dumps(record) + '\n' for record in records))
+        except OSError as e:
+            print(f"Warning: could not write resource usage to {self.log_path}: {e}")
+        return records
+
+
+def record_process(args, wall, rusage, returncode, suspended=0.0):
+    """Attribute a reaped child to the current job and stage (no-op outside a job)."""
+    job = _job
+    if job is not None:
+        job.record_process(args, wall, rusage, returncode, suspended)
+
+
+@contextmanager
+def stage(name):
+    """Charge the usage inside the block to a stage of the current job."""
+    job = _job
+    if job is None:
+        yield
+        return
+    job.push(name)
+    try:
+        yield
+    finally:
+        job.pop()
+
+
+@contextmanager
+def job_accounting(job, log_path=DEFAULT_USAGE_LOG, profile_dir=None):
+    """
+    Account for the resources one job uses, and optionally profile its Python side.
+
+    Args:
+        job (str): Job name (the video's path).
+        log_path (str): JSON-lines usage log shared by all jobs.
+        profile_dir (str, optional): Write a cProfile dump of the job here.
+    """
+    global _job
+    accounting = JobAccounting(job, log_path)
+    profiler = cProfile.Profile() if profile_dir else None
+    _job = accounting
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield accounting
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        _job = None
+        records = accounting.finish()
+        print(format_job_summary(job, records))
+        if profiler is not None:
+            _save_profile(profiler, job, profile_dir)
+
+
+def _save_profile(profiler, job, profile_dir):
+    os.makedirs(profile_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(job))[0]
+    profile_path = os.path.join(profile_dir, f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+    profiler.dump_stats(profile_path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+    print(f"Python profile written to {profile_path} (view with `python3 -m pstats {profile_path}`)")
+    print(summary.getvalue())
+
+
+def format_job_summary(job, records):
+    """One line per stage: wall time, child CPU and Python CPU, and time suspended by preemption."""
+    lines = [f"Resource usage for {os.path.basename(job)}:"]
+    for stage_name, group in _group(records, "stage").items():
+        children = [r for r in group if r["kind"] == "child"]
+        python = [r for r in group if r["kind"] == "python"]
+        suspended = sum(r.get("suspended", 0.0) for r in children)
+        lines.append(
+            f"   {stage_name:<12} wall {sum(r['wall'] for r in python):7.1f}s  "
+            f"tools {len(children):>3} runs {sum(r['user'] + r['sys'] for r in children):8.1f}s CPU  "
+            f"python {sum(r['user'] + r['sys'] for r in python):7.1f}s CPU"
+            + (f"  suspended {suspended:.1f}s" if suspended else "")
+        )
+    return '\n'.join(lines)
+
+
+def load_usage(log_path=DEFAULT_USAGE_LOG, since=None):
+    """Read usage records, optionally only those written after `since` (epoch seconds)."""
+    records = []
+    try:
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or record.get("at", 0) >= since:
+                    records.append(record)
+    except OSError:
+        pass
+    return records
+
+
+def _group(records, key):
+    groups = {}
+    for record in records:
+        groups.setdefault(record[key], []).append(record)
+    return groups
+
+
+def aggregate(records, key):
+    """
+    Totals per value of `key` ("stage", "command" or "job").
+
+    Returns:
+        list: (value, totals) pairs, most CPU first.
+    """
+    rows = []
+    for value, group in _group(records, key).items():
+        # Tools run inside the Python side's wall time, so only count theirs on their own
+        timed = [r for r in group if r["kind"] == "python"] or group
+        rows.append((value, {
+            "runs": sum(1 for r in group if r["kind"] == "child"),
+            "wall": sum(r["wall"] for r in timed),
+            "suspended": sum(r.get("suspended", 0.0) for r in group),
+            "cpu": sum(r["user"] + r["sys"] for r in group),
+            "user": sum(r["user"] for r in group),
+            "sys": sum(r["sys"] for r in group),
+            "max_rss_kib": max(r["max_rss_kib"] for r in group),
+            "read_bytes": sum(r["read_bytes"] for r in group),
+            "write_bytes": sum(r["write_bytes"] for r in group),
+        }))
+    return sorted(rows, key=lambda row: row[1]["cpu"], reverse=True)
+
+
+def print_report(records, keys=("stage", "command")):
+    jobs = {r["job"] for r in records}
+    total_cpu = sum(r["user"] + r["sys"] for r in records) or 1e-9
+    python_cpu = sum(r["user"] + r["sys"] for r in records if r["kind"] == "python")
+    print(f"{len(jobs)} jobs, {total_cpu:.0f}s CPU: media tools {(total_cpu - python_cpu) / total_cpu:.0%}, "
+          f"Python {python_cpu / total_cpu:.0%}")
+    for key in keys:
+        print(f"\nBy {key}:")
+        print(f"{key:<28}{'runs':>6}{'wall':>10}{'paused':>9}{'CPU':>10}{'share':>7}{'sys':>8}{'peak RSS':>10}"
+              f"{'read':>9}{'written':>9}")
+        for value, totals in aggregate(records, key):
+            label = os.path.basename(value) if key == "job" else value
+            print(f"{label[:27]:<28}{totals['runs']:>6}{totals['wall']:>9.0f}s{totals['suspended']:>8.0f}s"
+                  f"{totals['cpu']:>9.0f}s"
+                  f"{totals['cpu'] / total_cpu:>7.0%}{totals['sys']:>7.0f}s"
+                  f"{totals['max_rss_kib'] / 1024:>8.0f}MB{totals['read_bytes'] / 1024 ** 2:>7.0f}MB"
+                  f"{totals['write_bytes'] / 1024 ** 2:>7.0f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Where the machine's time goes, from the resource usage log")
+    parser.add_argument('--log', default=DEFAULT_USAGE_LOG, help="Resource usage log")
+    parser.add_argument('--days', type=float, help="Only jobs finished in the last N days")
+    parser.add_argument('--by', action='append', choices=("stage", "command", "job"),
+                        help="Grouping (repeatable; default: stage and command)")
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400 if args.days else None
+    records = load_usage(args.log, since)
+    if not records:
+        print(f"No resource usage recorded in {args.log}")
+    else:
+        print_report(records, args.by or ("stage", "command"))
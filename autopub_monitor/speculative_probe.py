@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# speculative_probe.py - Probe and check videos while they are still in the Nutstore folder
+
+import os
+import re
+import sys
+import time
+import argparse
+
+from handbrake import HandBrakePreprocessor
+from media_probe import (DEFAULT_SPECULATIVE_DIR, content_fingerprint, load_speculative,
+                         read_summary, store_speculative)
+
+VIDEO_PATTERN = re.compile(r'.+\.(mp4|mov|avi|flv|wmv|mkv)$', re.IGNORECASE)
+
+
+def _signature(stat):
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class Speculator:
+    """
+    Runs the probe and the HandBrake compatibility check on files in the sync
+    folder once they stop changing, ahead of the rename, ingest and queue.
+
+    Results are stored by content fingerprint (media_probe.content_fingerprint),
+    so they follow the content through the `_COMPLETED` rename and the ingest
+    into AUTOPUBLISH_DIR, where probe_video and detect_video_issues pick them
+    up. A file that changes after its check gets a new fingerprint, so the old
+    result is simply never found again; one that changes during its check is
+    discarded and checked again once it is stable.
+    """
+
+    def __init__(self, source_dir, speculative_dir=DEFAULT_SPECULATIVE_DIR, stable_seconds=30,
+                 max_age_days=7):
+        self.source_dir = source_dir
+        self.speculative_dir = speculative_dir
+        self.stable_seconds = stable_seconds
+        self.max_age_days = max_age_days
+        self.first_seen = {}
+        self.checked = {}
+
+    def _candidates(self):
+        try:
+            with os.scandir(self.source_dir) as entries:
+                for entry in entries:
+                    if (entry.name.startswith('.') or not VIDEO_PATTERN.match(entry.name)
+                            or not entry.is_file(follow_symlinks=False)):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_size > 0:
+                        yield entry.path, _signature(stat)
+        except FileNotFoundError:
+            return
+
+    def check_file(self, path):
+        """
+        Probe and check one file now and store the result by fingerprint.
+
+        Returns:
+            str: "known" if this content was already checked, "checked", or
+            "changed" if the file was modified while it was being checked.
+        """
+        before = _signature(os.stat(path))
+        fingerprint = content_fingerprint(path)
+        if os.path.exists(os.path.join(self.speculative_dir, f"{fingerprint}.json")):
+            return "known"
+
+        started = time.monotonic()
+        summary = read_summary(path)
+        preprocessor = HandBrakePreprocessor(path, speculative_dir=self.speculative_dir)
+        needs_fixing = preprocessor.detect_video_issues()
+
+        try:
+            unchanged = _signature(os.stat(path)) == before and content_fingerprint(path) == fingerprint
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            print(f"{os.path.basename(path)} changed while it was checked; discarding the result")
+            return "changed"
+
+        store_speculative(fingerprint, {
+            "fingerprint": fingerprint,
+            "source": os.path.basename(path),
+            "size": before[0],
+            "summary": summary,
+            "issues": preprocessor.detected_issues,
+            "needs_fixing": needs_fixing,
+            "checked_at": time.time(),
+        }, self.speculative_dir)
+        print(f"Checked {os.path.basename(path)} ahead of ingest in {time.monotonic() - started:.1f}s "
+              f"({'needs fixing' if needs_fixing else 'compatible'})")
+        return "checked"
+
+    def scan(self):
+        """
+        One pass over the sync folder: check the files stable for stable_seconds.
+
+        Returns:
+            dict: Counts per check_file outcome.
+        """
+        now = time.monotonic()
+        counts = {}
+        present = set()
+        for path, signature in self._candidates():
+            present.add(path)
+            seen = self.first_seen.get(path)
+            if seen is None or seen[0] != signature:
+                self.first_seen[path] = (signature, now)
+                continue
+            if now - seen[1] < self.stable_seconds or self.checked.get(path) == signature:
+                continue
+            try:
+                outcome = self.check_file(path)
+            except (OSError, ValueError) as e:
+                # Left to the normal checks after ingest; not retried until the file changes
+                print(f"Speculative check of {path} failed: {e}")
+                self.checked[path] = signature
+                continue
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if outcome != "changed":
+                self.checked[path] = signature
+            else:
+                del self.first_seen[path]
+
+        for path in [path for path in self.first_seen if path not in present]:
+            del self.first_seen[path]
+            self.checked.pop(path, None)
+        return counts
+
+    def prune(self):
+        """Remove results older than max_age_days; their files have long been processed."""
+        cutoff = time.time() - self.max_age_days * 86400
+        removed = 0
+        try:
+            names = os.listdir(self.speculative_dir)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.speculative_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def run(self, interval=10):
+        """Scan every interval seconds until interrupted."""
+        print(f"Speculative checks of {self.source_dir} "
+              f"(files stable for {self.stable_seconds}s) into {self.speculative_dir}")
+        last_prune = 0
+        while True:
+            if time.monotonic() - last_prune > 3600:
+                self.prune()
+                last_prune = time.monotonic()
+            self.scan()
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speculative probing of videos still in the sync folder")
+    parser.add_argument('--speculative-dir', default=DEFAULT_SPECULATIVE_DIR,
+                        help="Directory of results keyed by content fingerprint")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Keep checking stable files in SOURCE_DIR")
+    run_parser.add_argument('source_dir')
+    run_parser.add_argument('--stable-seconds', type=float, default=30,
+                            help="How long size and mtime must stay unchanged before a check")
+    run_parser.add_argument('--interval', type=float, default=10, help="Seconds between scans")
+    run_parser.add_argument('--max-age-days', type=float, default=7, help="Age at which results are pruned")
+    run_parser.add_argument('--niceness', type=int, default=10, help="Run the checks at this niceness")
+
+    check_parser = subparsers.add_parser('check', help="Check files now, without waiting for them to settle")
+    check_parser.add_argument('paths', nargs='+')
+
+    lookup_parser = subparsers.add_parser('lookup', help="Show the result stored for a file's content")
+    lookup_parser.add_argument('paths', nargs='+')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        os.nice(args.niceness)
+        speculator = Speculator(args.source_dir, args.speculative_dir, args.stable_seconds, args.max_age_days)
+        try:
+            speculator.run(args.interval)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'check':
+        speculator = Speculator(os.path.dirname(args.paths[0]), args.speculative_dir)
+        for path in args.paths:
+            print(f"{path}: {speculator.check_file(path)}")
+    else:
+        missing = False
+        for path in args.paths:
+            entry = load_speculative(path, args.speculative_dir)
+            if entry is None:
+                missing = True
+                print(f"{path}: not checked ahead")
+            else:
+                state = "needs fixing" if entry.get("needs_fixing") else "compatible"
+                print(f"{path}: {state}, checked as {entry.get('source')} {entry.get('issues') or ''}".rstrip())
+        sys.exit(1 if missing else 0)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# streaming_upload.py - Upload a fix encode while it is still being written
+
+import os
+import time
+import threading
+from collections import deque
+
+from media_runner import run_media_command
+
+
+class StreamingEncodeFailed(RuntimeError):
+    """
+    The encode behind a streaming upload failed.
+
+    Raised from the chunk generator before the body is complete, so the
+    request is torn down mid-body and the server never sees a finished upload.
+    """
+
+
+class StreamingEncode:
+    """
+    Runs a streamable (fragmented MP4) fix encode in the background and
+    exposes its output as a stream of chunks for an upload that starts
+    before the encode finishes.
+
+    Fragmented MP4 writes the moov header up front and appends self-contained
+    fragments, so every byte already on disk is final and can be sent as soon
+    as it lands. End-to-end time approaches max(encode, upload) instead of
+    their sum.
+    """
+
+    def __init__(self, preprocessor, duration=None, chunk_size=1024 * 1024, poll_interval=0.5):
+        """
+        Args:
+            preprocessor (HandBrakePreprocessor): Preprocessor whose output_path receives the encode.
+            duration (float, optional): Clip duration, used for the encode slot's preset.
+            chunk_size (int): Bytes per chunk handed to the uploader.
+            poll_interval (float): Seconds to wait for the encoder when the reader catches up.
+        """
+        self.preprocessor = preprocessor
+        self.output_path = str(preprocessor.output_path)
+        self.duration = duration
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.finished = threading.Event()
+        self.cancelled = threading.Event()
+        self.returncode = None
+        self.stderr_tail = deque(maxlen=50)
+        self.bytes_streamed = 0
+        self.encode_seconds = None
+        self._thread = None
+
+    def _run(self):
+        start_time = time.time()
+        try:
+            scheduler = self.preprocessor.encode_scheduler
+            with scheduler.reserve(duration=self.duration) as slot:
+                print(f"   Streaming encode: {slot.threads} threads on CPUs {slot.cpus}")
+                result = run_media_command(
+                    self.preprocessor.streamable_fix_command(slot),
+                    tail_lines=self.stderr_tail.maxlen,
+                    cancel_event=self.cancelled,
+                    preexec_fn=slot.preexec(), suspend_check=slot.suspend_check,
+                )
+                self.stderr_tail.extend(result.tail)
+                self.returncode = result.returncode
+        except Exception as e:
+            self.stderr_tail.append(f"{type(e).__name__}: {e}")
+            self.returncode = -1
+        finally:
+            self.encode_seconds = time.time() - start_time
+            self.finished.set()
+
+    def start(self):
+        """Start the encode; a stale output file is removed first so no old bytes are sent."""
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+        self._thread = threading.Thread(target=self._run, name="streaming-encode", daemon=True)
+        self._thread.start()
+
+    def chunks(self):
+        """
+        Yield the output file's bytes as the encoder writes them.
+
+        Stops once the encoder has exited and everything it wrote has been read.
+
+        Raises:
+            StreamingEncodeFailed: The encoder failed or was cancelled.
+        """
+        while not os.path.exists(self.output_path):
+            if self.finished.is_set():
+                self._check_finished()
+                return
+            time.sleep(self.poll_interval)
+
+        with open(self.output_path, 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if data:
+                    self.bytes_streamed += len(data)
+                    yield data
+                    continue
+                if self.finished.is_set():
+                    # Drain whatever was written between the last read and exit
+                    data = f.read()
+                    if data:
+                        self.bytes_streamed += len(data)
+                        yield data
+                    self._check_finished()
+                    return
+                time.sleep(self.poll_interval)
+
+    def _check_finished(self):
+        if self.returncode != 0:
+            raise StreamingEncodeFailed(f"streaming encode failed with code {self.returncode}")
+
+    def cancel(self):
+        """Stop the encode, e.g. after the upload it feeds has failed."""
+        self.cancelled.set()
+
+    def wait(self):
+        """Wait for the encoder and report whether it succeeded."""
+        if self._thread is not None:
+            self._thread.join()
+        if self.returncode != 0:
+            print(f"Streaming encode failed with code {self.returncode}:")
+            for line in self.stderr_tail:
+                print(f"   {line}")
+            return False
+        return True
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+# striped_upload.py - Multi-connection striped uploads through an upload-session API
+
+import io
+import os
+import json
+import math
+import time
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from bandwidth_arbiter import BandwidthArbiter, ThrottledReader, TokenBucket
+from upload_client import send_file
+
+DEFAULT_PART_MIB = 8
+DEFAULT_MAX_STREAMS = 8
+MIN_PART_BYTES = 1024 * 1024
+# Smaller files go over one connection: the session and RTT round trips would outweigh the streams
+MIN_STRIPED_PARTS = 4
+INITIAL_STREAMS = 2
+PART_ATTEMPTS = 3
+# Without a known link rate, streams are doubled while that still adds this much throughput
+RAMP_MIN_GAIN = 0.15
+_NO_SESSION_ENDPOINT = {404, 405, 501}
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def choose_streams(rtt, stream_rate, target_rate, max_streams=DEFAULT_MAX_STREAMS):
+    """
+    Parallel streams needed to fill the link.
+
+    A window-limited stream moves about one window per round trip, so its
+    window is stream_rate * rtt; filling the link takes target_rate * rtt
+    bytes in flight, i.e. that many windows.
+
+    Returns:
+        int or None: Stream count, or None if a rate is unknown.
+    """
+    if not stream_rate or not target_rate:
+        return None
+    window = stream_rate * max(rtt, 1e-3)
+    return max(1, min(max_streams, math.ceil(target_rate * max(rtt, 1e-3) / window)))
+
+
+class StripedUpload:
+    """
+    Upload a file as byte ranges over several parallel connections.
+
+    A single TCP stream to a distant server is limited to one window per
+    round trip; ranges sent on N connections at once get N windows in flight.
+
+    Protocol (session_url, e.g. `/upload/sessions`):
+      1. POST session_url with the usual upload fields plus `size`,
+         `part_size` and `parts`; the server answers `{"session_id"}`.
+         404/405/501 means the server has no session API.
+      2. PUT `<session_url>/<session_id>/parts/<index>` with the raw range,
+         `Content-Range: bytes start-end/size` and `X-Part-SHA256`; a
+         checksum mismatch is refused (4xx) and the part is sent again.
+      3. POST `<session_url>/<session_id>/complete` with the whole file's
+         `sha256`. The server reassembles the parts, checks the digest and
+         answers like a regular upload; 409 `{"missing": [...]}` asks for
+         parts it does not have, which are sent again before completing anew.
+      4. DELETE `<session_url>/<session_id>` abandons a session the upload
+         could not finish, so the server can drop its parts.
+
+    The stream count is fixed when `streams` is given. Otherwise the upload
+    starts with INITIAL_STREAMS, measures the round trip and the per-stream
+    rate, and adds streams to fill the rate the bandwidth arbiter allows
+    (choose_streams). Without a known link rate, streams are doubled while
+    the throughput keeps growing. All streams share the arbiter's token
+    bucket, so the upload still gets only its share of the uplink.
+    """
+
+    def __init__(self, path, session_url, upload_data, bandwidth=None, streams=None,
+                 max_streams=DEFAULT_MAX_STREAMS, part_size=DEFAULT_PART_MIB * 1024 * 1024, timeout=60):
+        self.path = path
+        self.session_url = session_url.rstrip('/')
+        self.upload_data = dict(upload_data)
+        self.bandwidth = bandwidth or BandwidthArbiter()
+        self.fixed_streams = streams if streams and streams > 0 else None
+        self.max_streams = max(1, max_streams)
+        self.size = os.path.getsize(path)
+        # A few parts per stream, so that streams added later still find work
+        self.part_size = max(MIN_PART_BYTES, min(part_size, math.ceil(self.size / (self.max_streams * 4)) or 1))
+        self.parts = math.ceil(self.size / self.part_size)
+        self.timeout = timeout
+        self.session_id = None
+        self.rtt = None
+        self.streams = 0
+        self.resent = 0
+        self._lock = threading.Lock()
+        self._error = None
+
+    @staticmethod
+    def worthwhile(size, part_size=None):
+        """Whether a file of this size is worth striping (at least MIN_STRIPED_PARTS full parts)."""
+        return size >= MIN_STRIPED_PARTS * (part_size or DEFAULT_PART_MIB * 1024 * 1024)
+
+    def _session_path(self, *parts):
+        return "/".join([self.session_url, str(self.session_id), *map(str, parts)])
+
+    def _measure_rtt(self, http, create_seconds):
+        """Shortest of the session creation and two status requests."""
+        samples = [create_seconds]
+        for _ in range(2):
+            started = time.monotonic()
+            try:
+                http.get(self._session_path(), timeout=self.timeout)
+            except requests.RequestException:
+                break
+            samples.append(time.monotonic() - started)
+        return min(samples)
+
+    def upload(self):
+        """
+        Run the upload.
+
+        Returns:
+            requests.Response or None: The completion response (shaped like a
+            regular upload's), or None if the server has no session API.
+
+        Raises:
+            requests.RequestException: A part failed PART_ATTEMPTS times or the
+                server could not be reached.
+        """
+        filename = self.upload_data.get("filename") or os.path.basename(self.path)
+        http = requests.Session()
+        started = time.monotonic()
+        response = http.post(self.session_url, data={
+            **self.upload_data, "size": self.size, "part_size": self.part_size, "parts": self.parts,
+        }, timeout=self.timeout)
+        if response.status_code in _NO_SESSION_ENDPOINT:
+            print(f"{self.session_url} has no upload sessions; uploading over one connection")
+            return None
+        response.raise_for_status()
+        self.session_id = response.json()["session_id"]
+        try:
+            response = self._run_session(http, filename, time.monotonic() - started)
+        except BaseException:
+            self.abort(http)
+            raise
+        if not response.ok:
+            self.abort(http)
+        return response
+
+    def _run_session(self, http, filename, create_seconds):
+        self.rtt = self._measure_rtt(http, create_seconds)
+
+        # The digest for the completion is computed while the parts go out
+        digest = {}
+        hasher = threading.Thread(target=lambda: digest.setdefault("sha256", file_sha256(self.path)), daemon=True)
+        hasher.start()
+        with self.bandwidth.transfer("upload", filename) as bucket:
+            self._send_parts(range(self.parts), bucket)
+            hasher.join()
+
+            def complete():
+                return http.post(self._session_path("complete"), data={"sha256": digest["sha256"]},
+                                 timeout=self.timeout)
+
+            # Every resend of missing parts is followed by another completion
+            response = complete()
+            for _ in range(PART_ATTEMPTS):
+                if response.status_code != 409:
+                    break
+                missing = response.json().get("missing", [])
+                print(f"Server is missing {len(missing)} parts; sending them again")
+                self.resent += len(missing)
+                self._send_parts(missing, bucket)
+                response = complete()
+        return response
+
+    def abort(self, http=None):
+        """Abandon the session on the server (best effort)."""
+        if self.session_id is None:
+            return
+        try:
+            (http or requests).delete(self._session_path(), timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Could not abandon upload session {self.session_id}: {e}")
+
+    def _send_part(self, http, index, bucket):
+        offset = index * self.part_size
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(min(self.part_size, self.size - offset))
+        response = http.put(
+            self._session_path("parts", index),
+            data=ThrottledReader(io.BytesIO(data), bucket, len(data)),
+            headers={
+                "Content-Range": f"bytes {offset}-{offset + len(data) - 1}/{self.size}",
+                "X-Part-SHA256": hashlib.sha256(data).hexdigest(),
+                "Content-Type": "application/octet-stream",
+            },
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return len(data)
+
+    def _send_parts(self, indices, bucket):
+        pending = deque(indices)
+        attempts = {}
+        workers = []
+        window = {"started": time.monotonic(), "bytes": 0, "parts": 0, "rates": []}
+        ramp = {"rate": None, "done": False, "adjusted": False}
+
+        def worker():
+            http = requests.Session()
+            while True:
+                with self._lock:
+                    if not pending or self._error is not None:
+                        return
+                    index = pending.popleft()
+                started = time.monotonic()
+                try:
+                    sent = self._send_part(http, index, bucket)
+                except (requests.RequestException, OSError) as e:
+                    with self._lock:
+                        attempts[index] = attempts.get(index, 0) + 1
+                        if attempts[index] >= PART_ATTEMPTS:
+                            self._error = e
+                        else:
+                            self.resent += 1
+                            pending.append(index)
+                    continue
+                with self._lock:
+                    window["bytes"] += sent
+                    window["parts"] += 1
+                    window["rates"].append(sent / max(time.monotonic() - started, 1e-6))
+                    # The first part already gives the per-stream rate; later, every stream reports in
+                    if window["parts"] >= (len(workers) if ramp["adjusted"] else 1):
+                        adjust()
+
+        def adjust():
+            # Called with the lock held
+            ramp["adjusted"] = True
+            now = time.monotonic()
+            rate = window["bytes"] / max(now - window["started"], 1e-6)
+            wanted = len(workers)
+            if self.fixed_streams is None:
+                stream_rate = sorted(window["rates"])[len(window["rates"]) // 2]
+                target = choose_streams(self.rtt, stream_rate, bucket.rate, self.max_streams)
+                if target is not None:
+                    wanted = max(wanted, target)
+                elif not ramp["done"]:
+                    if ramp["rate"] is None or rate >= ramp["rate"] * (1 + RAMP_MIN_GAIN):
+                        wanted = min(self.max_streams, len(workers) * 2)
+                    else:
+                        ramp["done"] = True
+                    ramp["rate"] = rate
+                if wanted > len(workers):
+                    print(f"RTT {self.rtt * 1000:.0f} ms, {stream_rate / 1024 ** 2:.2f} MiB/s per stream "
+                          f"(window ~{stream_rate * self.rtt / 1024:.0f} KiB): {wanted} streams")
+            window.update(started=now, bytes=0, parts=0, rates=[])
+            start_workers(wanted)
+
+        def start_workers(count):
+            for _ in range(max(0, min(count, len(workers) + len(pending)) - len(workers))):
+                thread = threading.Thread(target=worker, name=f"part-stream-{len(workers)}", daemon=True)
+                workers.append(thread)
+                thread.start()
+            self.streams = max(self.streams, len(workers))
+
+        with self._lock:
+            start_workers(self.fixed_streams or INITIAL_STREAMS)
+        # Workers started later are appended to the list while earlier ones run
+        joined = 0
+        while joined < len(workers):
+            workers[joined].join()
+            joined += 1
+        if self._error is not None:
+            raise self._error
+
+
+class _StandInSessionServer:
+    """
+    Local stand-in for the upload endpoints: the regular multipart upload and
+    the session API, with per-part and whole-file checks. The first
+    `corrupt_parts` parts received are treated as damaged in transit.
+    """
+
+    def __init__(self, work_dir, corrupt_parts=0):
+        self.work_dir = work_dir
+        self.sessions = {}
+        self.corrupt_parts = corrupt_parts
+        self.rejected = 0
+        self.completed = {}
+        self.aborted = 0
+        self._next_id = 1
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, code, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                remaining = int(self.headers.get('Content-Length') or 0)
+                chunks = []
+                while remaining:
+                    chunk = self.rfile.read(min(256 * 1024, remaining))
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    remaining -= len(chunk)
+                return b''.join(chunks)
+
+            def _new_id(self):
+                with server._lock:
+                    new_id = str(server._next_id)
+                    server._next_id += 1
+                return new_id
+
+            def do_GET(self):
+                parts = urlparse(self.path).path.strip('/').split('/')
+                session = server.sessions.get(parts[-1])
+                if session is None:
+                    self._send_json(404, {"error": "unknown session"})
+                    return
+                self._send_json(200, {"parts": session["parts"], "received": sorted(session["received"])})
+
+            def do_POST(self):
+                parts = urlparse(self.path).path.strip('/').split('/')
+                body = self._body()
+                if parts == ['upload']:
+                    video_id = self._new_id()
+                    self._send_json(200, {"video_id": video_id, "file_path": f"/uploads/{video_id}.mp4",
+                                          "bytes": len(body)})
+                elif parts == ['upload', 'sessions']:
+                    form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                    session_id = self._new_id()
+                    path = os.path.join(server.work_dir, f"session_{session_id}.part")
+                    with open(path, 'wb') as f:
+                        f.truncate(int(form["size"]))
+                    server.sessions[session_id] = {"path": path, "size": int(form["size"]),
+                                                   "parts": int(form["parts"]), "received": set()}
+                    self._send_json(200, {"session_id": session_id})
+                elif len(parts) == 4 and parts[3] == 'complete' and parts[2] in server.sessions:
+                    session = server.sessions[parts[2]]
+                    missing = sorted(set(range(session["parts"])) - session["received"])
+                    if missing:
+                        self._send_json(409, {"missing": missing})
+                        return
+                    sha256 = parse_qs(body.decode()).get("sha256", [""])[0]
+                    actual = file_sha256(session["path"])
+                    if actual != sha256:
+                        self._send_json(422, {"error": "checksum mismatch"})
+                        return
+                    server.completed[parts[2]] = actual
+                    self._send_json(200, {"video_id": parts[2], "file_path": f"/uploads/{parts[2]}.mp4",
+                                          "sha256": actual})
+                else:
+                    self._send_json(404, {"error": "unknown endpoint"})
+
+            def do_DELETE(self):
+                parts = urlparse(self.path).path.strip('/').split('/')
+                session = server.sessions.pop(parts[-1], None)
+                if session is None:
+                    self._send_json(404, {"error": "unknown session"})
+                    return
+                os.remove(session["path"])
+                server.aborted += 1
+                self._send_json(200, {"aborted": parts[-1]})
+
+            def do_PUT(self):
+                parts = urlparse(self.path).path.strip('/').split('/')
+                if len(parts) != 5 or parts[3] != 'parts' or parts[2] not in server.sessions:
+                    self._body()
+                    self._send_json(404, {"error": "unknown endpoint"})
+                    return
+                session = server.sessions[parts[2]]
+                data = self._body()
+                start = int(self.headers['Content-Range'].split()[1].split('-')[0])
+                with server._lock:
+                    damaged = server.corrupt_parts > 0
+                    if damaged:
+                        server.corrupt_parts -= 1
+                        server.rejected += 1
+                if damaged or hashlib.sha256(data).hexdigest() != self.headers.get('X-Part-SHA256'):
+                    self._send_json(422, {"error": "part checksum mismatch"})
+                    return
+                with open(session["path"], 'r+b') as f:
+                    f.seek(start)
+                    f.write(data)
+                session["received"].add(int(parts[4]))
+                self._send_json(200, {"received": len(data)})
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.httpd.server_port
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _LatencyProxy:
+    """
+    TCP proxy that stands in for a long-haul link.
+
+    Each direction is delayed by half the round trip. Upstream, a connection
+    forwards at most `window` bytes per round trip, like a window-limited TCP
+    stream, and all connections share a token bucket at the link rate.
+    """
+
+    def __init__(self, target_port, rtt, window, link_rate):
+        self.target_port = target_port
+        self.rtt = rtt
+        self.window = window
+        self.link = TokenBucket(link_rate, burst=window)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self._closed = False
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+            threading.Thread(target=self._pump, args=(client, upstream, True), daemon=True).start()
+            threading.Thread(target=self._pump, args=(upstream, client, False), daemon=True).start()
+
+    def _pump(self, source, destination, limited):
+        try:
+            while True:
+                started = time.monotonic()
+                data = source.recv(self.window if limited else 64 * 1024)
+                if not data:
+                    break
+                if limited:
+                    self.link.consume(len(data))
+                time.sleep(self.rtt / 2)
+                destination.sendall(data)
+                if limited:
+                    # The next window goes out when this one's acknowledgement is back
+                    remaining = started + self.rtt - time.monotonic()
+                    if remaining > 0:
+                        time.sleep(remaining)
+        except OSError:
+            pass
+        finally:
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        self._closed = True
+        self.listener.close()
+
+
+def run_benchmark(size_mib=32, rtt_ms=100, window_kib=256, link_mib=16, streams=None,
+                  max_streams=DEFAULT_MAX_STREAMS, part_mib=DEFAULT_PART_MIB, corrupt_parts=1):
+    """
+    One connection against a striped upload through a latency-injecting proxy.
+
+    The proxy holds each connection to one window per round trip and all of
+    them to the link rate; the arbiter is told the link rate, as
+    BANDWIDTH_LINK_KIB does in production, unless `link_mib` is 0.
+    """
+    with tempfile.TemporaryDirectory(prefix="striped_bench_") as work_dir:
+        path = os.path.join(work_dir, "clip.mp4")
+        with open(path, 'wb') as f:
+            for _ in range(size_mib):
+                f.write(os.urandom(1024 * 1024))
+        link_rate = link_mib * 1024 * 1024 if link_mib else None
+
+        server = _StandInSessionServer(work_dir, corrupt_parts=corrupt_parts)
+        proxy = _LatencyProxy(server.port, rtt_ms / 1000, window_kib * 1024, link_rate)
+        url = f"http://127.0.0.1:{proxy.port}"
+        bandwidth = BandwidthArbiter(capacity_kib=link_mib * 1024 if link_mib else None, sync_floor_kib=0,
+                                     state_dir=os.path.join(work_dir, 'bandwidth'))
+        upload_data = {"filename": "clip.mp4", "title": "benchmark"}
+        try:
+            started = time.monotonic()
+            response = send_file('post', f"{url}/upload", 'video', path, fields=upload_data, bandwidth=bandwidth)
+            response.raise_for_status()
+            single = time.monotonic() - started
+
+            started = time.monotonic()
+            upload = StripedUpload(path, f"{url}/upload/sessions", upload_data, bandwidth=bandwidth,
+                                   streams=streams, max_streams=max_streams, part_size=part_mib * 1024 * 1024)
+            response = upload.upload()
+            response.raise_for_status()
+            striped = time.monotonic() - started
+            intact = server.completed.get(upload.session_id) == file_sha256(path)
+        finally:
+            proxy.close()
+            server.close()
+
+    print(f"{size_mib} MiB through a stand-in link: {rtt_ms} ms RTT, {window_kib} KiB window per connection, "
+          f"{f'{link_mib} MiB/s' if link_mib else 'unlimited'} link")
+    print(f"{'mode':<10}{'streams':>8}{'seconds':>10}{'MiB/s':>8}")
+    print(f"{'single':<10}{1:>8}{single:>10.1f}{size_mib / single:>8.1f}")
+    print(f"{'striped':<10}{upload.streams:>8}{striped:>10.1f}{size_mib / striped:>8.1f}")
+    print(f"Measured RTT {upload.rtt * 1000:.0f} ms; {upload.resent} parts resent "
+          f"({server.rejected} refused by the part checksum); reassembled file "
+          f"{'matches' if intact else 'DOES NOT match'}")
+    return {"single": single, "striped": striped, "streams": upload.streams, "intact": intact}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Striped uploads over several connections")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    upload_parser = subparsers.add_parser('upload', help="Upload a file through an upload-session API")
+    upload_parser.add_argument('path')
+    upload_parser.add_argument('--session-url', required=True)
+    upload_parser.add_argument('--streams', type=int, help="Fixed stream count (default: automatic)")
+    upload_parser.add_argument('--max-streams', type=int, default=DEFAULT_MAX_STREAMS)
+    upload_parser.add_argument('--part-mib', type=int, default=DEFAULT_PART_MIB)
+
+    bench_parser = subparsers.add_parser('benchmark', help="Single against striped upload through a latency proxy")
+    bench_parser.add_argument('--size-mib', type=int, default=32)
+    bench_parser.add_argument('--rtt-ms', type=float, default=100)
+    bench_parser.add_argument('--window-kib', type=int, default=256, help="Per-connection window of the stand-in")
+    bench_parser.add_argument('--link-mib', type=float, default=16, help="Link rate (0 = unlimited, streams ramp up)")
+    bench_parser.add_argument('--streams', type=int, help="Fixed stream count (default: automatic)")
+    bench_parser.add_argument('--max-streams', type=int, default=DEFAULT_MAX_STREAMS)
+    bench_parser.add_argument('--part-mib', type=int, default=DEFAULT_PART_MIB)
+    bench_parser.add_argument('--corrupt-parts', type=int, default=1, help="Parts the stand-in refuses once")
+
+    args = parser.parse_args()
+    if args.command == 'benchmark':
+        run_benchmark(args.size_mib, args.rtt_ms, args.window_kib, args.link_mib, args.streams,
+                      args.max_streams, args.part_mib, args.corrupt_parts)
+    else:
+        upload = StripedUpload(args.path, args.session_url, {"filename": os.path.basename(args.path)},
+                               streams=args.streams, max_streams=args.max_streams,
+                               part_size=args.part_mib * 1024 * 1024)
+        response = upload.upload()
+        if response is None:
+            raise SystemExit(1)
+        print(f"{response.status_code}: {response.text}")
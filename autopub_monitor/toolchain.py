@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# toolchain.py - Cached registry of what the installed ffmpeg and HandBrake builds can do
+
+import os
+import re
+import json
+import shutil
+import argparse
+import subprocess
+
+from media_runner import run_media_command
+
+DEFAULT_TOOLCHAIN_CACHE = os.path.expanduser('~/AutoPublishDATA/toolchain_cache.json')
+
+# Software H.264 encoders, fastest usable first
+H264_ENCODERS = ('libx264', 'libopenh264')
+AAC_ENCODERS = ('libfdk_aac', 'aac')
+
+
+def _binary_key(binary):
+    """Resolved path and mtime of a binary on PATH, or None if it is not installed."""
+    path = shutil.which(binary)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    return path, os.stat(path).st_mtime_ns
+
+
+def _listing_after_separator(text):
+    """Lines of an ffmpeg listing (-encoders, -muxers, ...) after its ' ---' legend separator."""
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if line.strip() and set(line.strip()) == {'-'}:
+            return lines[i + 1:]
+    return lines
+
+
+def _parse_flagged_names(text):
+    """Names from listings whose lines are `FLAGS name description`."""
+    names = {}
+    for line in _listing_after_separator(text):
+        parts = line.split(None, 2)
+        if len(parts) >= 2:
+            for name in parts[1].split(','):
+                names[name] = parts[0]
+    return names
+
+
+def inspect_ffmpeg(binary='ffmpeg'):
+    """Encoders, bitstream filters, muxers and demuxers of an ffmpeg build."""
+    def listing(option):
+        return run_media_command([binary, '-hide_banner', option], capture_stdout=True, check=True, timeout=30).stdout
+
+    version = listing('-version').splitlines()
+    encoders = _parse_flagged_names(listing('-encoders'))
+    # -formats lists muxers and demuxers together, saving a spawn over -muxers plus -demuxers
+    formats = _parse_flagged_names(listing('-formats'))
+    return {
+        "version": version[0] if version else "",
+        "encoders": sorted(encoders),
+        "bsfs": sorted(line.strip() for line in listing('-bsfs').splitlines()[1:] if line.strip()),
+        "muxers": sorted(name for name, flags in formats.items() if 'E' in flags),
+        "demuxers": sorted(name for name, flags in formats.items() if 'D' in flags),
+    }
+
+
+def inspect_handbrake(binary='HandBrakeCLI'):
+    """Version and supported command-line options of a HandBrakeCLI build."""
+    result = run_media_command([binary, '--version'], capture_stdout=True, check=True, timeout=30)
+    match = re.search(r'HandBrake\s+(\S+)', result.stdout + '\n' + result.stderr)
+    help_result = run_media_command([binary, '--help'], capture_stdout=True, timeout=30)
+    options = set(re.findall(r'(?<![\w-])(--[a-z][a-z0-9-]*)', help_result.stdout + '\n' + help_result.stderr))
+    return {
+        "version": match.group(1) if match else "",
+        "options": sorted(options),
+    }
+
+
+class Toolchain:
+    """
+    What the installed media tools support, inspected once per binary build.
+
+    Results are cached on disk keyed by each binary's resolved path and mtime,
+    so jobs read a JSON file instead of spawning the tools, and an upgrade is
+    picked up automatically.
+    """
+
+    INSPECTORS = {
+        'ffmpeg': inspect_ffmpeg,
+        'HandBrakeCLI': inspect_handbrake,
+    }
+
+    def __init__(self, cache_path=DEFAULT_TOOLCHAIN_CACHE):
+        self.cache_path = cache_path
+        self.tools = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+        changed = False
+        for binary, inspect in self.INSPECTORS.items():
+            key = _binary_key(binary)
+            if key is None:
+                self.tools[binary] = None
+                continue
+            path, mtime_ns = key
+            entry = cache.get(binary)
+            if not entry or entry.get("path") != path or entry.get("mtime_ns") != mtime_ns:
+                try:
+                    info = inspect(binary)
+                except (subprocess.SubprocessError, OSError) as e:
+                    print(f"Warning: could not inspect {binary}: {e}")
+                    self.tools[binary] = None
+                    continue
+                entry = {"path": path, "mtime_ns": mtime_ns, "info": info}
+                cache[binary] = entry
+                changed = True
+            self.tools[binary] = entry["info"]
+
+        if changed:
+            self._save(cache)
+
+    def _save(self, cache):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print(f"Warning: could not write toolchain cache {self.cache_path}: {e}")
+
+    def _ffmpeg(self, key):
+        info = self.tools.get('ffmpeg')
+        return set(info[key]) if info else set()
+
+    def has_encoder(self, name):
+        return name in self._ffmpeg('encoders')
+
+    def has_bsf(self, name):
+        return name in self._ffmpeg('bsfs')
+
+    def has_muxer(self, name):
+        return name in self._ffmpeg('muxers')
+
+    def has_demuxer(self, name):
+        return name in self._ffmpeg('demuxers')
+
+    def h264_encoder(self):
+        """The preferred software H.264 encoder of the ffmpeg build, or None."""
+        return next((name for name in H264_ENCODERS if self.has_encoder(name)), None)
+
+    def aac_encoder(self):
+        """The preferred AAC encoder of the ffmpeg build (falls back to the native 'aac')."""
+        return next((name for name in AAC_ENCODERS if self.has_encoder(name)), 'aac')
+
+    def h264_args(self, x264_preset='fast', crf=23, threads=None, bitrate_kbps=None):
+        """
+        ffmpeg video encoder arguments for the preferred H.264 encoder.
+
+        With bitrate_kbps the encode targets that average bitrate instead of a
+        constant quality. libopenh264 has no presets or CRF, so it always gets
+        a bitrate.
+        """
+        encoder = self.h264_encoder() or 'libx264'
+        if encoder == 'libx264':
+            args = ['-c:v', 'libx264', '-preset', x264_preset]
+            if bitrate_kbps:
+                args += ['-b:v', f'{bitrate_kbps}k', '-maxrate', f'{int(bitrate_kbps * 1.5)}k',
+                         '-bufsize', f'{bitrate_kbps * 2}k']
+            else:
+                args += ['-crf', str(crf)]
+        else:
+            args = ['-c:v', encoder, '-b:v', f'{bitrate_kbps or 8000}k']
+        if threads:
+            args += ['-threads', str(threads)]
+        return args
+
+    def can_segment_encode(self):
+        """Segmented encodes need an H.264 encoder and the concat demuxer."""
+        return self.h264_encoder() is not None and self.has_demuxer('concat')
+
+    def handbrake_available(self):
+        return self.tools.get('HandBrakeCLI') is not None
+
+    def handbrake_version(self):
+        info = self.tools.get('HandBrakeCLI')
+        return info["version"] if info else None
+
+    def handbrake_supports(self, option):
+        """Whether HandBrakeCLI accepts a long option; unknown when its help could not be read."""
+        info = self.tools.get('HandBrakeCLI')
+        if not info or not info["options"]:
+            return True
+        return option in info["options"]
+
+
+_toolchains = {}
+
+
+def get_toolchain(cache_path=DEFAULT_TOOLCHAIN_CACHE):
+    """The process-wide Toolchain for a cache file."""
+    if cache_path not in _toolchains:
+        _toolchains[cache_path] = Toolchain(cache_path)
+    return _toolchains[cache_path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what the installed ffmpeg and HandBrake builds support")
+    parser.add_argument('--cache', default=DEFAULT_TOOLCHAIN_CACHE, help="Toolchain cache file")
+    parser.add_argument('--refresh', action='store_true', help="Inspect the binaries again")
+    args = parser.parse_args()
+
+    if args.refresh and os.path.exists(args.cache):
+        os.remove(args.cache)
+    toolchain = get_toolchain(args.cache)
+    ffmpeg = toolchain.tools.get('ffmpeg')
+    print(f"ffmpeg:       {ffmpeg['version'] if ffmpeg else 'not available'}")
+    if ffmpeg:
+        print(f"  H.264:      {toolchain.h264_encoder() or 'none'}")
+        print(f"  AAC:        {toolchain.aac_encoder()}")
+        print(f"  Segmented:  {'yes' if toolchain.can_segment_encode() else 'no'}")
+        print(f"  Encoders: {len(ffmpeg['encoders'])}, bsfs: {len(ffmpeg['bsfs'])}, "
+              f"muxers: {len(ffmpeg['muxers'])}, demuxers: {len(ffmpeg['demuxers'])}")
+    print(f"HandBrakeCLI: {toolchain.handbrake_version() or 'not available'}")
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# trace_sim.py - Replay historical arrivals from the ledgers through the queue scheduler
+
+import os
+import glob
+import heapq
+import random
+import argparse
+from datetime import datetime
+
+from queue_scheduler import (
+    Job, POLICIES, DEFAULT_POLICY, DEFAULT_AGING_SECONDS, DEFAULT_MAX_ATTEMPTS, DEFAULT_BACKOFF_BASE,
+    pick_next, backoff_delay, percentile, parse_arrival,
+)
+from encode_scheduler import EncodeScheduler, PRESET_COST, _encode_rate
+from media_probe import probe_video, estimate_processing_cost
+
+STAGES = ("preprocess", "upload", "process", "publish")
+
+
+def load_trace(ledger_paths):
+    """
+    Merge ledgers into one arrival trace.
+
+    Returns:
+        list: (arrival datetime, filename) tuples sorted by arrival, one per
+        distinct file; lines without a parsable timestamp are skipped.
+    """
+    arrivals = {}
+    for ledger_path in ledger_paths:
+        with open(ledger_path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                name = os.path.basename(line.strip().split(',')[0])
+                if not name:
+                    continue
+                arrival = parse_arrival(name)
+                if arrival is not None and name not in arrivals:
+                    arrivals[name] = arrival
+    return sorted((arrival, name) for name, arrival in arrivals.items())
+
+
+def default_ledgers(directory):
+    """The processed.csv / videos_db.csv ledgers and their dated snapshots in a directory."""
+    return sorted(
+        glob.glob(os.path.join(directory, 'processed.csv*'))
+        + glob.glob(os.path.join(directory, 'videos_db.csv*'))
+    )
+
+
+class ConstantCostModel:
+    """Every clip is 1080p of a fixed length and every stage takes fixed time."""
+
+    def __init__(self, duration=30.0, stage_seconds=None):
+        self.duration = duration
+        self.stage_seconds = stage_seconds or {"preprocess": 60.0, "upload": 20.0, "process": 90.0, "publish": 60.0}
+
+    def describe(self, name, rng):
+        return {"duration": self.duration, "width": 1920, "height": 1080}
+
+    def stage_costs(self, name, summary, rng):
+        return dict(self.stage_seconds)
+
+
+class KindCostModel:
+    """
+    Clip lengths and stage costs by the kind of file the name suggests.
+
+    Phone clips (IMG_*.MOV, VID_*) are short and usually need a HandBrake fix;
+    podcasts and TV episodes are long screen or broadcast recordings. The
+    preprocess cost is single-thread encode seconds, scaled by the simulator
+    for the threads and preset an encode actually gets.
+    """
+
+    # kind: (median duration s, spread, probability the clip needs a fix)
+    KINDS = {
+        "phone": (20.0, 0.6, 0.6),
+        "podcast": (300.0, 0.5, 0.2),
+        "episode": (660.0, 0.2, 0.5),
+        "other": (60.0, 0.8, 0.4),
+    }
+
+    def __init__(self, encode_seconds_per_second=4.0, upload_mbit=40.0, video_mbit=10.0,
+                 process_base=30.0, process_per_second=0.5, publish_seconds=60.0):
+        self.encode_seconds_per_second = encode_seconds_per_second
+        self.upload_mbit = upload_mbit
+        self.video_mbit = video_mbit
+        self.process_base = process_base
+        self.process_per_second = process_per_second
+        self.publish_seconds = publish_seconds
+
+    @staticmethod
+    def kind(name):
+        if name.startswith(('IMG_', 'VID_')):
+            return "phone"
+        if name.startswith('podcast_'):
+            return "podcast"
+        if name.startswith(('Doraemon', '[')):
+            return "episode"
+        return "other"
+
+    def describe(self, name, rng):
+        median, spread, _ = self.KINDS[self.kind(name)]
+        return {"duration": rng.lognormvariate(0.0, spread) * median, "width": 1920, "height": 1080}
+
+    def stage_costs(self, name, summary, rng):
+        duration = summary["duration"]
+        pixel_scale = summary["width"] * summary["height"] / (1920 * 1080)
+        needs_fix = rng.random() < self.KINDS[self.kind(name)][2]
+        return {
+            "preprocess": 5.0 + (duration * pixel_scale * self.encode_seconds_per_second if needs_fix else 0.0),
+            "upload": duration * self.video_mbit * pixel_scale / self.upload_mbit,
+            "process": self.process_base + duration * self.process_per_second,
+            "publish": self.publish_seconds,
+        }
+
+
+class ProbeCostModel(KindCostModel):
+    """KindCostModel, but with the real duration and resolution of files still on disk."""
+
+    def __init__(self, media_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.media_dir = media_dir
+
+    def describe(self, name, rng):
+        path = os.path.join(self.media_dir, name)
+        summary = probe_video(path) if os.path.exists(path) else None
+        if summary and summary.get("duration"):
+            return {
+                "duration": summary["duration"],
+                "width": summary.get("width") or 1920,
+                "height": summary.get("height") or 1080,
+            }
+        return super().describe(name, rng)
+
+
+COST_MODELS = {
+    "constant": ConstantCostModel,
+    "kind": KindCostModel,
+    "probe": ProbeCostModel,
+}
+
+
+def replay(trace, workers, cost_model, policy=DEFAULT_POLICY, cores=None, compress=1.0,
+           failure_rate=0.0, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_base=DEFAULT_BACKOFF_BASE,
+           aging_seconds=DEFAULT_AGING_SECONDS, seed=23):
+    """
+    Replay an arrival trace through `workers` parallel queue workers.
+
+    Workers pick jobs with queue_scheduler.pick_next under the given policy,
+    using the production cost estimate. Each encode gets cores // workers
+    threads and the preset EncodeScheduler.choose_preset picks for the
+    current backlog. Failed attempts back off as in the real queue.
+
+    Args:
+        trace (list): (arrival datetime, filename) tuples.
+        workers (int): Concurrent autopub.py jobs.
+        cost_model: Object with describe(name, rng) and stage_costs(name, summary, rng).
+        policy (str): Scheduling policy.
+        cores (int, optional): CPUs shared by the encodes; defaults to this machine's.
+        compress (float): Divide inter-arrival gaps by this factor to model a burst.
+        failure_rate (float): Probability that an attempt fails.
+
+    Returns:
+        dict: time_to_publish per file, dropped files, depth samples
+        [(t, depth)], per-stage busy seconds and the simulated span.
+    """
+    rng = random.Random(seed)
+    encode_scheduler = EncodeScheduler()
+    cores = cores or len(encode_scheduler.cpus) or 1
+    threads = max(1, cores // workers)
+    start = trace[0][0] if trace else datetime.now()
+
+    pending = []
+    for index, (arrival, name) in enumerate(trace):
+        summary = cost_model.describe(name, rng)
+        job = Job(
+            path=name,
+            index=index,
+            enqueued_at=(arrival - start).total_seconds() / compress,
+            cost=estimate_processing_cost(summary),
+        )
+        job.extra = {"summary": summary, "stages": cost_model.stage_costs(name, summary, rng)}
+        pending.append(job)
+
+    queue, running = [], []
+    done, dropped, depth = {}, [], []
+    stage_busy = {stage: 0.0 for stage in STAGES}
+    now, next_arrival = 0.0, 0
+
+    def service_time(job):
+        stages = dict(job.extra["stages"])
+        preset = encode_scheduler.choose_preset(job.extra["summary"]["duration"], len(queue))
+        stages["preprocess"] *= PRESET_COST[preset] / _encode_rate(threads)
+        for stage, seconds in stages.items():
+            stage_busy[stage] += seconds
+        return sum(stages.values())
+
+    while next_arrival < len(pending) or queue or running:
+        while next_arrival < len(pending) and pending[next_arrival].enqueued_at <= now:
+            queue.append(pending[next_arrival])
+            next_arrival += 1
+
+        # Hand jobs to idle workers
+        while len(running) < workers:
+            job = pick_next(queue, policy, now, aging_seconds)
+            if job is None:
+                break
+            queue.remove(job)
+            heapq.heappush(running, (now + service_time(job), job.index, job))
+        depth.append((now, len(queue) + len(running)))
+
+        # Advance to the next arrival, completion or retry
+        wake_times = [running[0][0]] if running else []
+        if next_arrival < len(pending):
+            wake_times.append(pending[next_arrival].enqueued_at)
+        if len(running) < workers:
+            wake_times += [job.next_attempt_at for job in queue if job.next_attempt_at > now]
+        if not wake_times:
+            break
+        now = max(now, min(wake_times))
+
+        while running and running[0][0] <= now:
+            finished_at, _, job = heapq.heappop(running)
+            if rng.random() < failure_rate:
+                job.attempts += 1
+                if job.attempts >= max_attempts:
+                    dropped.append(job.path)
+                else:
+                    job.next_attempt_at = finished_at + backoff_delay(job.attempts, backoff_base)
+                    queue.append(job)
+                continue
+            done[job.path] = finished_at - job.enqueued_at
+
+    return {
+        "time_to_publish": done,
+        "dropped": dropped,
+        "depth": depth,
+        "stage_busy": stage_busy,
+        "span": now,
+    }
+
+
+def depth_series(depth, bucket_seconds):
+    """Maximum queue depth per time bucket."""
+    series = {}
+    for t, d in depth:
+        bucket = int(t // bucket_seconds)
+        series[bucket] = max(series.get(bucket, 0), d)
+    return sorted(series.items())
+
+
+def summarize(result):
+    times = list(result["time_to_publish"].values())
+    depth = result["depth"]
+    weighted = sum((t2 - t1) * d for (t1, d), (t2, _) in zip(depth, depth[1:]))
+    return {
+        "jobs": len(times),
+        "dropped": len(result["dropped"]),
+        "p50": percentile(times, 50),
+        "p90": percentile(times, 90),
+        "p95": percentile(times, 95),
+        "p99": percentile(times, 99),
+        "max": max(times, default=0.0),
+        "peak_depth": max((d for _, d in depth), default=0),
+        "mean_depth": weighted / result["span"] if result["span"] else 0.0,
+    }
+
+
+def parse_slo(spec):
+    """Parse a `p95=3600`-style SLO into ('p95', 3600.0), as an argparse type."""
+    key, _, value = spec.partition('=')
+    try:
+        if key in ("p50", "p90", "p95", "p99", "max"):
+            return key, float(value)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Invalid SLO '{spec}', expected e.g. p95=3600")
+
+
+def size_workers(trace, cost_model, slos, max_workers, **replay_kwargs):
+    """
+    Replay with 1..max_workers workers and find the fewest that meet every SLO.
+
+    Returns:
+        tuple: (workers or None, {workers: summary})
+    """
+    summaries = {}
+    needed = None
+    for workers in range(1, max_workers + 1):
+        summary = summarize(replay(trace, workers, cost_model, **replay_kwargs))
+        summaries[workers] = summary
+        if all(summary[key] <= limit for key, limit in slos.items()):
+            needed = workers
+            break
+    return needed, summaries
+
+
+def _format_seconds(seconds):
+    if seconds >= 2 * 86400:
+        return f"{seconds / 86400:.1f}d"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    if seconds >= 60:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds:.0f}s"
+
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Replay ledger arrivals through the queue scheduler")
+    parser.add_argument('ledgers', nargs='*', help="Ledger files (default: processed.csv* and videos_db.csv* here)")
+    parser.add_argument('--model', choices=sorted(COST_MODELS), default="kind", help="Stage cost model")
+    parser.add_argument('--media-dir', help="Directory with the original files (for --model probe)")
+    parser.add_argument('--policy', choices=POLICIES, default=DEFAULT_POLICY, help="Scheduling policy")
+    parser.add_argument('--workers', type=int, default=1, help="Concurrent jobs")
+    parser.add_argument('--cores', type=int, help="CPUs shared by encodes (default: this machine)")
+    parser.add_argument('--compress', type=float, default=1.0, help="Speed up arrivals by this factor")
+    parser.add_argument('--failure-rate', type=float, default=0.02, help="Probability an attempt fails")
+    parser.add_argument('--slo', type=parse_slo, action='append', default=[], help="Time-to-publish SLO, e.g. p95=3600 (repeatable)")
+    parser.add_argument('--max-workers', type=int, default=16, help="Largest worker count tried for --slo")
+    parser.add_argument('--depth-bucket', type=float, default=86400.0, help="Seconds per queue-depth row")
+    parser.add_argument('--depth-csv', help="Write every depth sample (t,depth) to this CSV")
+    parser.add_argument('--seed', type=int, default=23, help="Random seed")
+    args = parser.parse_args()
+
+    trace = load_trace(args.ledgers or default_ledgers(script_dir))
+    if not trace:
+        parser.error("no arrivals with timestamps found in the ledgers")
+    if args.model == "probe":
+        if not args.media_dir:
+            parser.error("--model probe needs --media-dir")
+        cost_model = ProbeCostModel(args.media_dir)
+    else:
+        cost_model = COST_MODELS[args.model]()
+    replay_kwargs = dict(policy=args.policy, cores=args.cores, compress=args.compress,
+                         failure_rate=args.failure_rate, seed=args.seed)
+
+    print(f"Trace: {len(trace)} arrivals from {trace[0][0]} to {trace[-1][0]}"
+          f"{f' (compressed {args.compress:g}x)' if args.compress != 1 else ''}")
+
+    result = replay(trace, args.workers, cost_model, **replay_kwargs)
+    summary = summarize(result)
+    print(f"\n{args.workers} worker(s), policy {args.policy}, model {args.model}")
+    print(f"Time to publish: p50 {_format_seconds(summary['p50'])}, p90 {_format_seconds(summary['p90'])}, "
+          f"p95 {_format_seconds(summary['p95'])}, p99 {_format_seconds(summary['p99'])}, "
+          f"max {_format_seconds(summary['max'])}; {summary['dropped']} dropped")
+    print(f"Queue depth: peak {summary['peak_depth']}, time-weighted mean {summary['mean_depth']:.2f}")
+    busy = result["stage_busy"]
+    total_busy = sum(busy.values()) or 1.0
+    print("Stage share: " + ", ".join(f"{stage} {busy[stage] / total_busy:.0%}" for stage in STAGES))
+
+    print(f"\nPeak depth per {_format_seconds(args.depth_bucket)}:")
+    for bucket, peak in depth_series(result["depth"], args.depth_bucket):
+        if peak:
+            print(f"  +{_format_seconds(bucket * args.depth_bucket):>7}  {peak:>4}  {'#' * min(peak, 60)}")
+
+    if args.depth_csv:
+        with open(args.depth_csv, 'w') as f:
+            f.write("t,depth\n")
+            for t, d in result["depth"]:
+                f.write(f"{t:.1f},{d}\n")
+
+    if args.slo:
+        slos = dict(args.slo)
+        needed, summaries = size_workers(trace, cost_model, slos, args.max_workers, **replay_kwargs)
+        print(f"\nWorker sizing for {', '.join(f'{k} <= {_format_seconds(v)}' for k, v in slos.items())}:")
+        print(f"{'workers':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'peak':>6}")
+        for workers, s in summaries.items():
+            print(f"{workers:>8}{_format_seconds(s['p50']):>9}{_format_seconds(s['p95']):>9}"
+                  f"{_format_seconds(s['p99']):>9}{s['peak_depth']:>6}")
+        if needed is None:
+            print(f"No worker count up to {args.max_workers} meets the SLOs.")
+        else:
+            print(f"{needed} worker(s) meet the SLOs.")
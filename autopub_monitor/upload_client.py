@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# upload_client.py - Multipart uploads through the bandwidth arbiter, including audio-first uploads
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import requests
+from requests_toolbelt import MultipartEncoder
+from requests_toolbelt.multipart import decoder
+
+from bandwidth_arbiter import BandwidthArbiter, ThrottledReader, TokenBucket
+from media_probe import probe_video
+from media_runner import run_media_command
+
+# Containers that take a stream copy of each audio codec; Matroska takes anything else
+AUDIO_CONTAINERS = {
+    'aac': '.m4a',
+    'alac': '.m4a',
+    'mp3': '.mp3',
+}
+
+
+def send_file(method, url, file_field, file_path, fields=None, params=None,
+              bandwidth=None, kind="upload", filename=None):
+    """
+    Send a file as a streamed multipart body, rate-limited by the bandwidth arbiter.
+
+    Args:
+        method (str): "post" or "put".
+        url (str): Endpoint.
+        file_field (str): Form field of the file.
+        file_path (str): File to send.
+        fields (dict, optional): Extra string form fields.
+        params (dict, optional): Query parameters.
+        bandwidth (BandwidthArbiter, optional): Arbiter to register the transfer with.
+        kind (str): Transfer kind for the arbiter ("upload" or "publish").
+        filename (str, optional): Name sent for the file; defaults to its basename.
+
+    Returns:
+        requests.Response: The server's response.
+    """
+    bandwidth = bandwidth or BandwidthArbiter()
+    filename = filename or os.path.basename(file_path)
+    with open(file_path, 'rb') as f, bandwidth.transfer(kind, filename) as bucket:
+        body = MultipartEncoder(fields={**(fields or {}), file_field: (filename, f)})
+        return requests.request(
+            method, url,
+            data=ThrottledReader(body, bucket),
+            params=params,
+            headers={'Content-Type': body.content_type},
+        )
+
+
+def extract_audio(video_path, output_dir, summary=None):
+    """
+    Copy the first audio stream into its own file without re-encoding.
+
+    Returns:
+        str or None: Path of the audio file, or None if the video has no audio.
+    """
+    summary = summary or probe_video(video_path)
+    if summary is not None and not summary.get('has_audio'):
+        return None
+    extension = AUDIO_CONTAINERS.get((summary or {}).get('audio_codec'), '.mka')
+    audio_path = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}_audio{extension}")
+    run_media_command(
+        ['ffmpeg', '-y', '-v', 'error', '-i', video_path, '-map', '0:a:0', '-vn', '-c:a', 'copy', audio_path],
+        check=True, timeout=600,
+    )
+    return audio_path
+
+
+class AudioFirstUpload:
+    """
+    Upload the audio track first so the server can start transcribing, then
+    the full video in the background, linked to the same `video_id`.
+
+    Protocol:
+      1. POST `audio_upload_url` with the usual `filename`/`title`/`source`
+         fields and an `audio` file; the server answers with a JSON `video_id`
+         and may start transcription right away.
+      2. POST `upload_url` with the same fields plus `video_id` and the
+         `video` file; the server attaches the video to that record and
+         answers like a regular upload.
+    """
+
+    def __init__(self, video_path, upload_url, audio_upload_url, upload_data,
+                 bandwidth=None, work_dir=None, audio_path=None, filename=None):
+        """
+        Args:
+            video_path (str): Video to upload.
+            upload_url (str): Regular upload endpoint.
+            audio_upload_url (str): Audio upload endpoint.
+            upload_data (dict): Form fields sent with both uploads.
+            bandwidth (BandwidthArbiter, optional): Arbiter for both transfers.
+            work_dir (str, optional): Where the extracted audio is written; a
+                temporary directory, removed once the upload is over, otherwise.
+            audio_path (str, optional): Already extracted audio; skips extraction.
+            filename (str, optional): Name sent for the video; defaults to its basename.
+        """
+        self.video_path = video_path
+        self.upload_url = upload_url
+        self.audio_upload_url = audio_upload_url
+        self.upload_data = dict(upload_data)
+        self.bandwidth = bandwidth or BandwidthArbiter()
+        self.filename = filename
+        self._owns_work_dir = work_dir is None
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix="audio_first_")
+        self.audio_path = audio_path
+        self.audio_payload = None
+        self.video_response = None
+        self.video_error = None
+        self.audio_seconds = None
+        self.video_seconds = None
+        self._start_time = None
+        self._thread = None
+
+    def start(self):
+        """
+        Extract and upload the audio, then start the video upload in the background.
+
+        Returns:
+            bool: False if the video has no audio or the audio upload failed,
+            in which case nothing was started and the caller uploads normally.
+        """
+        self._start_time = time.time()
+        try:
+            if self.audio_path is None:
+                self.audio_path = extract_audio(self.video_path, self.work_dir)
+            if self.audio_path is None:
+                print("No audio track; uploading the video the usual way.")
+                self._remove_work_dir()
+                return False
+            response = send_file(
+                'post', self.audio_upload_url, 'audio', self.audio_path,
+                fields=self.upload_data, bandwidth=self.bandwidth,
+            )
+            response.raise_for_status()
+            self.audio_payload = response.json()
+        except Exception as e:
+            print(f"Audio-first upload failed ({e}); uploading the video the usual way.")
+            self._remove_work_dir()
+            return False
+
+        self.audio_seconds = time.time() - self._start_time
+        video_id = self.audio_payload.get('video_id')
+        print(f"Audio uploaded in {self.audio_seconds:.1f}s as video_id {video_id}; "
+              f"uploading the video in the background.")
+        if video_id is not None:
+            self.upload_data['video_id'] = str(video_id)
+        self._thread = threading.Thread(target=self._upload_video, name="video-upload", daemon=True)
+        self._thread.start()
+        return True
+
+    def _upload_video(self):
+        try:
+            self.video_response = send_file(
+                'post', self.upload_url, 'video', self.video_path,
+                fields=self.upload_data, bandwidth=self.bandwidth, filename=self.filename,
+            )
+        except Exception as e:
+            self.video_error = e
+        finally:
+            self.video_seconds = time.time() - self._start_time
+
+    def wait(self):
+        """
+        Wait for the video upload.
+
+        Returns:
+            requests.Response: The video upload's response.
+
+        Raises:
+            Exception: Whatever the background upload raised.
+        """
+        self._thread.join()
+        self._remove_work_dir()
+        if self.video_error is not None:
+            raise self.video_error
+        print(f"Video upload finished {self.video_seconds:.1f}s after the start "
+              f"(transcription could start at {self.audio_seconds:.1f}s).")
+        return self.video_response
+
+    def _remove_work_dir(self):
+        # Only a directory this upload created; a caller's workspace stays theirs
+        if self._owns_work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class _StandInServer:
+    """
+    Local stand-in for the processing server, behind a throttled uplink.
+
+    Request bodies are read through a shared token bucket at the link rate.
+    The server notes when transcription could start: when the audio has
+    arrived for an audio-first upload, or when the whole video has arrived
+    for a regular upload.
+    """
+
+    def __init__(self, link_bytes_per_second):
+        self.link = TokenBucket(link_bytes_per_second, burst=64 * 1024)
+        self.transcription_ready = {}
+        self.videos = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                remaining = int(self.headers['Content-Length'])
+                chunks = []
+                while remaining:
+                    chunk = self.rfile.read(min(64 * 1024, remaining))
+                    server.link.consume(len(chunk))
+                    chunks.append(chunk)
+                    remaining -= len(chunk)
+                parts = decoder.MultipartDecoder(b''.join(chunks), self.headers['Content-Type']).parts
+                fields = {}
+                for part in parts:
+                    name = part.headers[b'Content-Disposition'].decode().split('name="')[1].split('"')[0]
+                    fields[name] = part.content
+
+                with server._lock:
+                    video_id = fields.get('video_id', b'').decode() or str(server._next_id)
+                    if not fields.get('video_id'):
+                        server._next_id += 1
+                    if urlparse(self.path).path.endswith('/audio'):
+                        server.transcription_ready[video_id] = time.time()
+                    else:
+                        server.videos[video_id] = len(fields.get('video', b''))
+                        server.transcription_ready.setdefault(video_id, time.time())
+
+                payload = json.dumps({"video_id": video_id, "file_path": f"/uploads/{video_id}.mp4"}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def run_benchmark(duration=120.0, video_kbps=8000, audio_kbps=192, link_mib=4.0, video=None):
+    """
+    Time to transcription start, regular versus audio-first upload.
+
+    Uses synthetic files sized by the bitrates (no ffmpeg needed) unless a real
+    video is given, in which case its audio is extracted with a stream copy
+    and the extraction counts towards the audio-first time.
+    """
+    with tempfile.TemporaryDirectory(prefix="audio_first_bench_") as work_dir:
+        audio_path = None
+        if video is None:
+            video = os.path.join(work_dir, "clip.mp4")
+            audio_path = os.path.join(work_dir, "clip_audio.m4a")
+            with open(video, 'wb') as f:
+                f.write(os.urandom(int(duration * (video_kbps + audio_kbps) * 1000 / 8)))
+            with open(audio_path, 'wb') as f:
+                f.write(os.urandom(int(duration * audio_kbps * 1000 / 8)))
+
+        size = os.path.getsize(video)
+        server = _StandInServer(link_mib * 1024 * 1024)
+        bandwidth = BandwidthArbiter(state_dir=os.path.join(work_dir, 'bandwidth'))
+        upload_data = {"filename": os.path.basename(video), "title": "benchmark"}
+        try:
+            start_time = time.time()
+            response = send_file('post', f"{server.url}/upload", 'video', video,
+                                 fields=upload_data, bandwidth=bandwidth)
+            regular_id = response.json()['video_id']
+            regular = (server.transcription_ready[regular_id] - start_time, time.time() - start_time)
+
+            start_time = time.time()
+            upload = AudioFirstUpload(video, f"{server.url}/upload", f"{server.url}/upload/audio",
+                                      upload_data, bandwidth=bandwidth, work_dir=work_dir, audio_path=audio_path)
+            if not upload.start():
+                raise RuntimeError("audio-first upload did not start")
+            audio_first_id = upload.wait().json()['video_id']
+            audio_first = (server.transcription_ready[audio_first_id] - start_time, time.time() - start_time)
+            assert audio_first_id == upload.audio_payload['video_id'], "video was not linked to the audio's video_id"
+        finally:
+            server.close()
+
+    print(f"Video {size / 1024 ** 2:.1f} MiB over a {link_mib:.1f} MiB/s stand-in link")
+    print(f"{'mode':<13}{'transcription start':>21}{'upload done':>13}")
+    for mode, (ready, done) in (("regular", regular), ("audio-first", audio_first)):
+        print(f"{mode:<13}{ready:>20.2f}s{done:>12.2f}s")
+    return {"regular": regular, "audio-first": audio_first}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audio-first upload against a local stand-in server")
+    parser.add_argument('--video', help="Real video to upload (needs ffmpeg); synthetic files otherwise")
+    parser.add_argument('--duration', type=float, default=120.0, help="Synthetic clip length (s)")
+    parser.add_argument('--video-kbps', type=int, default=8000, help="Synthetic video bitrate")
+    parser.add_argument('--audio-kbps', type=int, default=192, help="Synthetic audio bitrate")
+    parser.add_argument('--link-mib', type=float, default=4.0, help="Stand-in link speed (MiB/s)")
+    args = parser.parse_args()
+    run_benchmark(args.duration, args.video_kbps, args.audio_kbps, args.link_mib, args.video)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# upload_planner.py - Decide whether to transcode a video down before uploading it
+
+import os
+import json
+import time
+import argparse
+from dataclasses import dataclass, asdict
+
+from media_probe import probe_video, DEFAULT_PROBE_CACHE_DIR
+from media_runner import run_media_command
+from toolchain import get_toolchain
+
+DEFAULT_UPLOAD_HISTORY = os.path.expanduser('~/AutoPublishDATA/upload_history.json')
+DEFAULT_TARGET_VIDEO_KBPS = 8000
+DEFAULT_TARGET_SHORT_SIDE = 1080
+AUDIO_KBPS = 192
+
+# Transcode seconds per second of source video per source megapixel, used
+# until real transcodes have been measured (x264 veryfast on a few cores)
+DEFAULT_TRANSCODE_RATE = 0.15
+
+
+class UploadHistory:
+    """
+    Recent upload and transcode measurements.
+
+    Upload throughput is the byte-weighted average of the last `window`
+    uploads. The transcode rate is seconds of work per second of source video
+    per source megapixel, so clips of any length and resolution inform the
+    estimate for the next one.
+    """
+
+    def __init__(self, path=DEFAULT_UPLOAD_HISTORY, window=20):
+        self.path = path
+        self.window = window
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault("uploads", [])
+        self.data.setdefault("transcodes", [])
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self.data, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Warning: could not save upload history {self.path}: {e}")
+
+    def record_upload(self, size_bytes, seconds):
+        if seconds <= 0:
+            return
+        self.data["uploads"] = (self.data["uploads"] + [
+            {"at": time.time(), "bytes": size_bytes, "seconds": seconds}
+        ])[-self.window:]
+        self._save()
+
+    def record_transcode(self, duration, megapixels, seconds):
+        if duration <= 0 or megapixels <= 0:
+            return
+        self.data["transcodes"] = (self.data["transcodes"] + [
+            {"at": time.time(), "rate": seconds / (duration * megapixels)}
+        ])[-self.window:]
+        self._save()
+
+    def throughput(self):
+        """Recent upload throughput in bytes per second, or None before the first upload."""
+        uploads = self.data["uploads"]
+        seconds = sum(u["seconds"] for u in uploads)
+        return sum(u["bytes"] for u in uploads) / seconds if seconds > 0 else None
+
+    def transcode_rate(self):
+        """Mean measured transcode rate, or the default before the first transcode."""
+        rates = [t["rate"] for t in self.data["transcodes"]]
+        return sum(rates) / len(rates) if rates else DEFAULT_TRANSCODE_RATE
+
+
+@dataclass
+class UploadPlan:
+    """The upload decision for one file and the timings it was based on."""
+    transcode: bool
+    reason: str
+    original_bytes: int
+    target_bytes: int = 0
+    upload_seconds: float = None
+    transcode_seconds: float = None
+    transcoded_upload_seconds: float = None
+
+    @property
+    def predicted_seconds(self):
+        """Predicted time until the upload finishes along the chosen path."""
+        if self.transcode:
+            return self.transcode_seconds + self.transcoded_upload_seconds
+        return self.upload_seconds
+
+
+def plan_upload(summary, size_bytes, history, target_video_kbps=DEFAULT_TARGET_VIDEO_KBPS,
+                target_short_side=DEFAULT_TARGET_SHORT_SIDE, min_gain=0.2):
+    """
+    Compare uploading the original with transcoding to the target first.
+
+    Args:
+        summary (dict or None): Probe summary of the video.
+        size_bytes (int): Size of the original file.
+        history (UploadHistory): Recent throughput and transcode measurements.
+        target_video_kbps (int): Video bitrate of the transcode.
+        target_short_side (int): Short side of the transcode in pixels.
+        min_gain (float): Fraction of the upload time the transcode path must save.
+
+    Returns:
+        UploadPlan: Whether to transcode, and the predicted timings.
+    """
+    plan = UploadPlan(transcode=False, reason="", original_bytes=size_bytes)
+    throughput = history.throughput()
+    if throughput is None:
+        plan.reason = "no upload throughput measured yet"
+        return plan
+    plan.upload_seconds = size_bytes / throughput
+
+    duration = (summary or {}).get('duration')
+    width, height = (summary or {}).get('width'), (summary or {}).get('height')
+    if not duration or not width or not height:
+        plan.reason = "no duration or resolution from the probe"
+        return plan
+
+    source_kbps = size_bytes * 8 / 1000 / duration
+    if source_kbps <= (target_video_kbps + AUDIO_KBPS) * 1.1 and min(width, height) <= target_short_side:
+        plan.reason = f"already within the target ({source_kbps:.0f} kbps)"
+        return plan
+
+    plan.target_bytes = int(duration * (min(target_video_kbps, source_kbps) + AUDIO_KBPS) * 1000 / 8)
+    plan.transcode_seconds = history.transcode_rate() * duration * width * height / 1e6
+    plan.transcoded_upload_seconds = plan.target_bytes / throughput
+
+    transcode_path = plan.transcode_seconds + plan.transcoded_upload_seconds
+    if transcode_path < plan.upload_seconds * (1 - min_gain):
+        plan.transcode = True
+        plan.reason = f"transcode saves {plan.upload_seconds - transcode_path:.0f}s"
+    else:
+        plan.reason = f"transcode would not pay off ({transcode_path:.0f}s vs {plan.upload_seconds:.0f}s)"
+    return plan
+
+
+def transcode_for_upload(input_path, output_path, encode_scheduler, duration=None,
+                         target_video_kbps=DEFAULT_TARGET_VIDEO_KBPS,
+                         target_short_side=DEFAULT_TARGET_SHORT_SIDE):
+    """Transcode to the target bitrate and short side within an encode slot; returns the seconds taken."""
+    toolchain = get_toolchain()
+    side = int(target_short_side)
+    # Cap the short side so portrait clips are not squeezed to a 1080-pixel height
+    scale = f"scale='if(gt(iw,ih),-2,min(iw,{side}))':'if(gt(iw,ih),min(ih,{side}),-2)'"
+    start_time = time.time()
+    with encode_scheduler.reserve(duration=duration) as slot:
+        command = [
+            'ffmpeg', '-y', '-v', 'error', '-i', input_path,
+            '-map', '0:v:0', '-map', '0:a:0?',
+            *toolchain.h264_args('veryfast', threads=slot.threads, bitrate_kbps=target_video_kbps),
+            '-vf', scale, '-pix_fmt', 'yuv420p',
+            '-c:a', toolchain.aac_encoder(), '-b:a', f'{AUDIO_KBPS}k',
+            '-movflags', '+faststart', output_path
+        ]
+        run_media_command(command, check=True, timeout=3600, preexec_fn=slot.preexec(),
+                          suspend_check=slot.suspend_check)
+    return time.time() - start_time
+
+
+class UploadPlanner:
+    """Plans and runs the optional pre-upload transcode, and learns from each upload."""
+
+    def __init__(self, history_path=DEFAULT_UPLOAD_HISTORY, enabled=True,
+                 target_video_kbps=DEFAULT_TARGET_VIDEO_KBPS,
+                 target_short_side=DEFAULT_TARGET_SHORT_SIDE, min_gain=0.2,
+                 probe_cache_dir=DEFAULT_PROBE_CACHE_DIR):
+        self.history = UploadHistory(history_path)
+        self.enabled = enabled
+        self.target_video_kbps = target_video_kbps
+        self.target_short_side = target_short_side
+        self.min_gain = min_gain
+        self.probe_cache_dir = probe_cache_dir
+
+    def plan(self, video_path):
+        summary = probe_video(video_path, cache_dir=self.probe_cache_dir)
+        plan = plan_upload(
+            summary, os.path.getsize(video_path), self.history,
+            self.target_video_kbps, self.target_short_side, self.min_gain,
+        )
+        if not self.enabled and plan.transcode:
+            plan.transcode = False
+            plan.reason = f"adaptive upload disabled ({plan.reason})"
+        return plan, summary
+
+    def prepare(self, video_path, output_path, encode_scheduler, workspace=None):
+        """
+        Return the file to upload: the original, or a transcode when that is faster overall.
+
+        The transcode is optional, so any failure (including a lack of space in
+        the workspace) falls back to the original.
+
+        Returns:
+            tuple: (path to upload, UploadPlan)
+        """
+        plan, summary = self.plan(video_path)
+        print(f"Upload plan for {os.path.basename(video_path)}: "
+              f"{'transcode' if plan.transcode else 'original'} - {plan.reason}")
+        if not plan.transcode:
+            return video_path, plan
+
+        print(f"   Predicted: transcode {plan.transcode_seconds:.0f}s + upload {plan.transcoded_upload_seconds:.0f}s "
+              f"({plan.target_bytes / 1024 ** 2:.0f} MB) vs upload {plan.upload_seconds:.0f}s "
+              f"({plan.original_bytes / 1024 ** 2:.0f} MB)")
+        try:
+            if workspace:
+                workspace.admit("upload transcode", plan.target_bytes)
+            seconds = transcode_for_upload(
+                video_path, output_path, encode_scheduler, summary['duration'],
+                self.target_video_kbps, self.target_short_side,
+            )
+        except Exception as e:
+            print(f"Warning: pre-upload transcode failed ({e}); uploading the original.")
+            plan.transcode = False
+            return video_path, plan
+
+        self.history.record_transcode(summary['duration'], summary['width'] * summary['height'] / 1e6, seconds)
+        print(f"   Transcode took {seconds:.0f}s (predicted {plan.transcode_seconds:.0f}s), "
+              f"{os.path.getsize(output_path) / 1024 ** 2:.0f} MB")
+        plan.transcode_seconds = seconds
+        return output_path, plan
+
+    def record_upload(self, upload_path, seconds, plan=None):
+        """Record a finished upload and log it against the plan's prediction."""
+        size_bytes = os.path.getsize(upload_path)
+        self.history.record_upload(size_bytes, seconds)
+        if plan is not None and plan.upload_seconds is not None:
+            predicted = plan.transcoded_upload_seconds if plan.transcode else plan.upload_seconds
+            total = seconds + (plan.transcode_seconds if plan.transcode else 0)
+            print(f"Upload took {seconds:.0f}s (predicted {predicted:.0f}s); "
+                  f"total {total:.0f}s (predicted {plan.predicted_seconds:.0f}s), "
+                  f"{size_bytes / seconds / 1024 ** 2:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the pre-upload transcode decision for videos")
+    parser.add_argument('videos', nargs='*', help="Videos to plan")
+    parser.add_argument('--history', default=DEFAULT_UPLOAD_HISTORY, help="Upload history file")
+    parser.add_argument('--target-kbps', type=int, default=DEFAULT_TARGET_VIDEO_KBPS, help="Target video bitrate")
+    parser.add_argument('--target-short-side', type=int, default=DEFAULT_TARGET_SHORT_SIDE,
+                        help="Target short side in pixels")
+    args = parser.parse_args()
+
+    planner = UploadPlanner(args.history, target_video_kbps=args.target_kbps,
+                            target_short_side=args.target_short_side)
+    throughput = planner.history.throughput()
+    print(f"Upload throughput: {throughput / 1024 ** 2:.2f} MB/s" if throughput else "Upload throughput: unknown")
+    print(f"Transcode rate: {planner.history.transcode_rate():.3f} s per second per megapixel")
+    for video in args.videos:
+        plan, _ = planner.plan(video)
+        print(f"{video}: {json.dumps(asdict(plan))}")
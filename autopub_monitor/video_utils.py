@@ -5,15 +5,19 @@ Video utilities for lazyedit - wrapper functions for video preprocessing
 import os
 from pathlib import Path
 from handbrake import preprocess_video
+from media_probe import DEFAULT_SPECULATIVE_DIR
 
 
-def ensure_video_compatibility(input_path: str, output_dir: str = None) -> str:
+def ensure_video_compatibility(input_path: str, output_dir: str = None, encode_scheduler=None,
+                               speculative_dir: str = DEFAULT_SPECULATIVE_DIR) -> str:
     """
     Ensure video is compatible with FFmpeg processing pipeline
     
     Args:
         input_path (str): Path to input video
         output_dir (str, optional): Directory for output. Defaults to same as input.
+        encode_scheduler (EncodeScheduler, optional): Shared CPU budget for encodes.
+        speculative_dir (str): Directory of checks done while files were still syncing.
     
     Returns:
         str: Path to compatible video (original if no fixes needed, or fixed version)
@@ -31,7 +35,10 @@ def ensure_video_compatibility(input_path: str, output_dir: str = None) -> str:
     
     try:
         # Use the handbrake preprocessor
-        compatible_path, was_fixed = preprocess_video(str(input_path), str(output_path))
+        compatible_path, was_fixed = preprocess_video(
+            str(input_path), str(output_path), encode_scheduler=encode_scheduler,
+            speculative_dir=speculative_dir
+        )
         
         return compatible_path
         
@@ -41,13 +48,16 @@ def ensure_video_compatibility(input_path: str, output_dir: str = None) -> str:
         return str(input_path)
 
 
-def preprocess_if_needed(video_path: str, output_dir: str = None) -> str:
+def preprocess_if_needed(video_path: str, output_dir: str = None, encode_scheduler=None,
+                         speculative_dir: str = DEFAULT_SPECULATIVE_DIR) -> str:
     """
     Simple wrapper that preprocesses video only if needed
     
     Args:
         video_path (str): Path to video file
         output_dir (str, optional): Directory for output. Defaults to temp directory.
+        encode_scheduler (EncodeScheduler, optional): Shared CPU budget for encodes.
+        speculative_dir (str): Directory of checks done while files were still syncing.
         
     Returns:
         str: Path to processed video (may be original if no processing needed)
@@ -58,4 +68,5 @@ def preprocess_if_needed(video_path: str, output_dir: str = None) -> str:
     if output_dir is None:
         output_dir = tempfile.mkdtemp(prefix="video_preprocess_")
     
-    return ensure_video_compatibility(video_path, output_dir)
\ No newline at end of file
+    return ensure_video_compatibility(video_path, output_dir, encode_scheduler=encode_scheduler,
+                                      speculative_dir=speculative_dir)
\ No newline at end of file
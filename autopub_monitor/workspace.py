@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# workspace.py - Per-job scratch space with tmpfs placement, cleanup and disk-space admission
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import argparse
+
+DEFAULT_SHM_DIR = '/dev/shm'
+DEFAULT_SHM_LIMIT_BYTES = 256 * 1024 * 1024
+DEFAULT_RESERVE_BYTES = 2 * 1024 * 1024 * 1024
+
+# Exit code used by autopub.py when a job is deferred for lack of disk space (EX_TEMPFAIL)
+EXIT_DEFERRED = 75
+
+
+class InsufficientSpaceError(Exception):
+    """A stage's estimated output does not fit in the free-space budget."""
+
+    def __init__(self, stage, needed, available, path):
+        self.stage = stage
+        self.needed = needed
+        self.available = available
+        self.path = path
+        super().__init__(
+            f"Not enough space for stage '{stage}' in {path}: "
+            f"needs {needed / 1024 ** 3:.2f} GB, {available / 1024 ** 3:.2f} GB available"
+        )
+
+
+def free_bytes(path):
+    """Bytes available to unprivileged users on the filesystem holding path."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+class JobWorkspace:
+    """
+    Disk space for one job.
+
+    - Artifacts (the fixed or augmented video) live in a job directory under
+      the base directory. The directory name is derived from the source path,
+      so a retry finds the artifacts a checkpoint points to.
+    - Scratch files (segment encodes, concat lists) live in scratch
+      directories, on /dev/shm when they are small enough to fit there.
+
+    On exit, scratch is always removed. The job directory is removed as well
+    unless the job failed, in which case it is kept for the retry.
+    """
+
+    def __init__(self, source_path, base_dir, shm_dir=DEFAULT_SHM_DIR,
+                 shm_limit_bytes=DEFAULT_SHM_LIMIT_BYTES, reserve_bytes=DEFAULT_RESERVE_BYTES):
+        """
+        Args:
+            source_path (str): The video the job processes.
+            base_dir (str): Directory that holds job directories (e.g. PreprocessedVideos).
+            shm_dir (str): tmpfs mount for small intermediates; None disables it.
+            shm_limit_bytes (int): Largest intermediate placed on tmpfs.
+            reserve_bytes (int): Free space that must remain after a stage's output.
+        """
+        key = hashlib.sha1(os.path.realpath(source_path).encode('utf-8')).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        self.name = f"{stem}.{key}"
+        self.base_dir = base_dir
+        self.job_dir = os.path.join(base_dir, 'jobs', self.name)
+        self.shm_dir = shm_dir if shm_dir and os.path.isdir(shm_dir) else None
+        self.shm_limit_bytes = shm_limit_bytes
+        self.reserve_bytes = reserve_bytes
+        self.keep_artifacts = False
+        self._scratch_dirs = []
+
+    def __enter__(self):
+        os.makedirs(self.job_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.keep_artifacts = True
+        self.cleanup()
+        return False
+
+    def artifact_path(self, filename):
+        """Path for a stage output that must survive until the job succeeds."""
+        os.makedirs(self.job_dir, exist_ok=True)
+        return os.path.join(self.job_dir, filename)
+
+    def scratch_dir(self, estimated_bytes=None):
+        """
+        A fresh scratch directory, removed when the workspace closes.
+
+        Placed on tmpfs when estimated_bytes is known and fits there.
+        """
+        parent = os.path.join(self.job_dir, 'scratch')
+        if (
+            self.shm_dir
+            and estimated_bytes is not None
+            and estimated_bytes <= self.shm_limit_bytes
+            and free_bytes(self.shm_dir) - estimated_bytes > self.shm_limit_bytes
+        ):
+            parent = self.shm_dir
+        os.makedirs(parent, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f"autopub_{self.name}_", dir=parent)
+        self._scratch_dirs.append(path)
+        return path
+
+    def scratch_path(self, filename, estimated_bytes=None):
+        """Path for a single intermediate file in a new scratch directory."""
+        return os.path.join(self.scratch_dir(estimated_bytes), filename)
+
+    def admit(self, stage, estimated_bytes, path=None):
+        """
+        Refuse to start a stage whose output would eat into the reserve.
+
+        Args:
+            stage (str): Stage name for the error message.
+            estimated_bytes (int): Expected output size of the stage.
+            path (str, optional): Where the output goes; defaults to the job directory.
+
+        Raises:
+            InsufficientSpaceError: If the output does not fit.
+        """
+        target = path or self.job_dir
+        os.makedirs(target, exist_ok=True)
+        available = free_bytes(target) - self.reserve_bytes
+        if estimated_bytes > available:
+            raise InsufficientSpaceError(stage, estimated_bytes, max(0, available), target)
+
+    def cleanup(self):
+        """Remove scratch directories, and the job directory unless artifacts are kept."""
+        for path in self._scratch_dirs:
+            shutil.rmtree(path, ignore_errors=True)
+        self._scratch_dirs = []
+        if self.keep_artifacts:
+            shutil.rmtree(os.path.join(self.job_dir, 'scratch'), ignore_errors=True)
+        else:
+            shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def cleanup_stale_workspaces(base_dir, max_age_days=7):
+    """
+    Remove job directories left behind by jobs that never succeeded.
+
+    Returns:
+        list: The removed directories.
+    """
+    jobs_dir = os.path.join(base_dir, 'jobs')
+    if not os.path.isdir(jobs_dir):
+        return []
+    cutoff = time.time() - max_age_days * 86400
+    removed = []
+    for name in os.listdir(jobs_dir):
+        path = os.path.join(jobs_dir, name)
+        try:
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+        except OSError:
+            continue
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clean job workspaces")
+    parser.add_argument('base_dir', help="Directory holding the jobs/ workspaces")
+    parser.add_argument('--max-age-days', type=float, default=7, help="Remove workspaces older than this")
+    parser.add_argument('--clean', action='store_true', help="Remove stale workspaces")
+    args = parser.parse_args()
+
+    if args.clean:
+        for path in cleanup_stale_workspaces(args.base_dir, args.max_age_days):
+            print(f"Removed {path}")
+    else:
+        jobs_dir = os.path.join(args.base_dir, 'jobs')
+        for name in sorted(os.listdir(jobs_dir)) if os.path.isdir(jobs_dir) else []:
+            path = os.path.join(jobs_dir, name)
+            size = sum(
+                os.path.getsize(os.path.join(root, f))
+                for root, _, files in os.walk(path) for f in files
+            )
+            print(f"{name}  {size / 1024 ** 2:.1f} MB")
+        print(f"Free: {free_bytes(args.base_dir) / 1024 ** 3:.1f} GB")